@@ -22,7 +22,7 @@ Roles y permisos:
 Próximas fases sugeridas:
     Fase 4: extraer locales, choferes y usuarios a services/ (locales_service, users_service, choferes_service).
     Fase 5: agregar índices SQLite (viajes.fecha_viaje, devoluciones_log.created_at, cd_despachos.fecha, cd_envios_origen.fecha).
-    Fase 6: caching selectivo con st.cache_data para catálogos (locales, choferes) y resúmenes agregados.
+    Fase 6: (hecho) cache de lecturas en app/services/cache.py para catálogos y resúmenes, invalidado por las escrituras de services.
     Fase 7: logging estructurado (actions + usuario + timestamp) y tests unitarios básicos para services.
 
 Notas técnicas:
@@ -37,7 +37,8 @@ from datetime import timedelta
 import plotly.graph_objects as go  # necesario para charts del dashboard
 
 # Servicios externos
-from app.services.stats_service import get_dashboard_stats, get_pendientes_por_local
+from app.services.stats_service import get_dashboard_snapshot
+from app.services.cache import cache_stats as svc_cache_stats, invalidar as svc_cache_invalidar
 from app.services.viajes_service import (
     listar_viajes as svc_listar_viajes,
     viaje_locales as svc_viaje_locales,
@@ -50,16 +51,20 @@ from app.services.viajes_service import (
 )
 from app.services.cd_service import (
     cd_totales as svc_cd_totales,
+    cd_stock_en_fecha as svc_cd_stock_en_fecha,
+    cd_stock_historial as svc_cd_stock_historial,
+    cd_listar_cds as svc_cd_listar_cds,
+    cd_lock_stats as svc_cd_lock_stats,
     cd_enviar_a_origen as svc_cd_enviar_a_origen,
     cd_listar_envios_origen as svc_cd_listar_envios_origen,
-    cd_actualizar_envio_origen as svc_cd_actualizar_envio_origen,
-    cd_eliminar_envio_origen as svc_cd_eliminar_envio_origen,
+    cd_aplicar_cambios_envios as svc_cd_aplicar_cambios_envios,
     cd_crear_despacho as svc_cd_crear_despacho,
-    cd_listar_despachos as svc_cd_listar_despachos,
+    cd_buscar_despachos as svc_cd_buscar_despachos,
     cd_registrar_devolucion as svc_cd_registrar_devolucion,
-    cd_actualizar_despacho_detallado as svc_cd_actualizar_despacho_detallado,
+    cd_aplicar_cambios_historial as svc_cd_aplicar_cambios_historial,
     cd_eliminar_despacho_forzado as svc_cd_eliminar_despacho_forzado,
-    cd_revertir_despacho_a_pendiente as svc_cd_revertir_despacho_a_pendiente,
+    cd_pendientes_por_destino as svc_cd_pendientes_por_destino,
+    cd_registrar_devolucion_todas_por_destino as svc_cd_registrar_devolucion_todas_por_destino,
 )
 from app.services.locales_service import (
     listar_locales as svc_loc_listar_locales,
@@ -68,6 +73,7 @@ from app.services.locales_service import (
     eliminar_local as svc_loc_eliminar_local,
     siguiente_numero as svc_loc_siguiente_numero,
     get_catalogo_con_display as svc_loc_get_catalogo_con_display,
+    get_cd_display as svc_loc_get_cd_display,
 )
 from app.services.choferes_service import (
     listar_choferes as svc_ch_listar_choferes,
@@ -104,9 +110,9 @@ except Exception:
 # IMPORTS MODELOS / FALLBACKS
 # ---------------------------------
 try:
-    from app.db import get_connection as mdl_get_connection, init_database as mdl_init_db
+    from app.db import get_connection as mdl_get_connection, init_database as mdl_init_db, checkpoint as mdl_checkpoint
 except Exception:
-    mdl_get_connection = mdl_init_db = None
+    mdl_get_connection = mdl_init_db = mdl_checkpoint = None
 
 try:
     from app.config import get_db_path as mdl_get_db_path
@@ -191,7 +197,7 @@ def get_locales_catalogo():
 
 ## Funciones de viajes y devoluciones ahora provienen de app.services.viajes_service
 
-## get_dashboard_stats y get_pendientes_por_local ahora provienen de app.services.stats_service
+## get_dashboard_snapshot (métricas del sidebar y del dashboard) proviene de app.services.stats_service
 
 def hash_password(pw: str) -> str:  # compat
     return svc_user_hash_password(pw)
@@ -287,22 +293,8 @@ def actualizar_estado_viaje(viaje_id, nuevo_estado):
     return True
 
 def get_cd_display():
-    """Intenta detectar el 'numero - nombre' del CD a partir del catálogo.
-    Heurística: primer local cuyo nombre contiene 'CD' (case-insensitive).
-    Devuelve None si no encuentra.
-    """
-    catalogo_df = get_locales_catalogo()
-    if catalogo_df.empty:
-        return None
-    for _, row in catalogo_df.iterrows():
-        nombre = str(row.get("nombre") or "")
-        if nombre and ("cd" in nombre.lower()):
-            numero = row.get("numero")
-            # Devolver exactamente el mismo formato que se usa al guardar en viaje_locales (numero o "numero - nombre")
-            # En creación de viaje usamos display "numero - nombre"; pero para matching de numero_local parece que se guarda sólo el display.
-            # Intentamos ambas posibilidades, prefiriendo display completo.
-            return f"{numero} - {nombre}" if nombre else str(numero)
-    return None
+    """Display 'numero - nombre' del CD (local marcado es_cd) o None. Resuelto y cacheado en locales_service."""
+    return svc_loc_get_cd_display()
 
 ## Lógica CD movida a cd_service (cd_totales)
 
@@ -339,6 +331,26 @@ def get_cd_display():
 
 ## Lógica CD movida a cd_service (cd_listar_envios_origen)
 
+def _pagina_cursor(clave, filtros):
+    """Cursor keyset de la página actual de una lista paginada; vuelve a la primera si cambian los filtros."""
+    estado = st.session_state.setdefault(clave, {"filtros": filtros, "cursores": []})
+    if estado["filtros"] != filtros:
+        estado["filtros"] = filtros; estado["cursores"] = []
+    return estado["cursores"][-1] if estado["cursores"] else None
+
+def _pagina_controles(clave, resultado, etiqueta="despacho(s)"):
+    """Botones Anterior / Siguiente y total (resultado = dict de cd_buscar_despachos)."""
+    estado = st.session_state[clave]
+    c1, c2, c3 = st.columns([1, 2, 1])
+    with c1:
+        if st.button("◀ Anterior", key=f"{clave}_prev", disabled=not estado["cursores"], use_container_width=True):
+            estado["cursores"].pop(); st.rerun()
+    with c2:
+        st.caption(f"Página {len(estado['cursores']) + 1} · {resultado['total']} {etiqueta}")
+    with c3:
+        if st.button("Siguiente ▶", key=f"{clave}_next", disabled=resultado["siguiente"] is None, use_container_width=True):
+            estado["cursores"].append(resultado["siguiente"]); st.rerun()
+
 # -------------------------------
 # HEADER PERSONALIZADO
 # -------------------------------
@@ -439,10 +451,11 @@ with st.sidebar:
     
     st.markdown("---")
     st.markdown("### 📊 Resumen Rápido")
-    stats = get_dashboard_stats()
-    st.metric("Total Choferes", stats['total_choferes'])
-    st.metric("Viajes Activos", stats['viajes_activos'])
-    st.metric("Cajas Pendientes", stats['pendientes'])
+    # Una lectura por rerun: el dashboard reutiliza el mismo snapshot
+    stats = get_dashboard_snapshot()
+    st.metric("Total Choferes", stats.total_choferes)
+    st.metric("Viajes Activos", stats.viajes_activos)
+    st.metric("Cajas Pendientes", stats.pendientes)
 
 # -------------------------------
 # DASHBOARD
@@ -457,8 +470,9 @@ if menu == "🏪 Locales":
     with st.form("agregar_local"):
         numero = st.number_input("Número de local", min_value=1, step=1, value=svc_loc_siguiente_numero())
         nombre = st.text_input("Nombre del local")
+        es_cd = st.checkbox("Es Centro de Distribución (CD)", value=False)
         if st.form_submit_button("Agregar"):
-            ok, msg = svc_loc_crear_local(int(numero), nombre)
+            ok, msg = svc_loc_crear_local(int(numero), nombre, es_cd=es_cd)
             (st.success if ok else st.error)(msg)
             if ok:
                 st.rerun()
@@ -467,7 +481,7 @@ if menu == "🏪 Locales":
     data_locales = svc_loc_listar_locales()
     if data_locales:
         import pandas as pd
-        df_locales = pd.DataFrame(data_locales).rename(columns={"id":"ID","numero":"Número","nombre":"Nombre"})
+        df_locales = pd.DataFrame(data_locales).rename(columns={"id":"ID","numero":"Número","nombre":"Nombre","es_cd":"CD"})
 
         # Filtros de búsqueda y orden
         with st.container():
@@ -530,6 +544,7 @@ if menu == "🏪 Locales":
                 id_local = int(fila_sel['ID'])
                 numero_actual = int(fila_sel['Número'])
                 nombre_actual = str(fila_sel['Nombre'])
+                es_cd_actual = bool(fila_sel['CD'])
 
                 col1, col2 = st.columns(2)
 
@@ -538,9 +553,10 @@ if menu == "🏪 Locales":
                     with st.form(f"editar_local_{id_local}"):
                         nuevo_numero = st.number_input("Nuevo número:", min_value=1, value=numero_actual)
                         nuevo_nombre = st.text_input("Nuevo nombre:", value=nombre_actual)
+                        nuevo_es_cd = st.checkbox("Es Centro de Distribución (CD)", value=es_cd_actual)
                     
                         if st.form_submit_button("💾 Guardar cambios", use_container_width=True):
-                            ok, msg = svc_loc_actualizar_local(id_local, int(nuevo_numero), nuevo_nombre)
+                            ok, msg = svc_loc_actualizar_local(id_local, int(nuevo_numero), nuevo_nombre, es_cd=nuevo_es_cd)
                             (st.success if ok else st.error)(msg)
                             if ok:
                                 st.rerun()
@@ -575,35 +591,33 @@ if menu == "🏪 Locales":
 elif menu == "🏠 Dashboard":
     st.header("📊 Dashboard General")
     
-    stats = get_dashboard_stats()
-    
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
         st.metric(
             label="📦 Total Enviadas",
-            value=stats['total_enviadas'],
+            value=stats.total_enviadas,
             delta=None
         )
     
     with col2:
         st.metric(
             label="✅ Total Devueltas", 
-            value=stats['total_devueltas'],
+            value=stats.total_devueltas,
             delta=None
         )
     
     with col3:
         st.metric(
             label="⚠️ Pendientes",
-            value=stats['pendientes'],
+            value=stats.pendientes,
             delta=None
         )
     
     with col4:
         st.metric(
             label="🚛 Viajes Activos",
-            value=stats['viajes_activos'],
+            value=stats.viajes_activos,
             delta=None
         )
     
@@ -611,10 +625,10 @@ elif menu == "🏠 Dashboard":
     
     # Solo gráfico de estado general y detalle (se elimina el gráfico por local)
     st.subheader("📈 Estado de Cajas")
-    if stats['total_enviadas'] > 0:
+    if stats.total_enviadas > 0:
         fig = go.Figure(data=[go.Pie(
             labels=['Devueltas', 'Pendientes'],
-            values=[stats['total_devueltas'], stats['pendientes']],
+            values=[stats.total_devueltas, stats.pendientes],
             hole=.3,
             marker_colors=["#16a34a", "#f59e0b"]
         )])
@@ -623,19 +637,19 @@ elif menu == "🏠 Dashboard":
     else:
         st.info("No hay datos para mostrar")
 
-    pend_local = get_pendientes_por_local()
+    pend_local_det = stats.pendientes_df()
     
     st.subheader("🔍 Detalle de Cajas Pendientes por Local")
-    pend_local_det = pend_local[pend_local['pendientes'] > 0] if not pend_local.empty else pend_local
     if not pend_local_det.empty:
         st.dataframe(
-            pend_local_det[['local', 'enviadas', 'devueltas', 'pendientes']].sort_values('pendientes', ascending=False),
+            pend_local_det[['local', 'enviadas', 'devueltas', 'pendientes', 'ultimo_movimiento']],
             use_container_width=True,
             column_config={
                 "local": "🏪 Local",
                 "enviadas": st.column_config.NumberColumn("📦 Enviadas"),
                 "devueltas": st.column_config.NumberColumn("✅ Devueltas"),
-                "pendientes": st.column_config.NumberColumn("⚠️ Pendientes")
+                "pendientes": st.column_config.NumberColumn("⚠️ Pendientes"),
+                "ultimo_movimiento": "🕒 Último movimiento"
             }
         )
     else:
@@ -684,13 +698,11 @@ elif menu == "🏠 Dashboard":
                         v.fecha_viaje,
                         v.estado,
                         c.nombre as chofer_nombre,
-                        COUNT(vl.id) as total_locales,
-                        SUM(vl.cajas_enviadas) as total_enviadas,
-                        SUM(vl.cajas_devueltas) as total_devueltas
+                        v.total_locales,
+                        v.total_enviadas,
+                        v.total_devueltas
                     FROM viajes v
                     LEFT JOIN choferes c ON v.chofer_id = c.id
-                    LEFT JOIN viaje_locales vl ON v.id = vl.viaje_id
-                    GROUP BY v.id
                     ORDER BY v.fecha_viaje DESC
                 """
                 df_vr = pd.read_sql_query(query_resumen, conn)
@@ -735,6 +747,9 @@ elif menu == "🏠 Dashboard":
 
         # Backup del archivo .db completo
         try:
+            # Con WAL los últimos cambios pueden estar en el -wal: volcarlos antes de leer el archivo
+            if mdl_checkpoint:
+                mdl_checkpoint("TRUNCATE")
             db_path = get_db_path()
             with open(db_path, "rb") as f:
                 db_bytes = f.read()
@@ -752,6 +767,22 @@ elif menu == "🏠 Dashboard":
     # Herramienta de limpieza (solo visible para admin)
     current_role = st.session_state.get("user", {}).get("role")
     if current_role == "admin":
+        with st.expander("⏱️ Lock de escritura CD", expanded=False):
+            st.caption("Espera y tiempo de retención del lock de escritura por operación (desde que arrancó el servidor).")
+            df_locks = svc_cd_lock_stats()
+            if df_locks.empty:
+                st.info("Todavía no hubo escrituras del CD en este proceso.")
+            else:
+                st.dataframe(df_locks, use_container_width=True, hide_index=True)
+        with st.expander("🗃️ Cache de lecturas", expanded=False):
+            st.caption("Aciertos y fallos del cache de catálogos y resúmenes por función (desde que arrancó el servidor).")
+            datos_cache = svc_cache_stats()
+            if not datos_cache:
+                st.info("Todavía no hubo lecturas cacheadas en este proceso.")
+            else:
+                df_cache = pd.DataFrame.from_dict(datos_cache, orient="index").rename_axis("funcion").reset_index()
+                df_cache["hit_ratio"] = (df_cache["hit_ratio"] * 100).round(1)
+                st.dataframe(df_cache, use_container_width=True, hide_index=True)
         with st.expander("🧹 Limpiar datos (mantener Locales)", expanded=False):
             st.caption("Elimina viajes, sus ítems, choferes y despachos del CD. Mantiene la lista de Locales.")
             try:
@@ -794,6 +825,7 @@ elif menu == "🏠 Dashboard":
                             pass  # Si no existe la tabla sqlite_sequence o falla, ignorar
                         cur.execute("COMMIT")
                         conn.close()
+                        svc_cache_invalidar()
                         st.success("Datos eliminados. Los Locales se mantuvieron intactos.")
                         st.balloons(); st.rerun()
                     except Exception as e:
@@ -1113,12 +1145,21 @@ elif menu == "🛣️ Viajes":
 # -------------------------------
 elif menu == "🏬 Centro de Distribución":
     st.markdown("## 🏬 Centro de Distribución")
-    st.markdown("Carga aquí los despachos del CD a los locales. El CD se detecta automáticamente.")
+    st.markdown("Carga aquí los despachos del CD a los locales. Los CD se marcan en Locales (Es CD).")
     role = st.session_state.get("user", {}).get("role", "")
     cd_edit_enabled = role in ("admin", "cd_only")
 
+    # Con varios CD se elige cuál operar; stock, despachos y envíos se filtran por ese CD
+    cds_disponibles = svc_cd_listar_cds()
+    if len(cds_disponibles) > 1:
+        cd_activo = st.selectbox("🏬 CD", cds_disponibles, key="cd_activo")
+        cd_filtro = cd_activo
+    else:
+        cd_activo = cds_disponibles[0] if cds_disponibles else None
+        cd_filtro = None
+
     # KPIs del CD: recibido (por viajes al CD), enviados, devueltos, stock actual
-    tot = svc_cd_totales()  # se recalcula en cada run
+    tot = svc_cd_totales(cd_activo)  # lectura O(1) del ledger cd_stock
     cd_name = tot.get("cd") or "CD"
     k1, k2, k3, k4, k5, k6 = st.columns(6)
     with k1:
@@ -1128,12 +1169,36 @@ elif menu == "🏬 Centro de Distribución":
     with k3:
         st.metric("✅ Devueltos al CD", tot.get("devueltos", 0))
     with k4:
-        st.metric("🏷️ CD detectado", cd_name)
+        st.metric("🏷️ CD", cd_name)
     with k5:
         st.metric("📊 Stock CD", tot.get("stock", 0))
     with k6:
         st.metric("📤 Enviado a Pastas Frescas", tot.get("enviados_origen", 0))
 
+    with st.expander("📈 Stock histórico del CD", expanded=False):
+        # Snapshots diarios (cd_stock_diario): stock a una fecha y tendencia sin recorrer el historial
+        s1, s2, s3 = st.columns(3)
+        with s1:
+            fecha_stock = st.date_input("Stock al cierre del día", value=datetime.date.today(), key="cd_stock_fecha")
+        with s2:
+            hist_desde = st.date_input("Tendencia desde", value=datetime.date.today() - timedelta(days=90), key="cd_stock_hist_from")
+        with s3:
+            hist_hasta = st.date_input("Hasta", value=datetime.date.today(), key="cd_stock_hist_to")
+        st.metric(f"📊 Stock al {fecha_stock}", svc_cd_stock_en_fecha(fecha_stock, cd_activo).get("stock", 0))
+        df_stock_hist = svc_cd_stock_historial(hist_desde, hist_hasta, cd_activo)
+        if df_stock_hist.empty:
+            st.info("Sin movimientos del CD en el rango.")
+        else:
+            st.line_chart(df_stock_hist.set_index("fecha")["stock"])
+            st.dataframe(
+                df_stock_hist.rename(columns={
+                    "fecha": "📅 Fecha", "entradas": "📥 Entradas", "recibido_viajes": "🚛 Recibido",
+                    "devueltas": "✅ Devueltas", "despachos": "📦 Despachos", "envios_origen": "📤 A PF", "stock": "📊 Stock",
+                }),
+                use_container_width=True,
+                hide_index=True,
+            )
+
     st.markdown("<hr class='custom-divider'>", unsafe_allow_html=True)
 
     # Formulario para registrar un despacho desde CD a un destino (sin origen seleccionable)
@@ -1177,6 +1242,36 @@ elif menu == "🏬 Centro de Distribución":
             st.warning("Tu rol no permite crear o editar en el Centro de Distribución.")
 
         st.markdown("<hr class='custom-divider'>", unsafe_allow_html=True)
+        # Resumen por destino (tabla cd_pendientes_destino: una fila por destino, sin agregar historial)
+        df_dest = svc_cd_pendientes_por_destino()
+        with st.expander(f"📊 Pendientes por destino ({len(df_dest)})", expanded=False):
+            if df_dest.empty:
+                st.success("🎉 No hay cajas pendientes en ningún destino")
+            else:
+                st.dataframe(
+                    df_dest,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "destino_local": st.column_config.TextColumn("🏪 Destino"),
+                        "enviadas": st.column_config.NumberColumn("📦 Enviadas"),
+                        "devueltas": st.column_config.NumberColumn("✅ Devueltas"),
+                        "pendientes": st.column_config.NumberColumn("⚠️ Pendientes"),
+                        "abiertos": st.column_config.NumberColumn("Despachos abiertos"),
+                        "primer_abierto": st.column_config.TextColumn("Más antiguo"),
+                    },
+                )
+                with st.form("cd_devolver_todo_destino"):
+                    dest_todo = st.selectbox("Destino", df_dest["destino_local"].tolist(), key="cd_devolver_todo_dest")
+                    if st.form_submit_button("📥 Devolver todo el destino", use_container_width=True, disabled=(not cd_edit_enabled)):
+                        ok, aplicadas = svc_cd_registrar_devolucion_todas_por_destino(dest_todo)
+                        if not ok:
+                            st.error(aplicadas)
+                        elif aplicadas > 0:
+                            st.success(f"Se registraron {aplicadas} cajas devueltas de {dest_todo}.")
+                            st.rerun()
+                        else:
+                            st.info("Ese destino ya no tiene cajas pendientes.")
         st.markdown("### 📋 Despachos pendientes")
         f1, f2, f3 = st.columns(3)
         with f1:
@@ -1186,22 +1281,17 @@ elif menu == "🏬 Centro de Distribución":
         with f3:
             filtro_dest = st.text_input("Buscar destino", value="", key="cd_pend_search")
 
-        # Cálculo y render de pendientes dentro de la misma pestaña
-        df_list = svc_cd_listar_despachos(start_date=fecha_i, end_date=fecha_f)
-        if filtro_dest:
-            df_list = df_list[df_list["destino_local"].str.contains(filtro_dest, case=False, na=False)]
-        df_list = df_list.copy()
-        if not df_list.empty:
-            df_list["cajas_enviadas"] = df_list["cajas_enviadas"].fillna(0).astype(int)
-            df_list["cajas_devueltas"] = df_list["cajas_devueltas"].fillna(0).astype(int)
-            df_list["pendientes"] = df_list["cajas_enviadas"] - df_list["cajas_devueltas"]
-        else:
-            df_list["pendientes"] = pd.Series(dtype=int)
-
-        df_pend = df_list[df_list["pendientes"] > 0]
+        # Búsqueda, estado y paginación en el servidor (una página por rerun)
+        filtros_pend = (str(fecha_i), str(fecha_f), cd_filtro, filtro_dest.strip())
+        res_pend = svc_cd_buscar_despachos(
+            start_date=fecha_i, end_date=fecha_f, cd_local=cd_filtro, texto=filtro_dest, estado="pendiente",
+            cursor=_pagina_cursor("cd_pend_pagina", filtros_pend),
+        )
+        df_pend = res_pend["filas"]
         if df_pend.empty:
             st.info("No hay despachos pendientes en este rango.")
         else:
+            _pagina_controles("cd_pend_pagina", res_pend)
             cols = st.columns(2)
             for idx, (_, r) in enumerate(df_pend.iterrows()):
                 pendientes = int(r["pendientes"])
@@ -1255,22 +1345,17 @@ elif menu == "🏬 Centro de Distribución":
         with f3:
             filtro_dest_hist = st.text_input("🔎 Buscar por destino", value="", key="cd_hist_search")
 
-        df_list_h = svc_cd_listar_despachos(start_date=fecha_i_h, end_date=fecha_f_h)
-        if filtro_dest_hist:
-            df_list_h = df_list_h[df_list_h["destino_local"].str.contains(filtro_dest_hist, case=False, na=False)]
-        df_list_h = df_list_h.copy()
-        if not df_list_h.empty:
-            df_list_h["cajas_enviadas"] = df_list_h["cajas_enviadas"].fillna(0).astype(int)
-            df_list_h["cajas_devueltas"] = df_list_h["cajas_devueltas"].fillna(0).astype(int)
-            df_list_h["pendientes"] = df_list_h["cajas_enviadas"] - df_list_h["cajas_devueltas"]
-        else:
-            df_list_h["pendientes"] = pd.Series(dtype=int)
-
-        # Historial = completados (pendientes == 0)
-        df_hist = df_list_h[df_list_h["pendientes"] == 0].copy()
+        # Historial = completados, paginado en el servidor
+        filtros_hist = (str(fecha_i_h), str(fecha_f_h), cd_filtro, filtro_dest_hist.strip())
+        res_hist = svc_cd_buscar_despachos(
+            start_date=fecha_i_h, end_date=fecha_f_h, cd_local=cd_filtro, texto=filtro_dest_hist, estado="completo",
+            cursor=_pagina_cursor("cd_hist_pagina", filtros_hist),
+        )
+        df_hist = res_hist["filas"].copy()
         if df_hist.empty:
             st.info("Aún no hay despachos completados en este rango.")
         else:
+            _pagina_controles("cd_hist_pagina", res_hist)
             if not cd_edit_enabled:
                 st.info("Para editar necesitas rol 'admin' o 'cd_only'.")
 
@@ -1314,18 +1399,11 @@ elif menu == "🏬 Centro de Distribución":
 
             applied = st.button("Aplicar cambios", key="cd_hist_apply_changes", disabled=(not cd_edit_enabled))
             if applied and cd_edit_enabled:
-                to_delete = edited_hist[edited_hist["🗑️ Eliminar"] == True]
-                ok_del, err_del = 0, []
-                for _, row in to_delete.iterrows():
-                    rid = int(row["#"])
-                    ok, msg = svc_cd_revertir_despacho_a_pendiente(rid)
-                    if ok:
-                        ok_del += 1
-                    else:
-                        err_del.append(f"Despacho #{rid}: {msg}")
+                # Diff del editor -> un solo lote (validado y aplicado en una transacción)
                 base = df_hist_view.set_index("#")
                 edited_idx = edited_hist.set_index("#")
-                ok_upd, err_upd = 0, []
+                revertir = [int(rid) for rid in edited_idx.index[edited_idx["🗑️ Eliminar"] == True]]
+                actualizar = []
                 for rid, row in edited_idx.iterrows():
                     if bool(row.get("🗑️ Eliminar", False)):
                         continue
@@ -1342,25 +1420,18 @@ elif menu == "🏬 Centro de Distribución":
                         enviadas_new != int(orig["📦 Enviadas"]) or
                         devueltas_new != int(orig["✅ Devueltas"]) 
                     )
-                    if not changed:
-                        continue
-                    if devueltas_new > enviadas_new:
-                        err_upd.append(f"Despacho #{rid}: Devueltas ({devueltas_new}) no pueden superar Enviadas ({enviadas_new})")
-                        continue
-                    ok, msg = svc_cd_actualizar_despacho_detallado(int(rid), fecha_new, enviadas_new, devueltas_new)
+                    if changed:
+                        actualizar.append({"id": int(rid), "fecha": fecha_new, "cajas_enviadas": enviadas_new, "cajas_devueltas": devueltas_new})
+                if not (actualizar or revertir):
+                    st.info("No hay cambios para aplicar.")
+                else:
+                    ok, msg = svc_cd_aplicar_cambios_historial({"actualizar": actualizar, "revertir": revertir})
                     if ok:
-                        ok_upd += 1
+                        st.success(f"✅ {msg}")
+                        st.rerun()
                     else:
-                        err_upd.append(f"Despacho #{rid}: {msg}")
-                if ok_del:
-                    st.success(f"✅ {ok_del} despacho(s) revertido(s) a estado pendiente")
-                if ok_upd:
-                    st.success(f"✅ Actualizados {ok_upd} despacho(s)")
-                if err_del or err_upd:
-                    for m in err_del + err_upd:
-                        st.error(m)
-                if ok_del or ok_upd:
-                    st.rerun()
+                        for m in msg.splitlines():
+                            st.error(m)
             elif applied and not cd_edit_enabled:
                 st.warning("No tienes permisos para aplicar cambios.")
 
@@ -1378,7 +1449,7 @@ elif menu == "🏬 Centro de Distribución":
             submit_origen = st.form_submit_button("Enviar a Pastas Frescas", type="primary", disabled=(not cd_edit_enabled))
         if submit_origen and cd_edit_enabled:
             if cajas_origen > 0:
-                ok, msg = svc_cd_enviar_a_origen(fecha_origen, int(cajas_origen))
+                ok, msg = svc_cd_enviar_a_origen(fecha_origen, int(cajas_origen), cd_local=cd_activo)
                 if ok:
                     st.success(msg)
                     st.rerun()
@@ -1398,10 +1469,10 @@ elif menu == "🏬 Centro de Distribución":
         
         # Mostrar stock actual para orientar al usuario
         if cd_edit_enabled:
-            stock_actual = svc_cd_totales().get("stock", 0)
+            stock_actual = svc_cd_totales(cd_activo).get("stock", 0)
             st.info(f"📦 Stock actual en CD: **{stock_actual}** cajas disponibles")
         
-        df_pf = svc_cd_listar_envios_origen(start_date=pf_i, end_date=pf_f)
+        df_pf = svc_cd_listar_envios_origen(start_date=pf_i, end_date=pf_f, cd_local=cd_filtro)
         if df_pf.empty:
             st.info("No hay envíos a Pastas Frescas en el rango seleccionado.")
         else:
@@ -1466,80 +1537,31 @@ elif menu == "🏬 Centro de Distribución":
                 edited_pf['🗑️ Eliminar'] = False
 
             if st.button("Aplicar cambios", key="pf_hist_apply_changes", disabled=(not cd_edit_enabled)):
-                # Aplicar eliminaciones primero - eliminar TODOS los envíos de las fechas marcadas
-                to_delete = edited_pf[edited_pf["🗑️ Eliminar"] == True]
-                ok_del, err_del = 0, []
-                cajas_liberadas_por_eliminacion = 0
-                
-                for idx, row in to_delete.iterrows():
-                    ids_to_delete = row["ids_envios"]  # Lista de IDs a eliminar para esta fecha
-                    fecha = row["📅 Fecha"]
-                    cajas_total = int(row["📦 Enviadas"])
-                    
-                    # Eliminar todos los envíos de esta fecha
-                    for rid in ids_to_delete:
-                        ok, msg = svc_cd_eliminar_envio_origen(int(rid))
-                        if ok:
-                            ok_del += 1
-                        else:
-                            err_del.append(f"Envío #{rid} (fecha {fecha}): {msg}")
-                    
-                    if ok_del > 0:
-                        cajas_liberadas_por_eliminacion += cajas_total
-
-                # Aplicar ediciones de cantidad (donde no se marcó eliminar)
-                ok_upd, err_upd = 0, []
-                
+                # Diff del editor -> un solo lote (validado y aplicado en una transacción).
+                # Fecha marcada para eliminar: se eliminan todos sus envíos. Fecha editada: el primer
+                # envío toma la nueva cantidad total y los demás de esa fecha se eliminan.
+                actualizar, eliminar = [], []
                 for idx, row in edited_pf.iterrows():
+                    ids_envios = [int(rid) for rid in row["ids_envios"]]
                     if bool(row.get("🗑️ Eliminar", False)):
+                        eliminar.extend(ids_envios)
                         continue
-                    
-                    # Obtener datos originales y editados
                     fecha_new = row["📅 Fecha"]
                     cajas_new = int(row["📦 Enviadas"])
-                    ids_envios = row["ids_envios"]
-                    
-                    # Encontrar la fila original correspondiente
                     orig_row = df_pf_view.iloc[idx]
-                    cajas_old = int(orig_row["📦 Enviadas"])
-                    
-                    # Verificar si cambió la cantidad
-                    if cajas_new != cajas_old:
-                        # Si hay múltiples envíos en la misma fecha, necesitamos decidir cómo distribuir el cambio
-                        # Por simplicidad, actualizamos el primer envío con la nueva cantidad total
-                        # y eliminamos los demás envíos de esa fecha
-                        
-                        if len(ids_envios) == 1:
-                            # Caso simple: solo un envío en esa fecha
-                            ok, msg = svc_cd_actualizar_envio_origen(int(ids_envios[0]), fecha_new, cajas_new)
-                            if ok:
-                                ok_upd += 1
-                            else:
-                                err_upd.append(f"Fecha {fecha_new}: {msg}")
-                        else:
-                            # Caso complejo: múltiples envíos en la misma fecha
-                            # Actualizar el primer envío con la cantidad total nueva
-                            # y eliminar los demás
-                            ok, msg = svc_cd_actualizar_envio_origen(int(ids_envios[0]), fecha_new, cajas_new)
-                            if ok:
-                                ok_upd += 1
-                                # Eliminar los envíos adicionales
-                                for rid in ids_envios[1:]:
-                                    svc_cd_eliminar_envio_origen(int(rid))
-                            else:
-                                err_upd.append(f"Fecha {fecha_new}: {msg}")
-
-                # Mostrar resultados
-                if ok_del:
-                    fechas_eliminadas = len(to_delete)
-                    st.success(f"✅ Eliminados todos los envíos de {fechas_eliminadas} fecha(s) ({ok_del} envío(s) total)")
-                if ok_upd:
-                    st.success(f"✅ Actualizadas {ok_upd} fecha(s)")
-                if err_del or err_upd:
-                    for m in err_del + err_upd:
-                        st.error(m)
-                if ok_del or ok_upd:
-                    st.rerun()
+                    if cajas_new != int(orig_row["📦 Enviadas"]) or str(fecha_new) != str(orig_row["📅 Fecha"]):
+                        actualizar.append({"id": ids_envios[0], "fecha": fecha_new, "cajas_enviadas": cajas_new})
+                        eliminar.extend(ids_envios[1:])
+                if not (actualizar or eliminar):
+                    st.info("No hay cambios para aplicar.")
+                else:
+                    ok, msg = svc_cd_aplicar_cambios_envios({"actualizar": actualizar, "eliminar": eliminar})
+                    if ok:
+                        st.success(f"✅ {msg}")
+                        st.rerun()
+                    else:
+                        for m in msg.splitlines():
+                            st.error(m)
 
 elif menu == "📥 Devoluciones":
     st.markdown("## 📥 Registro de Devoluciones")
@@ -1777,6 +1799,10 @@ elif menu == "📥 Devoluciones":
                                     pass
                             # Re-render para mostrar estado actualizado / banner
                             st.rerun()
+                        elif isinstance(msg_upd, list):
+                            # Un motivo por ítem rechazado: se muestra con el local de esa fila
+                            nombres = dict(zip(locales['id'].astype(int), locales['numero_local']))
+                            st.error("\n".join(f"{nombres.get(e['id'], e['id'])}: {e['motivo']}" for e in msg_upd))
                         else:
                             st.error(msg_upd)
             
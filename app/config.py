@@ -1,5 +1,6 @@
 # Centralized app configuration and theming
 import os
+import re
 from dataclasses import dataclass
 
 @dataclass(frozen=True)
@@ -15,14 +16,122 @@ BRAND = Brand()
 
 DB_FILENAME = "cajas_plasticas.db"
 
+# Pool de conexiones SQLite (app.db)
+DB_POOL_MAX_SIZE = 8       # conexiones abiertas como máximo por proceso
+DB_POOL_TIMEOUT = 10.0     # segundos de espera por una conexión libre
+DB_TIMEOUT = 5.0           # segundos que sqlite3 espera un lock antes de fallar
+
+# Perfil de PRAGMAs aplicado a cada conexión nueva (nombre, valor).
+# WAL: los lectores (dashboard) no esperan a los escritores (BEGIN IMMEDIATE del CD).
+DB_PRAGMAS = (
+    ("foreign_keys", "ON"),
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),        # seguro con WAL; fsync solo en checkpoint
+    ("cache_size", "-16000"),         # negativo = KiB (~16 MB por conexión)
+    ("mmap_size", "67108864"),        # 64 MB de lectura mapeada
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", "5000"),         # ms de espera ante un lock de escritura
+    ("wal_autocheckpoint", "1000"),   # checkpoint pasivo cada ~1000 páginas
+    ("journal_size_limit", "67108864"),  # el WAL se trunca a 64 MB tras cada checkpoint
+)
+
+# Política de checkpoint: cada DB_CHECKPOINT_INTERVAL devoluciones al pool se mira
+# el tamaño del WAL y, si supera DB_WAL_MAX_BYTES, se hace un checkpoint PASSIVE.
+DB_CHECKPOINT_INTERVAL = 200
+DB_WAL_MAX_BYTES = 32 * 1024 * 1024
+
+# Variables de entorno que ajustan la conexión (ver get_db_settings)
+ENV_DB_PATH = "CAJAS_PLASTICAS_DB"
+ENV_DB_TIMEOUT = "CAJAS_PLASTICAS_DB_TIMEOUT"
+ENV_DB_READONLY = "CAJAS_PLASTICAS_DB_READONLY"
+ENV_DB_PRAGMAS = "CAJAS_PLASTICAS_DB_PRAGMAS"          # "cache_size=-20000;temp_store=MEMORY"
+ENV_DB_POOL_SIZE = "CAJAS_PLASTICAS_DB_POOL_SIZE"
+ENV_DB_POOL_TIMEOUT = "CAJAS_PLASTICAS_DB_POOL_TIMEOUT"
+
+# Cache de lecturas de services (app.services.cache): el TTL acota lo que escriben otros
+# procesos (jobs, app.maintenance), que no invalidan el cache de este
+CACHE_TTL = 300.0          # segundos por defecto de cada entrada
+CACHE_MAX_ENTRIES = 256    # LRU: al superarlo se descarta la entrada menos usada
+ENV_CACHE_DISABLED = "CAJAS_PLASTICAS_CACHE_DISABLED"  # "1": toda lectura va a la base
+ENV_CACHE_TTL = "CAJAS_PLASTICAS_CACHE_TTL"
+ENV_CACHE_MAX_ENTRIES = "CAJAS_PLASTICAS_CACHE_MAX_ENTRIES"
+
 # Streamlit page config constants
 PAGE_TITLE = "Pastas Frescas — Control de Cajas"
 PAGE_ICON = "📦"
 
 
+@dataclass(frozen=True)
+class DBSettings:
+    path: str
+    timeout: float = DB_TIMEOUT
+    read_only: bool = False
+    pragmas: tuple = DB_PRAGMAS
+    pool_size: int = DB_POOL_MAX_SIZE
+    pool_timeout: float = DB_POOL_TIMEOUT
+
+
+@dataclass(frozen=True)
+class CacheSettings:
+    enabled: bool = True
+    ttl: float = CACHE_TTL
+    max_entries: int = CACHE_MAX_ENTRIES
+
+
 def get_db_path() -> str:
     """Return absolute path for the sqlite db both local and Streamlit Cloud."""
+    override = os.environ.get(ENV_DB_PATH)
+    if override:
+        return os.path.abspath(override)
     base_dir = os.environ.get("STREAMLIT_CLOUD", None)
     if base_dir:
         return os.path.join("/mount/src", DB_FILENAME)
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", DB_FILENAME)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _env_bool(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "si", "sí")
+
+
+def _parse_pragmas(raw: str) -> dict:
+    pragmas = {}
+    for item in (raw or "").split(";"):
+        if "=" not in item:
+            continue
+        key, value = item.split("=", 1)
+        key, value = key.strip().lower(), value.strip()
+        if re.fullmatch(r"[a-z_]+", key) and re.fullmatch(r"-?[\w.]+", value):
+            pragmas[key] = value
+    return pragmas
+
+
+def get_db_settings() -> DBSettings:
+    """Configuración efectiva de la conexión: defaults de este módulo + variables de entorno.
+    Todos los services obtienen conexiones con estos parámetros vía app.db.get_connection().
+    """
+    pragmas = dict(DB_PRAGMAS)
+    pragmas.update(_parse_pragmas(os.environ.get(ENV_DB_PRAGMAS, "")))
+    return DBSettings(
+        path=get_db_path(),
+        timeout=_env_float(ENV_DB_TIMEOUT, DB_TIMEOUT),
+        read_only=_env_bool(ENV_DB_READONLY),
+        pragmas=tuple(pragmas.items()),
+        pool_size=int(_env_float(ENV_DB_POOL_SIZE, DB_POOL_MAX_SIZE)),
+        pool_timeout=_env_float(ENV_DB_POOL_TIMEOUT, DB_POOL_TIMEOUT),
+    )
+
+
+def get_cache_settings() -> CacheSettings:
+    """Configuración del cache de lecturas: defaults de este módulo + variables de entorno."""
+    return CacheSettings(
+        enabled=not _env_bool(ENV_CACHE_DISABLED),
+        ttl=_env_float(ENV_CACHE_TTL, CACHE_TTL),
+        max_entries=int(_env_float(ENV_CACHE_MAX_ENTRIES, CACHE_MAX_ENTRIES)),
+    )
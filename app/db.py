@@ -1,123 +1,410 @@
 # Database helpers
+import datetime
 import os
 import sqlite3
-from .config import get_db_path
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from urllib.parse import quote
+from .config import DBSettings, get_db_settings, DB_CHECKPOINT_INTERVAL, DB_WAL_MAX_BYTES
 
 
-def get_connection():
-    """Create and return a SQLite connection, ensuring path is valid."""
-    db_path = get_db_path()
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    # Enforce foreign key constraints
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-    except Exception:
-        pass
-    # quick sanity
-    conn.execute("SELECT 1").fetchone()
-    return conn
+class PooledConnection(sqlite3.Connection):
+    """Conexión SQLite que vuelve al pool al llamar close().
 
+    Es subclase de sqlite3.Connection para que pandas (read_sql_query) y el
+    resto del código la traten como una conexión normal.
+    """
 
-def init_database():
-    conn = get_connection()
-    c = conn.cursor()
-
-    # choferes
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS choferes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL UNIQUE,
-            contacto TEXT,
-            fecha_registro DATE DEFAULT CURRENT_DATE
-        )
-        """
-    )
-
-    # viajes
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS viajes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chofer_id INTEGER NOT NULL,
-            fecha_viaje DATE NOT NULL,
-            estado TEXT DEFAULT 'En Curso',
-            FOREIGN KEY (chofer_id) REFERENCES choferes (id)
-        )
-        """
-    )
-
-    # viaje_locales
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS viaje_locales (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            viaje_id INTEGER NOT NULL,
-            numero_local TEXT NOT NULL,
-            cajas_enviadas INTEGER NOT NULL,
-            cajas_devueltas INTEGER DEFAULT 0,
-            FOREIGN KEY (viaje_id) REFERENCES viajes (id)
-        )
-        """
-    )
-
-    # reception_local
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS reception_local (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            numero INTEGER UNIQUE,
-            nombre TEXT UNIQUE
-        )
-        """
-    )
-
-    # users (asegurar que exista para evitar depender solo de ensure_user_table fallback)
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT NOT NULL DEFAULT 'admin'
-        )
-        """
-    )
-
-    # devoluciones_log (historial de devoluciones individuales y masivas)
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS devoluciones_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            viaje_id INTEGER NOT NULL,
-            viaje_local_id INTEGER NOT NULL,
-            numero_local TEXT NOT NULL,
-            cantidad INTEGER NOT NULL,
-            tipo TEXT NOT NULL DEFAULT 'individual', -- 'individual' | 'masiva'
-            usuario TEXT, -- username que registró la devolución
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (viaje_id) REFERENCES viajes (id),
-            FOREIGN KEY (viaje_local_id) REFERENCES viaje_locales (id)
-        )
-        """
-    )
-
-    conn.commit()
-    # Índices idempotentes (performance)
-    indices = [
-        "CREATE INDEX IF NOT EXISTS idx_viajes_fecha ON viajes(fecha_viaje)",
-        "CREATE INDEX IF NOT EXISTS idx_devlog_created ON devoluciones_log(created_at)",
-        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_fecha ON cd_despachos(fecha)",
-        "CREATE INDEX IF NOT EXISTS idx_cd_envios_fecha ON cd_envios_origen(fecha)",
-        "CREATE INDEX IF NOT EXISTS idx_viaje_locales_viaje ON viaje_locales(viaje_id)",
-        "CREATE INDEX IF NOT EXISTS idx_devlog_viaje ON devoluciones_log(viaje_id)",
-        "CREATE INDEX IF NOT EXISTS idx_devlog_viaje_local ON devoluciones_log(viaje_local_id)"
-    ]
-    for stmt in indices:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._checked_out = False
+
+    def close(self):
+        pool = self._pool
+        if pool is None:
+            super().close()
+        else:
+            pool.release(self)
+
+    def _dispose(self):
+        self._pool = None
+        try:
+            sqlite3.Connection.close(self)
+        except Exception:
+            pass
+
+    def __del__(self):
+        # Conexión perdida sin close(): liberar su cupo en el pool
+        pool = getattr(self, "_pool", None)
+        if pool is not None and getattr(self, "_checked_out", False):
+            pool._forget(self)
+
+
+def _connect(settings: DBSettings) -> PooledConnection:
+    """Fábrica única de conexiones: path, timeout y modo solo lectura según settings."""
+    if settings.read_only:
+        uri = f"file:{quote(settings.path)}?mode=ro"
+        return sqlite3.connect(uri, uri=True, timeout=settings.timeout, check_same_thread=False, factory=PooledConnection)
+    return sqlite3.connect(settings.path, timeout=settings.timeout, check_same_thread=False, factory=PooledConnection)
+
+
+def _setup_connection(conn: sqlite3.Connection, settings: DBSettings):
+    """Configuración por conexión (se ejecuta una sola vez al abrirla)."""
+    # PRAGMAs del perfil (app.config.DB_PRAGMAS + entorno)
+    for name, value in settings.pragmas:
+        if settings.read_only and name == "journal_mode":
+            continue  # cambiar el journal requiere escritura
         try:
-            c.execute(stmt)
+            conn.execute(f"PRAGMA {name} = {value}").fetchall()
         except Exception:
             pass
-    conn.commit()
-    conn.close()
+
+
+class ConnectionPool:
+    """Pool acotado y thread-safe de conexiones SQLite.
+
+    - Reutiliza conexiones ya configuradas (PRAGMAs aplicados al crearlas).
+    - Verifica la conexión al entregarla (SELECT 1) y la reemplaza si falló.
+    - Si no hay conexiones libres y se alcanzó max_size, espera hasta timeout.
+    """
+
+    def __init__(self, settings: DBSettings):
+        self.settings = settings
+        self.db_path = settings.path
+        self.max_size = max(1, int(settings.pool_size))
+        self.timeout = float(settings.pool_timeout)
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "releases": 0,
+            "checkpoints": 0,
+        }
+
+    # --- ciclo de vida de conexiones ---
+
+    def _create(self) -> PooledConnection:
+        conn = _connect(self.settings)
+        _setup_connection(conn, self.settings)
+        conn._pool = self
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn: PooledConnection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn: PooledConnection):
+        conn._dispose()
+        with self._cond:
+            self._stats["discarded"] += 1
+
+    def acquire(self) -> PooledConnection:
+        deadline = time.monotonic() + self.timeout
+        wait_start = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.OperationalError("Pool de conexiones cerrado")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._open < self.max_size:
+                    self._open += 1
+                    conn = None
+                    break
+                if wait_start is None:
+                    wait_start = time.monotonic()
+                    self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    self._stats["wait_time"] += time.monotonic() - wait_start
+                    raise sqlite3.OperationalError(
+                        f"Pool de conexiones agotado ({self.max_size} en uso)"
+                    )
+                self._cond.wait(remaining)
+            if wait_start is not None:
+                self._stats["wait_time"] += time.monotonic() - wait_start
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._create()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        conn._checked_out = True
+        if _trace_callback is not None:
+            conn.set_trace_callback(_trace_callback)
+        with self._cond:
+            self._stats["checkouts"] += 1
+        return conn
+
+    def release(self, conn: PooledConnection):
+        with self._cond:
+            if not conn._checked_out:
+                return  # close() repetido
+            conn._checked_out = False
+        reusable = True
+        try:
+            # Igual que sqlite3.close(): lo no confirmado se descarta
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+            conn.set_trace_callback(None)
+        except Exception:
+            reusable = False
+        with self._cond:
+            self._stats["releases"] += 1
+            check_wal = self._stats["releases"] % DB_CHECKPOINT_INTERVAL == 0
+        if reusable and check_wal and not self.settings.read_only:
+            if _wal_bytes(self.db_path) > DB_WAL_MAX_BYTES:
+                try:
+                    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                    with self._cond:
+                        self._stats["checkpoints"] += 1
+                except Exception:
+                    pass
+        with self._cond:
+            if reusable and not self._closed:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+            self._open -= 1
+            self._cond.notify()
+        self._discard(conn)
+
+    def _forget(self, conn: PooledConnection):
+        with self._cond:
+            conn._checked_out = False
+            self._open -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def close(self):
+        """Cierra las conexiones libres; las prestadas se cierran al devolverse."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn._dispose()
+
+    def stats(self) -> dict:
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                "db_path": self.db_path,
+                "read_only": self.settings.read_only,
+                "max_size": self.max_size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+            })
+        return data
+
+
+def _wal_bytes(db_path: str) -> int:
+    try:
+        return os.path.getsize(db_path + "-wal")
+    except OSError:
+        return 0
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_trace_callback = None
+
+
+def set_trace_callback(callback):
+    """Instala (o quita con None) un callback que recibe cada sentencia SQL ejecutada
+    por las conexiones que se entreguen desde el pool (ver app.query_plans)."""
+    global _trace_callback
+    _trace_callback = callback
+
+
+def get_pool() -> ConnectionPool:
+    """Pool del proceso para la configuración actual (se recrea si cambia, p.ej. otro path)."""
+    global _pool
+    settings = get_db_settings()
+    with _pool_lock:
+        if _pool is None or _pool.settings != settings:
+            if _pool is not None:
+                _pool.close()
+            if not settings.read_only:
+                os.makedirs(os.path.dirname(settings.path), exist_ok=True)
+            _pool = ConnectionPool(settings)
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def pool_stats() -> dict:
+    """Métricas del pool: checkouts, waits, wait_time, timeouts, open, idle, in_use..."""
+    return get_pool().stats()
+
+
+def get_connection():
+    """Devuelve una conexión del pool; conn.close() la devuelve al pool.
+    Único punto de acceso a la base para models y services (ver app.config.get_db_settings).
+    """
+    return get_pool().acquire()
+
+
+_lock_stats = {}
+_lock_stats_lock = threading.Lock()
+
+
+def _registrar_lock(operacion: str, espera: float, retenido: Optional[float], resultado: str):
+    with _lock_stats_lock:
+        st = _lock_stats.setdefault(operacion, {
+            "count": 0, "commits": 0, "rollbacks": 0, "busy": 0,
+            "wait_time": 0.0, "wait_max": 0.0, "hold_time": 0.0, "hold_max": 0.0,
+        })
+        st["count"] += 1
+        st[resultado] += 1
+        st["wait_time"] += espera
+        st["wait_max"] = max(st["wait_max"], espera)
+        if retenido is not None:
+            st["hold_time"] += retenido
+            st["hold_max"] = max(st["hold_max"], retenido)
+
+
+@contextmanager
+def write_transaction(conn: sqlite3.Connection, operacion: str):
+    """BEGIN IMMEDIATE ... COMMIT midiendo, por operación, la espera del lock de escritura
+    y el tiempo que se retiene (ver lock_stats()).
+
+    Excepción dentro del bloque -> ROLLBACK y se relanza. Si el bloque hace su propio
+    ROLLBACK (validación fallida) no se confirma nada y se cuenta como rollback.
+    Todo lo que sea solo lectura (catálogos, caches, filas a validar) va antes del `with`:
+    adentro solo las sentencias indexadas que necesitan el lock.
+    """
+    t0 = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        _registrar_lock(operacion, time.perf_counter() - t0, None, "busy")
+        raise
+    t1 = time.perf_counter()
+    resultado = "rollbacks"
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.execute("COMMIT")
+            resultado = "commits"
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _registrar_lock(operacion, t1 - t0, time.perf_counter() - t1, resultado)
+
+
+def lock_stats() -> dict:
+    """Métricas de write_transaction por operación (del proceso actual):
+    {operacion: {count, commits, rollbacks, busy, wait_time, wait_max, hold_time, hold_max, hold_avg}}
+    (tiempos en segundos)."""
+    with _lock_stats_lock:
+        datos = {op: dict(st) for op, st in _lock_stats.items()}
+    for st in datos.values():
+        medidas = st["count"] - st["busy"]
+        st["hold_avg"] = st["hold_time"] / medidas if medidas else 0.0
+    return datos
+
+
+def reset_lock_stats():
+    with _lock_stats_lock:
+        _lock_stats.clear()
+
+
+def to_iso_date(value):
+    """Normaliza una fecha al formato canónico guardado en la base: 'YYYY-MM-DD'.
+    Acepta date/datetime/pd.Timestamp o texto ISO (con o sin hora). None -> None.
+    Guardar siempre este formato permite filtrar con rangos simples (fecha >= ?) que usan índices.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    text = str(value).strip()
+    try:
+        return datetime.date.fromisoformat(text[:10]).isoformat()
+    except ValueError:
+        raise ValueError(f"Fecha inválida: {value!r}")
+
+
+def next_iso_date(value):
+    """Día siguiente en formato ISO; cota superior exclusiva para columnas DATETIME."""
+    iso = to_iso_date(value)
+    if iso is None:
+        return None
+    return (datetime.date.fromisoformat(iso) + datetime.timedelta(days=1)).isoformat()
+
+
+def checkpoint(mode: str = "PASSIVE") -> dict:
+    """Ejecuta PRAGMA wal_checkpoint(mode). TRUNCATE deja el WAL vacío (útil antes de copiar el .db).
+    Retorna {busy, log_frames, checkpointed_frames}.
+    """
+    mode = mode.upper()
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Modo de checkpoint inválido: {mode}")
+    conn = get_connection()
+    try:
+        row = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+    busy, log_frames, done = row if row else (0, 0, 0)
+    return {"busy": int(busy), "log_frames": int(log_frames), "checkpointed_frames": int(done)}
+
+
+def wal_status() -> dict:
+    """Estado del journal: modo actual, tamaño del archivo -wal y umbral de checkpoint."""
+    conn = get_connection()
+    try:
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        autocheckpoint = conn.execute("PRAGMA wal_autocheckpoint").fetchone()[0]
+        db_path = get_pool().db_path
+    finally:
+        conn.close()
+    return {
+        "journal_mode": journal_mode,
+        "wal_bytes": _wal_bytes(db_path),
+        "wal_max_bytes": DB_WAL_MAX_BYTES,
+        "wal_autocheckpoint_pages": int(autocheckpoint),
+    }
+
+
+def init_database():
+    """Crea o actualiza el esquema (ver app.migrations).
+    Con el esquema al día solo lee PRAGMA user_version, así que es seguro llamarla en cada rerun.
+    """
+    from .migrations import migrate
+    return migrate()
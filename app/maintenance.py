@@ -0,0 +1,130 @@
+"""Comandos de mantenimiento de la base.
+
+Uso:
+    python -m app.maintenance cd-stock              # verifica cd_stock y cd_stock_diario contra los SUM reales
+    python -m app.maintenance cd-stock --reparar    # además lo reescribe si difiere
+    python -m app.maintenance cd-stock --reconstruir
+    python -m app.maintenance cd-pendientes [--reparar]  # resumen de pendientes por destino
+    python -m app.maintenance viajes-totales [--reparar] # totales guardados en viajes
+    python -m app.maintenance pendientes-local [--reparar] # saldo pendiente por local
+
+Exit 1 si el ledger / resumen no coincide (y no se pidió reparar).
+"""
+from __future__ import annotations
+import argparse
+import json
+import sys
+
+from app.db import get_connection, init_database
+
+
+def _cds():
+    from app.services.locales_service import listar_cds
+    return listar_cds()
+
+
+def cmd_cd_stock(args) -> int:
+    from app.models import cd_stock
+    cds = _cds()
+    if args.reconstruir:
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                datos = cd_stock.reconstruir(conn, cds)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        print(json.dumps(datos, ensure_ascii=False, indent=2))
+        return 0
+    res = cd_stock.verificar(cds, reparar=args.reparar)
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+    elif res["ok"]:
+        stocks = ", ".join(f"{cd}: {v['real']['stock']}" for cd, v in res["por_cd"].items()) or "sin CDs"
+        print(f"cd_stock OK ({stocks})")
+    else:
+        for cd, dif in res["diferencias"].items():
+            print(f"cd_stock difiere para {cd}{' - reparado' if args.reparar else ''}:")
+            for campo, (ledger, real) in dif.items():
+                print(f"  {campo}: ledger={ledger} real={real}")
+        for cd, ids in res["devoluciones"].items():
+            print(f"cd_devoluciones no suma las devueltas de {len(ids)} despacho(s) de {cd}{' - reparado' if args.reparar else ''}")
+        for cd, fecha in res["diario"].items():
+            print(f"cd_stock_diario difiere para {cd} desde {fecha}{' - reparado' if args.reparar else ''}")
+    return 0 if res["ok"] or args.reparar else 1
+
+
+def cmd_cd_pendientes(args) -> int:
+    from app.models.cd import verificar_pendientes_destino
+    res = verificar_pendientes_destino(reparar=args.reparar)
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+    elif res["ok"]:
+        print(f"cd_pendientes_destino OK ({res['destinos']} destinos)")
+    else:
+        for destino, (guardado, real) in res["diferencias"].items():
+            print(f"cd_pendientes_destino difiere para el destino #{destino}{' - reparado' if args.reparar else ''}:"
+                  f" guardado={guardado} real={real}")
+    return 0 if res["ok"] or args.reparar else 1
+
+
+def cmd_viajes_totales(args) -> int:
+    from app.models.viajes import verificar_totales_viajes
+    res = verificar_totales_viajes(reparar=args.reparar)
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+    elif res["ok"]:
+        print(f"totales de viajes OK ({res['viajes']} viajes)")
+    else:
+        for viaje_id, (guardado, real) in res["diferencias"].items():
+            print(f"totales del viaje {viaje_id} difieren{' - reparado' if args.reparar else ''}:"
+                  f" guardado={guardado} real={real}")
+    return 0 if res["ok"] or args.reparar else 1
+
+
+def cmd_pendientes_local(args) -> int:
+    from app.models.viajes import verificar_pendientes_local
+    res = verificar_pendientes_local(reparar=args.reparar)
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+    elif res["ok"]:
+        print(f"pendientes_local OK ({res['locales']} locales)")
+    else:
+        for clave, (guardado, real) in res["diferencias"].items():
+            local = f"#{clave}" if isinstance(clave, int) else repr(clave)
+            print(f"pendientes_local difiere para el local {local}{' - reparado' if args.reparar else ''}:"
+                  f" guardado={guardado} real={real}")
+    return 0 if res["ok"] or args.reparar else 1
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance", description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p = sub.add_parser("cd-stock", help="Verificar / reparar el ledger cd_stock")
+    p.add_argument("--reparar", action="store_true", help="Reescribir el ledger si difiere")
+    p.add_argument("--reconstruir", action="store_true", help="Recalcular el ledger sin verificar")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_cd_stock)
+    p = sub.add_parser("cd-pendientes", help="Verificar / reparar el resumen cd_pendientes_destino")
+    p.add_argument("--reparar", action="store_true", help="Reescribir el resumen si difiere")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_cd_pendientes)
+    p = sub.add_parser("viajes-totales", help="Verificar / reparar los totales guardados en viajes")
+    p.add_argument("--reparar", action="store_true", help="Reescribir los totales que difieren")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_viajes_totales)
+    p = sub.add_parser("pendientes-local", help="Verificar / reparar el saldo pendientes_local")
+    p.add_argument("--reparar", action="store_true", help="Reescribir el saldo si difiere")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_pendientes_local)
+    args = parser.parse_args(argv)
+    init_database()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
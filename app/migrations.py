@@ -0,0 +1,1149 @@
+"""Migraciones de esquema versionadas con PRAGMA user_version.
+
+Cada paso de MIGRATIONS es (version, descripcion, funcion(conn)) y se aplica una sola vez,
+en orden, dentro de su propia transacción. Con el esquema al día, migrate() se reduce a
+leer PRAGMA user_version, por lo que puede llamarse en cada rerun de Streamlit.
+
+Para agregar un cambio de esquema: escribir una función _vN_... y sumarla al final de
+MIGRATIONS (nunca modificar un paso ya publicado).
+"""
+from __future__ import annotations
+import sqlite3
+from app.db import get_connection, get_pool
+from app.models.viajes import SQL_PENDIENTES_LOCAL
+
+
+def _v1_esquema_base(conn: sqlite3.Connection):
+    """Tablas e índices originales (incluye cd_despachos / cd_envios_origen)."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS choferes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL UNIQUE,
+            contacto TEXT,
+            fecha_registro DATE DEFAULT CURRENT_DATE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS viajes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chofer_id INTEGER NOT NULL,
+            fecha_viaje DATE NOT NULL,
+            estado TEXT DEFAULT 'En Curso',
+            FOREIGN KEY (chofer_id) REFERENCES choferes (id)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS viaje_locales (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            viaje_id INTEGER NOT NULL,
+            numero_local TEXT NOT NULL,
+            cajas_enviadas INTEGER NOT NULL,
+            cajas_devueltas INTEGER DEFAULT 0,
+            FOREIGN KEY (viaje_id) REFERENCES viajes (id)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reception_local (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            numero INTEGER UNIQUE,
+            nombre TEXT UNIQUE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL CHECK(role IN ('admin','cd_only','no_cd_edit')),
+            created_at DATE DEFAULT CURRENT_DATE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS devoluciones_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            viaje_id INTEGER NOT NULL,
+            viaje_local_id INTEGER NOT NULL,
+            numero_local TEXT NOT NULL,
+            cantidad INTEGER NOT NULL,
+            tipo TEXT NOT NULL DEFAULT 'individual', -- 'individual' | 'masiva'
+            usuario TEXT, -- username que registró la devolución
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (viaje_id) REFERENCES viajes (id),
+            FOREIGN KEY (viaje_local_id) REFERENCES viaje_locales (id)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_despachos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cd_local TEXT NOT NULL,           -- etiqueta: "numero - nombre" del CD
+            destino_local TEXT NOT NULL,      -- etiqueta: "numero - nombre" del destino final
+            fecha DATE DEFAULT CURRENT_DATE,
+            cajas_enviadas INTEGER NOT NULL,
+            cajas_devueltas INTEGER DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_envios_origen (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha DATE DEFAULT CURRENT_DATE,
+            cajas_enviadas INTEGER NOT NULL
+        )
+        """
+    )
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_viajes_fecha ON viajes(fecha_viaje)",
+        "CREATE INDEX IF NOT EXISTS idx_devlog_created ON devoluciones_log(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_fecha ON cd_despachos(fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_cd_envios_fecha ON cd_envios_origen(fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_viaje_locales_viaje ON viaje_locales(viaje_id)",
+        "CREATE INDEX IF NOT EXISTS idx_devlog_viaje ON devoluciones_log(viaje_id)",
+        "CREATE INDEX IF NOT EXISTS idx_devlog_viaje_local ON devoluciones_log(viaje_local_id)",
+    ):
+        conn.execute(stmt)
+
+
+def _v2_fechas_iso(conn: sqlite3.Connection):
+    """Normaliza fechas existentes a 'YYYY-MM-DD' (DATETIME a 'YYYY-MM-DD HH:MM:SS')
+    para que los filtros por rango usen los índices de fecha sin envolver la columna en date().
+    Valores que SQLite no reconoce como fecha se dejan como están.
+    """
+    for tabla, columna in (
+        ("viajes", "fecha_viaje"),
+        ("cd_despachos", "fecha"),
+        ("cd_envios_origen", "fecha"),
+    ):
+        conn.execute(
+            f"UPDATE {tabla} SET {columna} = date({columna}) "
+            f"WHERE date({columna}) IS NOT NULL AND {columna} <> date({columna})"
+        )
+    conn.execute(
+        "UPDATE devoluciones_log SET created_at = datetime(created_at) "
+        "WHERE datetime(created_at) IS NOT NULL AND created_at <> datetime(created_at)"
+    )
+
+
+def _v3_indices_pendientes(conn: sqlite3.Connection):
+    """Índices compuestos para las consultas calientes y parciales restringidos a filas abiertas
+    (cajas_devueltas < cajas_enviadas / viajes En Curso): su tamaño sigue al trabajo pendiente,
+    no al historial. Las consultas deben repetir el mismo WHERE para que SQLite los use.
+    """
+    for stmt in (
+        # Recibido por local (CD) y pendientes por local: SUM cubierto por el índice
+        "CREATE INDEX IF NOT EXISTS idx_viaje_locales_local ON viaje_locales(numero_local, cajas_enviadas, cajas_devueltas)",
+        # Despachos por destino (totales por destino con rango de fechas)
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_destino ON cd_despachos(destino_local, fecha)",
+        # FIFO de devoluciones y pendientes por destino: solo despachos abiertos
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_abiertos ON cd_despachos(destino_local, fecha) "
+        "WHERE cajas_devueltas < cajas_enviadas",
+        # Dashboard / página de devoluciones: solo viajes en curso
+        "CREATE INDEX IF NOT EXISTS idx_viajes_en_curso ON viajes(fecha_viaje) WHERE estado = 'En Curso'",
+        # Historial de devoluciones filtrado por local (ORDER BY id usa el rowid implícito)
+        "CREATE INDEX IF NOT EXISTS idx_devlog_local ON devoluciones_log(numero_local)",
+    ):
+        conn.execute(stmt)
+    conn.execute("ANALYZE")
+
+
+def _v4_cd_stock(conn: sqlite3.Connection):
+    """Ledger cd_stock (una fila) mantenido por triggers sobre viaje_locales, cd_despachos y
+    cd_envios_origen: el stock del CD se lee en O(1) en lugar de cuatro SUM por escritura.
+    recibido_viajes solo suma filas de viaje_locales cuyo numero_local es cd_local; la fila
+    nace con cd_local NULL y app.models.cd_stock la reconstruye al detectar el CD.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_stock (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            cd_local TEXT,                       -- display del CD al que corresponde recibido_viajes
+            recibido_viajes INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            devueltos INTEGER NOT NULL DEFAULT 0,
+            enviados_origen INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO cd_stock (id, cd_local, recibido_viajes, enviados, devueltos, enviados_origen)
+        VALUES (1, NULL, 0,
+                (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_despachos),
+                (SELECT COALESCE(SUM(cajas_devueltas), 0) FROM cd_despachos),
+                (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_envios_origen))
+        """
+    )
+    triggers = {
+        "trg_cd_stock_vl_ins": """
+            AFTER INSERT ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes + NEW.cajas_enviadas
+                WHERE id = 1 AND cd_local = NEW.numero_local;
+            END""",
+        "trg_cd_stock_vl_del": """
+            AFTER DELETE ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes - OLD.cajas_enviadas
+                WHERE id = 1 AND cd_local = OLD.numero_local;
+            END""",
+        "trg_cd_stock_vl_upd": """
+            AFTER UPDATE OF numero_local, cajas_enviadas ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes
+                    - CASE WHEN cd_local = OLD.numero_local THEN OLD.cajas_enviadas ELSE 0 END
+                    + CASE WHEN cd_local = NEW.numero_local THEN NEW.cajas_enviadas ELSE 0 END
+                WHERE id = 1 AND cd_local IN (OLD.numero_local, NEW.numero_local);
+            END""",
+        "trg_cd_stock_desp_ins": """
+            AFTER INSERT ON cd_despachos BEGIN
+                UPDATE cd_stock SET enviados = enviados + NEW.cajas_enviadas,
+                                    devueltos = devueltos + COALESCE(NEW.cajas_devueltas, 0)
+                WHERE id = 1;
+            END""",
+        "trg_cd_stock_desp_del": """
+            AFTER DELETE ON cd_despachos BEGIN
+                UPDATE cd_stock SET enviados = enviados - OLD.cajas_enviadas,
+                                    devueltos = devueltos - COALESCE(OLD.cajas_devueltas, 0)
+                WHERE id = 1;
+            END""",
+        "trg_cd_stock_desp_upd": """
+            AFTER UPDATE OF cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                UPDATE cd_stock SET enviados = enviados - OLD.cajas_enviadas + NEW.cajas_enviadas,
+                                    devueltos = devueltos - COALESCE(OLD.cajas_devueltas, 0) + COALESCE(NEW.cajas_devueltas, 0)
+                WHERE id = 1;
+            END""",
+        "trg_cd_stock_ori_ins": """
+            AFTER INSERT ON cd_envios_origen BEGIN
+                UPDATE cd_stock SET enviados_origen = enviados_origen + NEW.cajas_enviadas WHERE id = 1;
+            END""",
+        "trg_cd_stock_ori_del": """
+            AFTER DELETE ON cd_envios_origen BEGIN
+                UPDATE cd_stock SET enviados_origen = enviados_origen - OLD.cajas_enviadas WHERE id = 1;
+            END""",
+        "trg_cd_stock_ori_upd": """
+            AFTER UPDATE OF cajas_enviadas ON cd_envios_origen BEGIN
+                UPDATE cd_stock SET enviados_origen = enviados_origen - OLD.cajas_enviadas + NEW.cajas_enviadas WHERE id = 1;
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+def _v5_locales_es_cd(conn: sqlite3.Connection):
+    """Marca explícita del CD en reception_local (antes: primer local con 'cd' en el nombre).
+    Se inicializa con esa misma heurística para no cambiar el CD detectado hoy.
+    """
+    columnas = {r[1] for r in conn.execute("PRAGMA table_info(reception_local)").fetchall()}
+    if "es_cd" not in columnas:
+        conn.execute("ALTER TABLE reception_local ADD COLUMN es_cd INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        """
+        UPDATE reception_local SET es_cd = 1
+        WHERE id = (SELECT id FROM reception_local WHERE instr(lower(nombre), 'cd') > 0 ORDER BY numero LIMIT 1)
+          AND NOT EXISTS (SELECT 1 FROM reception_local WHERE es_cd = 1)
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reception_local_cd ON reception_local(numero) WHERE es_cd = 1")
+
+
+# Display "numero - nombre" de reception_local tal como lo arma locales_service
+_SQL_DISPLAY_LOCAL = "CASE WHEN nombre IS NOT NULL AND nombre <> '' THEN numero || ' - ' || nombre ELSE CAST(numero AS TEXT) END"
+
+
+def _cd_stock_asegurar_fila(cd: str, tabla: str = "", id_expr: str = "") -> str:
+    """INSERT que crea la fila del ledger para `cd` si no existe, calculada desde las tablas base.
+    En triggers se excluye la fila que disparó (tabla / id_expr) porque el UPDATE siguiente la suma.
+    """
+    def excl(t):
+        return f" AND id <> {id_expr}" if t == tabla else ""
+    return f"""
+        INSERT INTO cd_stock (cd_local, recibido_viajes, enviados, devueltos, enviados_origen)
+        SELECT {cd},
+               (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM viaje_locales WHERE numero_local = {cd}),
+               (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_despachos WHERE cd_local = {cd}{excl('cd_despachos')}),
+               (SELECT COALESCE(SUM(cajas_devueltas), 0) FROM cd_despachos WHERE cd_local = {cd}{excl('cd_despachos')}),
+               (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_envios_origen WHERE cd_local = {cd}{excl('cd_envios_origen')})
+        WHERE {cd} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM cd_stock WHERE cd_local = {cd})"""
+
+
+def _v6_stock_por_cd(conn: sqlite3.Connection):
+    """Stock particionado por CD: cd_envios_origen.cd_local (inicializado con el CD principal),
+    ledger cd_stock con una fila por CD (clave cd_local) e índices por CD.
+    Cada fila existente del ledger es exacta; las que faltan se crean desde las tablas base
+    (en el trigger que las necesita o en app.models.cd_stock.leer).
+    """
+    columnas = {r[1] for r in conn.execute("PRAGMA table_info(cd_envios_origen)").fetchall()}
+    if "cd_local" not in columnas:
+        conn.execute("ALTER TABLE cd_envios_origen ADD COLUMN cd_local TEXT")
+    conn.execute(
+        f"""
+        UPDATE cd_envios_origen SET cd_local = (
+            SELECT {_SQL_DISPLAY_LOCAL} FROM reception_local WHERE es_cd = 1 ORDER BY numero LIMIT 1
+        ) WHERE cd_local IS NULL
+        """
+    )
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_cd ON cd_despachos(cd_local, fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_cd_envios_cd ON cd_envios_origen(cd_local, fecha)",
+    ):
+        conn.execute(stmt)
+
+    for (nombre,) in conn.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'trg_cd_stock_%'").fetchall():
+        conn.execute(f"DROP TRIGGER {nombre}")
+    conn.execute("DROP TABLE IF EXISTS cd_stock")
+    conn.execute(
+        """
+        CREATE TABLE cd_stock (
+            cd_local TEXT PRIMARY KEY NOT NULL,  -- display del CD ("numero - nombre")
+            recibido_viajes INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            devueltos INTEGER NOT NULL DEFAULT 0,
+            enviados_origen INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    claves = conn.execute(
+        f"""
+        SELECT cd_local FROM cd_despachos WHERE cd_local IS NOT NULL
+        UNION SELECT cd_local FROM cd_envios_origen WHERE cd_local IS NOT NULL
+        UNION SELECT {_SQL_DISPLAY_LOCAL} FROM reception_local WHERE es_cd = 1
+        """
+    ).fetchall()
+    for (cd,) in claves:
+        conn.execute(_cd_stock_asegurar_fila(":cd"), {"cd": cd})
+
+    triggers = {
+        "trg_cd_stock_vl_ins": """
+            AFTER INSERT ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes + NEW.cajas_enviadas WHERE cd_local = NEW.numero_local;
+            END""",
+        "trg_cd_stock_vl_del": """
+            AFTER DELETE ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes - OLD.cajas_enviadas WHERE cd_local = OLD.numero_local;
+            END""",
+        "trg_cd_stock_vl_upd": """
+            AFTER UPDATE OF numero_local, cajas_enviadas ON viaje_locales BEGIN
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes - OLD.cajas_enviadas WHERE cd_local = OLD.numero_local;
+                UPDATE cd_stock SET recibido_viajes = recibido_viajes + NEW.cajas_enviadas WHERE cd_local = NEW.numero_local;
+            END""",
+        "trg_cd_stock_desp_ins": f"""
+            AFTER INSERT ON cd_despachos BEGIN
+                {_cd_stock_asegurar_fila("NEW.cd_local", "cd_despachos", "NEW.id")};
+                UPDATE cd_stock SET enviados = enviados + NEW.cajas_enviadas,
+                                    devueltos = devueltos + COALESCE(NEW.cajas_devueltas, 0)
+                WHERE cd_local = NEW.cd_local;
+            END""",
+        "trg_cd_stock_desp_del": """
+            AFTER DELETE ON cd_despachos BEGIN
+                UPDATE cd_stock SET enviados = enviados - OLD.cajas_enviadas,
+                                    devueltos = devueltos - COALESCE(OLD.cajas_devueltas, 0)
+                WHERE cd_local = OLD.cd_local;
+            END""",
+        "trg_cd_stock_desp_upd": f"""
+            AFTER UPDATE OF cd_local, cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                UPDATE cd_stock SET enviados = enviados - OLD.cajas_enviadas,
+                                    devueltos = devueltos - COALESCE(OLD.cajas_devueltas, 0)
+                WHERE cd_local = OLD.cd_local;
+                {_cd_stock_asegurar_fila("NEW.cd_local", "cd_despachos", "NEW.id")};
+                UPDATE cd_stock SET enviados = enviados + NEW.cajas_enviadas,
+                                    devueltos = devueltos + COALESCE(NEW.cajas_devueltas, 0)
+                WHERE cd_local = NEW.cd_local;
+            END""",
+        "trg_cd_stock_ori_ins": f"""
+            AFTER INSERT ON cd_envios_origen BEGIN
+                {_cd_stock_asegurar_fila("NEW.cd_local", "cd_envios_origen", "NEW.id")};
+                UPDATE cd_stock SET enviados_origen = enviados_origen + NEW.cajas_enviadas WHERE cd_local = NEW.cd_local;
+            END""",
+        "trg_cd_stock_ori_del": """
+            AFTER DELETE ON cd_envios_origen BEGIN
+                UPDATE cd_stock SET enviados_origen = enviados_origen - OLD.cajas_enviadas WHERE cd_local = OLD.cd_local;
+            END""",
+        "trg_cd_stock_ori_upd": f"""
+            AFTER UPDATE OF cd_local, cajas_enviadas ON cd_envios_origen BEGIN
+                UPDATE cd_stock SET enviados_origen = enviados_origen - OLD.cajas_enviadas WHERE cd_local = OLD.cd_local;
+                {_cd_stock_asegurar_fila("NEW.cd_local", "cd_envios_origen", "NEW.id")};
+                UPDATE cd_stock SET enviados_origen = enviados_origen + NEW.cajas_enviadas WHERE cd_local = NEW.cd_local;
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER {nombre} {cuerpo}")
+
+
+def _v7_busqueda_despachos(conn: sqlite3.Connection):
+    """Búsqueda por destino y paginación de despachos en el servidor.
+    - cd_despachos_fts: índice FTS5 trigram (contenido externo) sobre destino_local, mantenido
+      por triggers; si SQLite no trae FTS5 se omite y la búsqueda usa LIKE.
+    - Parcial por fecha de los despachos abiertos: la página de pendientes recorre solo esos.
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_abiertos_fecha ON cd_despachos(fecha) "
+        "WHERE cajas_devueltas < cajas_enviadas"
+    )
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS cd_despachos_fts USING fts5("
+            "destino_local, content='cd_despachos', content_rowid='id', tokenize='trigram')"
+        )
+    except sqlite3.OperationalError:
+        return  # sin FTS5 / trigram (SQLite < 3.34)
+    conn.execute("INSERT INTO cd_despachos_fts(cd_despachos_fts) VALUES ('rebuild')")
+    triggers = {
+        "trg_cd_despachos_fts_ins": """
+            AFTER INSERT ON cd_despachos BEGIN
+                INSERT INTO cd_despachos_fts(rowid, destino_local) VALUES (NEW.id, NEW.destino_local);
+            END""",
+        "trg_cd_despachos_fts_del": """
+            AFTER DELETE ON cd_despachos BEGIN
+                INSERT INTO cd_despachos_fts(cd_despachos_fts, rowid, destino_local) VALUES ('delete', OLD.id, OLD.destino_local);
+            END""",
+        "trg_cd_despachos_fts_upd": """
+            AFTER UPDATE OF destino_local ON cd_despachos BEGIN
+                INSERT INTO cd_despachos_fts(cd_despachos_fts, rowid, destino_local) VALUES ('delete', OLD.id, OLD.destino_local);
+                INSERT INTO cd_despachos_fts(rowid, destino_local) VALUES (NEW.id, NEW.destino_local);
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+_DIARIO_CAMPOS = ("recibido_viajes", "enviados", "devueltos", "enviados_origen")
+
+
+def _cd_diario_backfill(cd: str, tabla: str = "", id_expr: str = "", condicion: str = "",
+                        fechas_devolucion: bool = False) -> str:
+    """INSERT que arma los snapshots de `cd` desde las tablas base si aún no tiene ninguno.
+    Igual que _cd_stock_asegurar_fila: en triggers se excluye la fila que disparó.
+    fechas_devolucion: devueltas desde cd_devoluciones (migración 14) y no a la fecha del despacho.
+    """
+    # Cada rama arranca de una fila guarda con CROSS JOIN (orden fijo): si el CD ya tiene snapshots
+    # la guarda sale vacía y no se recorren las tablas base; un NOT EXISTS en la WHERE se
+    # evaluaría fila por fila y el costo de cada disparo crecería con el historial.
+    guarda = (f"(SELECT 1 WHERE {cd} IS NOT NULL{condicion}"
+              f" AND NOT EXISTS (SELECT 1 FROM cd_stock_diario WHERE cd_local = {cd})) g CROSS JOIN")
+
+    def excl(t, alias=""):
+        return f" AND {alias}id <> {id_expr}" if t == tabla else ""
+    devoluciones = f"""
+            SELECT fecha, 0, 0, cajas, 0
+            FROM {guarda} cd_devoluciones e WHERE e.cd_local = {cd}{excl('cd_devoluciones', 'e.')}
+            UNION ALL""" if fechas_devolucion else ""
+    return f"""
+        INSERT INTO cd_stock_diario (cd_local, fecha, {", ".join(_DIARIO_CAMPOS)})
+        SELECT {cd}, fecha, SUM(SUM(rec)) OVER w, SUM(SUM(env)) OVER w, SUM(SUM(dev)) OVER w, SUM(SUM(ori)) OVER w
+        FROM (
+            SELECT v.fecha_viaje AS fecha, vl.cajas_enviadas AS rec, 0 AS env, 0 AS dev, 0 AS ori
+            FROM {guarda} viaje_locales vl JOIN viajes v ON v.id = vl.viaje_id
+            WHERE vl.numero_local = {cd}{excl('viaje_locales', 'vl.')}
+            UNION ALL
+            SELECT fecha, 0, cajas_enviadas, {"0" if fechas_devolucion else "COALESCE(cajas_devueltas, 0)"}, 0
+            FROM {guarda} cd_despachos d WHERE d.cd_local = {cd}{excl('cd_despachos', 'd.')}
+            UNION ALL{devoluciones}
+            SELECT fecha, 0, 0, 0, cajas_enviadas
+            FROM {guarda} cd_envios_origen o WHERE o.cd_local = {cd}{excl('cd_envios_origen', 'o.')}
+        )
+        WHERE fecha IS NOT NULL
+        GROUP BY fecha
+        WINDOW w AS (ORDER BY fecha)"""
+
+
+def _cd_diario_mover(cd: str, fecha: str, signo: str, valores: dict, condicion: str = "") -> str:
+    """Suma (signo '+') o resta ('-') un movimiento del día `fecha` a los snapshots de `cd`:
+    crea la fila del día copiando el acumulado anterior y ajusta esa fila y las posteriores.
+    Solo actúa si el CD ya tiene snapshots (los vacíos se arman con _cd_diario_backfill).
+    """
+    previo = ", ".join(
+        f"COALESCE((SELECT {c} FROM cd_stock_diario p WHERE p.cd_local = {cd} AND p.fecha < {fecha}"
+        f" ORDER BY p.fecha DESC LIMIT 1), 0)"
+        for c in _DIARIO_CAMPOS
+    )
+    ajustes = ", ".join(f"{c} = {c} {signo} {valores[c]}" for c in _DIARIO_CAMPOS if c in valores)
+    return f"""
+        INSERT OR IGNORE INTO cd_stock_diario (cd_local, fecha, {", ".join(_DIARIO_CAMPOS)})
+        SELECT {cd}, {fecha}, {previo}
+        WHERE {cd} IS NOT NULL AND {fecha} IS NOT NULL{condicion}
+          AND EXISTS (SELECT 1 FROM cd_stock_diario WHERE cd_local = {cd});
+        UPDATE cd_stock_diario SET {ajustes} WHERE cd_local = {cd} AND fecha >= {fecha}{condicion}"""
+
+
+# Día en que se registra una devolución del CD (no antes que su despacho)
+_HOY_DEVOLUCION = "CASE WHEN NEW.fecha > date('now', 'localtime') THEN NEW.fecha ELSE date('now', 'localtime') END"
+
+
+def _cd_devoluciones_triggers(backfill) -> dict:
+    """Triggers de cd_despachos y cd_devoluciones para imputar las devueltas a su fecha (migración 14).
+    cd_despachos: enviadas a la fecha del despacho y un movimiento en cd_devoluciones por cada cambio
+    de cajas_devueltas. cd_devoluciones: suma / resta sus cajas en cd_stock_diario a su fecha.
+    """
+    env = lambda fila: {"enviados": f"{fila}.cajas_enviadas"}
+    dev = lambda fila: {"devueltos": f"{fila}.cajas"}
+    # Registrar una devolución solo toca cajas_devueltas: no mover las enviadas
+    cambia_envio = " AND (OLD.cd_local IS NOT NEW.cd_local OR OLD.fecha IS NOT NEW.fecha OR OLD.cajas_enviadas IS NOT NEW.cajas_enviadas)"
+    delta = "COALESCE(NEW.cajas_devueltas, 0) - COALESCE(OLD.cajas_devueltas, 0)"
+    return {
+        "trg_cd_diario_desp_ins": f"""
+            AFTER INSERT ON cd_despachos BEGIN
+                {backfill("NEW.cd_local", "cd_despachos", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", env("NEW"))};
+                INSERT INTO cd_devoluciones (despacho_id, cd_local, fecha, cajas)
+                SELECT NEW.id, NEW.cd_local, NEW.fecha, NEW.cajas_devueltas WHERE COALESCE(NEW.cajas_devueltas, 0) <> 0;
+            END""",
+        "trg_cd_diario_desp_del": f"""
+            AFTER DELETE ON cd_despachos BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", env("OLD"))};
+                DELETE FROM cd_devoluciones WHERE despacho_id = OLD.id;
+            END""",
+        # Orden fijo: primero las enviadas (puede armar los snapshots del CD nuevo), después las
+        # devoluciones del despacho siguen su CD y no quedan antes de su fecha, y al final el delta de hoy
+        "trg_cd_diario_desp_upd": f"""
+            AFTER UPDATE OF cd_local, fecha, cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", env("OLD"), cambia_envio)};
+                {backfill("NEW.cd_local", "cd_despachos", "NEW.id", cambia_envio)};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", env("NEW"), cambia_envio)};
+                UPDATE cd_devoluciones SET cd_local = NEW.cd_local,
+                                           fecha = CASE WHEN fecha < NEW.fecha THEN NEW.fecha ELSE fecha END
+                WHERE despacho_id = NEW.id AND (cd_local IS NOT NEW.cd_local OR fecha < NEW.fecha);
+                INSERT INTO cd_devoluciones (despacho_id, cd_local, fecha, cajas)
+                SELECT NEW.id, NEW.cd_local, {_HOY_DEVOLUCION}, {delta} WHERE {delta} <> 0;
+            END""",
+        "trg_cd_diario_dev_ins": f"""
+            AFTER INSERT ON cd_devoluciones BEGIN
+                {backfill("NEW.cd_local", "cd_devoluciones", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", dev("NEW"))};
+            END""",
+        "trg_cd_diario_dev_del": f"""
+            AFTER DELETE ON cd_devoluciones BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", dev("OLD"))};
+            END""",
+        "trg_cd_diario_dev_upd": f"""
+            AFTER UPDATE OF cd_local, fecha, cajas ON cd_devoluciones BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", dev("OLD"))};
+                {backfill("NEW.cd_local", "cd_devoluciones", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", dev("NEW"))};
+            END""",
+    }
+
+
+def _cd_diario_triggers(fechas_devolucion: bool = False) -> dict:
+    """Triggers que mantienen cd_stock_diario (nombre -> cuerpo). Con fechas_devolucion (migración 14)
+    los de cd_despachos imputan solo las enviadas y llevan las devueltas a cd_devoluciones, cuyos
+    triggers las suman al día en que se registraron.
+    """
+    backfill = lambda *args: _cd_diario_backfill(*args, fechas_devolucion=fechas_devolucion)
+    es_cd = lambda local: f" AND EXISTS (SELECT 1 FROM cd_stock WHERE cd_local = {local})"
+    fecha_viaje = lambda viaje: f"(SELECT fecha_viaje FROM viajes WHERE id = {viaje})"
+    vl = lambda fila: {"recibido_viajes": f"{fila}.cajas_enviadas"}
+    desp = lambda fila: {"enviados": f"{fila}.cajas_enviadas", "devueltos": f"COALESCE({fila}.cajas_devueltas, 0)"}
+    ori = lambda fila: {"enviados_origen": f"{fila}.cajas_enviadas"}
+    # Lo aportado por un viaje a un CD (para mover todo el viaje de fecha)
+    aporte_viaje = "(SELECT COALESCE(SUM(cajas_enviadas), 0) FROM viaje_locales WHERE viaje_id = NEW.id AND numero_local = cd_stock_diario.cd_local)"
+    triggers = {
+        "trg_cd_diario_vl_ins": f"""
+            AFTER INSERT ON viaje_locales WHEN EXISTS (SELECT 1 FROM cd_stock WHERE cd_local = NEW.numero_local) BEGIN
+                {backfill("NEW.numero_local", "viaje_locales", "NEW.id")};
+                {_cd_diario_mover("NEW.numero_local", fecha_viaje("NEW.viaje_id"), "+", vl("NEW"))};
+            END""",
+        "trg_cd_diario_vl_del": f"""
+            AFTER DELETE ON viaje_locales BEGIN
+                {_cd_diario_mover("OLD.numero_local", fecha_viaje("OLD.viaje_id"), "-", vl("OLD"), es_cd("OLD.numero_local"))};
+            END""",
+        "trg_cd_diario_vl_upd": f"""
+            AFTER UPDATE OF viaje_id, numero_local, cajas_enviadas ON viaje_locales BEGIN
+                {_cd_diario_mover("OLD.numero_local", fecha_viaje("OLD.viaje_id"), "-", vl("OLD"), es_cd("OLD.numero_local"))};
+                {backfill("NEW.numero_local", "viaje_locales", "NEW.id", es_cd("NEW.numero_local"))};
+                {_cd_diario_mover("NEW.numero_local", fecha_viaje("NEW.viaje_id"), "+", vl("NEW"), es_cd("NEW.numero_local"))};
+            END""",
+        "trg_cd_diario_viaje_fecha": f"""
+            AFTER UPDATE OF fecha_viaje ON viajes BEGIN
+                INSERT OR IGNORE INTO cd_stock_diario (cd_local, fecha, {", ".join(_DIARIO_CAMPOS)})
+                SELECT s.cd_local, NEW.fecha_viaje, {", ".join(
+                    f"COALESCE((SELECT {c} FROM cd_stock_diario p WHERE p.cd_local = s.cd_local AND p.fecha < NEW.fecha_viaje ORDER BY p.fecha DESC LIMIT 1), 0)"
+                    for c in _DIARIO_CAMPOS)}
+                FROM (SELECT DISTINCT cd_local FROM cd_stock_diario
+                      WHERE cd_local IN (SELECT numero_local FROM viaje_locales WHERE viaje_id = NEW.id)) s
+                WHERE NEW.fecha_viaje IS NOT NULL;
+                UPDATE cd_stock_diario SET recibido_viajes = recibido_viajes
+                    - CASE WHEN fecha >= OLD.fecha_viaje THEN {aporte_viaje} ELSE 0 END
+                    + CASE WHEN fecha >= NEW.fecha_viaje THEN {aporte_viaje} ELSE 0 END
+                WHERE cd_local IN (SELECT numero_local FROM viaje_locales WHERE viaje_id = NEW.id)
+                  AND fecha >= MIN(COALESCE(OLD.fecha_viaje, NEW.fecha_viaje), COALESCE(NEW.fecha_viaje, OLD.fecha_viaje));
+            END""",
+        "trg_cd_diario_desp_ins": f"""
+            AFTER INSERT ON cd_despachos BEGIN
+                {backfill("NEW.cd_local", "cd_despachos", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", desp("NEW"))};
+            END""",
+        "trg_cd_diario_desp_del": f"""
+            AFTER DELETE ON cd_despachos BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", desp("OLD"))};
+            END""",
+        "trg_cd_diario_desp_upd": f"""
+            AFTER UPDATE OF cd_local, fecha, cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", desp("OLD"))};
+                {backfill("NEW.cd_local", "cd_despachos", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", desp("NEW"))};
+            END""",
+        "trg_cd_diario_ori_ins": f"""
+            AFTER INSERT ON cd_envios_origen BEGIN
+                {backfill("NEW.cd_local", "cd_envios_origen", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", ori("NEW"))};
+            END""",
+        "trg_cd_diario_ori_del": f"""
+            AFTER DELETE ON cd_envios_origen BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", ori("OLD"))};
+            END""",
+        "trg_cd_diario_ori_upd": f"""
+            AFTER UPDATE OF cd_local, fecha, cajas_enviadas ON cd_envios_origen BEGIN
+                {_cd_diario_mover("OLD.cd_local", "OLD.fecha", "-", ori("OLD"))};
+                {backfill("NEW.cd_local", "cd_envios_origen", "NEW.id")};
+                {_cd_diario_mover("NEW.cd_local", "NEW.fecha", "+", ori("NEW"))};
+            END""",
+    }
+    if fechas_devolucion:
+        triggers.update(_cd_devoluciones_triggers(backfill))
+    return triggers
+
+
+def _v8_cd_stock_diario(conn: sqlite3.Connection):
+    """Snapshots diarios del stock por CD: cd_stock_diario guarda, por (cd_local, fecha), los
+    acumulados de recibido_viajes / enviados / devueltos / enviados_origen al cierre del día,
+    así el stock en una fecha es una sola búsqueda por PK. Fechas de imputación: la del viaje,
+    la del despacho (también sus devueltas: el CD no registra cuándo volvieron) y la del envío.
+    Los triggers ajustan el día del movimiento y los posteriores (lo habitual: solo hoy).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_stock_diario (
+            cd_local TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            recibido_viajes INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            devueltos INTEGER NOT NULL DEFAULT 0,
+            enviados_origen INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cd_local, fecha)
+        ) WITHOUT ROWID
+        """
+    )
+    for (cd,) in conn.execute("SELECT cd_local FROM cd_stock").fetchall():
+        conn.execute(_cd_diario_backfill(":cd"), {"cd": cd})
+
+    for nombre, cuerpo in _cd_diario_triggers().items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+# Un despacho está abierto con el mismo predicado que el índice parcial idx_cd_despachos_abiertos
+_DESPACHO_ABIERTO = "cajas_devueltas < cajas_enviadas"
+
+
+def _cd_destino_sumar(fila: str, signo: str, clave: str = "destino_local") -> str:
+    """Upsert que suma (signo '+') o resta ('-') el despacho `fila` (NEW / OLD) al resumen de su
+    destino y recalcula la fecha del abierto más antiguo (MIN sobre el índice parcial).
+    `clave`: columna del destino en cd_despachos y en el resumen (destino_id desde la migración 12).
+    """
+    return f"""
+        INSERT INTO cd_pendientes_destino ({clave}, enviadas, devueltas, abiertos)
+        SELECT {fila}.{clave}, {signo}{fila}.cajas_enviadas, {signo}COALESCE({fila}.cajas_devueltas, 0),
+               {signo}IFNULL({fila}.cajas_devueltas < {fila}.cajas_enviadas, 0)
+        WHERE {fila}.{clave} IS NOT NULL
+        ON CONFLICT ({clave}) DO UPDATE SET
+            enviadas = enviadas + excluded.enviadas,
+            devueltas = devueltas + excluded.devueltas,
+            abiertos = abiertos + excluded.abiertos;
+        UPDATE cd_pendientes_destino SET primer_abierto = (
+            SELECT MIN(fecha) FROM cd_despachos WHERE {clave} = {fila}.{clave} AND {_DESPACHO_ABIERTO}
+        ) WHERE {clave} = {fila}.{clave}"""
+
+
+def _v9_cd_pendientes_destino(conn: sqlite3.Connection):
+    """Resumen de pendientes por destino: cd_pendientes_destino guarda por destino_local los
+    totales enviadas / devueltas de todos sus despachos, cuántos siguen abiertos y la fecha del
+    abierto más antiguo. Los triggers de cd_despachos lo ajustan en cada escritura, así el resumen
+    de pendientes y "devolver todo" leen una fila por destino en vez de agregar el historial.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_pendientes_destino (
+            destino_local TEXT PRIMARY KEY NOT NULL,
+            enviadas INTEGER NOT NULL DEFAULT 0,
+            devueltas INTEGER NOT NULL DEFAULT 0,
+            abiertos INTEGER NOT NULL DEFAULT 0,   -- despachos con cajas_devueltas < cajas_enviadas
+            primer_abierto TEXT                    -- fecha del abierto más antiguo (NULL si no hay)
+        )
+        """
+    )
+    conn.execute("DELETE FROM cd_pendientes_destino")
+    conn.execute(
+        f"""
+        INSERT INTO cd_pendientes_destino (destino_local, enviadas, devueltas, abiertos, primer_abierto)
+        SELECT destino_local, SUM(cajas_enviadas), SUM(COALESCE(cajas_devueltas, 0)),
+               SUM(IFNULL({_DESPACHO_ABIERTO}, 0)), MIN(CASE WHEN {_DESPACHO_ABIERTO} THEN fecha END)
+        FROM cd_despachos WHERE destino_local IS NOT NULL GROUP BY destino_local
+        """
+    )
+    triggers = {
+        "trg_cd_destino_ins": f"""
+            AFTER INSERT ON cd_despachos BEGIN
+                {_cd_destino_sumar("NEW", "+")};
+            END""",
+        "trg_cd_destino_del": f"""
+            AFTER DELETE ON cd_despachos BEGIN
+                {_cd_destino_sumar("OLD", "-")};
+            END""",
+        "trg_cd_destino_upd": f"""
+            AFTER UPDATE OF destino_local, fecha, cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                {_cd_destino_sumar("OLD", "-")};
+                {_cd_destino_sumar("NEW", "+")};
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+def _reconstruir_con_checks(conn: sqlite3.Connection, tabla: str, checks: list):
+    """Reconstruye `tabla` agregando restricciones CHECK (SQLite no las admite en ALTER TABLE):
+    copia la definición actual (con las columnas agregadas por ALTER), mueve las filas con sus id,
+    recrea índices y triggers propios y conserva el contador AUTOINCREMENT.
+    Requiere foreign_keys OFF (migrate() lo desactiva antes de aplicar los pasos).
+    """
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (tabla,)).fetchone()[0]
+    if all(check in sql for check in checks):
+        return
+    cuerpo = sql[sql.index("(") + 1:sql.rindex(")")].rstrip()
+    nueva = f"{tabla}__nueva"
+    dependientes = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL",
+        (tabla,),
+    ).fetchall()
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (tabla,)).fetchone()
+    conn.execute(f"CREATE TABLE {nueva} ({cuerpo},\n            " + ",\n            ".join(f"CHECK ({c})" for c in checks) + "\n        )")
+    conn.execute(f"INSERT INTO {nueva} SELECT * FROM {tabla}")
+    conn.execute(f"DROP TABLE {tabla}")
+    # Modo legacy: el RENAME no reescribe (ni valida) los triggers de otras tablas que nombran a `tabla`
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        conn.execute(f"ALTER TABLE {nueva} RENAME TO {tabla}")
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+    for (stmt,) in dependientes:
+        conn.execute(stmt)
+    if seq:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq[0], tabla))
+    conn.execute(f"ANALYZE {tabla}")
+
+
+_CHECKS_CAJAS = [
+    "cajas_enviadas >= 0",
+    "cajas_devueltas >= 0",
+    "cajas_devueltas <= cajas_enviadas",
+]
+
+
+def _v10_checks_devoluciones(conn: sqlite3.Connection):
+    """CHECK 0 <= cajas_devueltas <= cajas_enviadas en viaje_locales y cd_despachos: ninguna
+    escritura (ni dos operadores a la vez) puede registrar más devueltas que enviadas.
+    Las filas que ya lo violaban se ajustan al límite antes de reconstruir (los triggers de los
+    ledgers registran el ajuste).
+    """
+    for tabla in ("viaje_locales", "cd_despachos"):
+        conn.execute(f"UPDATE {tabla} SET cajas_enviadas = 0 WHERE cajas_enviadas < 0")
+        conn.execute(f"UPDATE {tabla} SET cajas_devueltas = 0 WHERE cajas_devueltas < 0")
+        conn.execute(f"UPDATE {tabla} SET cajas_devueltas = cajas_enviadas WHERE cajas_devueltas > cajas_enviadas")
+        _reconstruir_con_checks(conn, tabla, _CHECKS_CAJAS)
+
+
+_TOTALES_VIAJE = ("total_locales", "total_enviadas", "total_devueltas", "pendientes")
+
+
+def _viaje_totales_sumar(fila: str, signo: str) -> str:
+    """UPDATE que suma (signo '+') o resta ('-') el local `fila` (NEW / OLD) a los totales de su viaje."""
+    devueltas = f"COALESCE({fila}.cajas_devueltas, 0)"
+    return f"""
+        UPDATE viajes SET total_locales = total_locales {signo} 1,
+                          total_enviadas = total_enviadas {signo} {fila}.cajas_enviadas,
+                          total_devueltas = total_devueltas {signo} {devueltas},
+                          pendientes = pendientes {signo} ({fila}.cajas_enviadas - {devueltas})
+        WHERE id = {fila}.viaje_id"""
+
+
+def _v11_totales_viaje(conn: sqlite3.Connection):
+    """Totales por viaje guardados en viajes (total_locales, total_enviadas, total_devueltas,
+    pendientes) y mantenidos por triggers de viaje_locales: los listados de viajes leen una sola
+    tabla por idx_viajes_fecha en vez de agrupar viaje_locales en cada render.
+    """
+    columnas = {r[1] for r in conn.execute("PRAGMA table_info(viajes)").fetchall()}
+    for col in _TOTALES_VIAJE:
+        if col not in columnas:
+            conn.execute(f"ALTER TABLE viajes ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        """
+        UPDATE viajes SET total_locales = t.locales, total_enviadas = t.enviadas,
+                          total_devueltas = t.devueltas, pendientes = t.enviadas - t.devueltas
+        FROM (
+            SELECT viaje_id, COUNT(*) AS locales, SUM(cajas_enviadas) AS enviadas,
+                   SUM(COALESCE(cajas_devueltas, 0)) AS devueltas
+            FROM viaje_locales GROUP BY viaje_id
+        ) AS t
+        WHERE viajes.id = t.viaje_id
+        """
+    )
+    triggers = {
+        "trg_viaje_totales_ins": f"""
+            AFTER INSERT ON viaje_locales BEGIN
+                {_viaje_totales_sumar("NEW", "+")};
+            END""",
+        "trg_viaje_totales_del": f"""
+            AFTER DELETE ON viaje_locales BEGIN
+                {_viaje_totales_sumar("OLD", "-")};
+            END""",
+        "trg_viaje_totales_upd": f"""
+            AFTER UPDATE OF viaje_id, cajas_enviadas, cajas_devueltas ON viaje_locales BEGIN
+                {_viaje_totales_sumar("OLD", "-")};
+                {_viaje_totales_sumar("NEW", "+")};
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+
+
+# id de reception_local para una etiqueta "numero - nombre": el número es único (índice UNIQUE)
+# y CAST toma su prefijo numérico, así también resuelven etiquetas de un nombre anterior
+_SQL_ID_LOCAL = "(SELECT id FROM reception_local WHERE numero = CAST({} AS INTEGER))"
+
+# (tabla, columna id, columna etiqueta)
+_LOCAL_ID_COLUMNAS = (
+    ("viaje_locales", "local_id", "numero_local"),
+    ("devoluciones_log", "local_id", "numero_local"),
+    ("cd_despachos", "destino_id", "destino_local"),
+)
+
+
+def _v12_local_id(conn: sqlite3.Connection):
+    """Referencia entera a reception_local en lugar de la etiqueta "numero - nombre":
+    viaje_locales.local_id, devoluciones_log.local_id y cd_despachos.destino_id (la etiqueta queda
+    como texto para el historial y los ledgers por CD). Agrupar, filtrar y unir por local usa el
+    id; el display se arma al leer. Un trigger completa el id de las altas que solo traen etiqueta.
+    cd_pendientes_destino pasa a tener clave destino_id.
+    """
+    for tabla, col, etiqueta in _LOCAL_ID_COLUMNAS:
+        columnas = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()}
+        if col not in columnas:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} INTEGER REFERENCES reception_local(id)")
+        conn.execute(
+            f"UPDATE {tabla} SET {col} = r.id FROM reception_local r "
+            f"WHERE {tabla}.{col} IS NULL AND r.numero = CAST({tabla}.{etiqueta} AS INTEGER)"
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_{col} AFTER INSERT ON {tabla} WHEN NEW.{col} IS NULL BEGIN
+                UPDATE {tabla} SET {col} = {_SQL_ID_LOCAL.format(f"NEW.{etiqueta}")} WHERE id = NEW.id;
+            END"""
+        )
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_viaje_locales_local_id ON viaje_locales(local_id, cajas_enviadas, cajas_devueltas)",
+        "CREATE INDEX IF NOT EXISTS idx_devlog_local_id ON devoluciones_log(local_id)",
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_destino_id ON cd_despachos(destino_id, fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_cd_despachos_abiertos_destino ON cd_despachos(destino_id, fecha) "
+        "WHERE cajas_devueltas < cajas_enviadas",
+        # Reemplazados por los índices por id (idx_viaje_locales_local queda: recibido por CD)
+        "DROP INDEX IF EXISTS idx_devlog_local",
+        "DROP INDEX IF EXISTS idx_cd_despachos_destino",
+        "DROP INDEX IF EXISTS idx_cd_despachos_abiertos",
+    ):
+        conn.execute(stmt)
+
+    for (nombre,) in conn.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'trg_cd_destino_%'").fetchall():
+        conn.execute(f"DROP TRIGGER {nombre}")
+    conn.execute("DROP TABLE IF EXISTS cd_pendientes_destino")
+    conn.execute(
+        """
+        CREATE TABLE cd_pendientes_destino (
+            destino_id INTEGER PRIMARY KEY NOT NULL,  -- reception_local.id
+            enviadas INTEGER NOT NULL DEFAULT 0,
+            devueltas INTEGER NOT NULL DEFAULT 0,
+            abiertos INTEGER NOT NULL DEFAULT 0,   -- despachos con cajas_devueltas < cajas_enviadas
+            primer_abierto TEXT                    -- fecha del abierto más antiguo (NULL si no hay)
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO cd_pendientes_destino (destino_id, enviadas, devueltas, abiertos, primer_abierto)
+        SELECT destino_id, SUM(cajas_enviadas), SUM(COALESCE(cajas_devueltas, 0)),
+               SUM(IFNULL({_DESPACHO_ABIERTO}, 0)), MIN(CASE WHEN {_DESPACHO_ABIERTO} THEN fecha END)
+        FROM cd_despachos WHERE destino_id IS NOT NULL GROUP BY destino_id
+        """
+    )
+    triggers = {
+        "trg_cd_destino_ins": f"""
+            AFTER INSERT ON cd_despachos BEGIN
+                {_cd_destino_sumar("NEW", "+", "destino_id")};
+            END""",
+        "trg_cd_destino_del": f"""
+            AFTER DELETE ON cd_despachos BEGIN
+                {_cd_destino_sumar("OLD", "-", "destino_id")};
+            END""",
+        "trg_cd_destino_upd": f"""
+            AFTER UPDATE OF destino_id, fecha, cajas_enviadas, cajas_devueltas ON cd_despachos BEGIN
+                {_cd_destino_sumar("OLD", "-", "destino_id")};
+                {_cd_destino_sumar("NEW", "+", "destino_id")};
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER {nombre} {cuerpo}")
+    conn.execute("ANALYZE")
+
+
+# Clave del saldo por local de una fila (NEW / OLD) de viaje_locales o devoluciones_log: el id del
+# local, o 0 y la etiqueta para las filas que no resuelven a ningún local
+def _saldo_clave(fila: str) -> tuple:
+    return (f"IFNULL({fila}.local_id, 0)",
+            f"CASE WHEN {fila}.local_id IS NULL THEN IFNULL({fila}.numero_local, '') ELSE '' END")
+
+
+def _saldo_ultimo(local_id: str, etiqueta: str) -> str:
+    """Fecha del último movimiento de un local: su viaje más reciente o su última devolución."""
+    filtro = "{t}.local_id IS NULLIF({id}, 0) AND ({id} <> 0 OR {t}.numero_local = {et})"
+    return f"""(SELECT MAX(m) FROM (
+            SELECT MAX(v.fecha_viaje) AS m FROM viaje_locales vl JOIN viajes v ON v.id = vl.viaje_id
+            WHERE {filtro.format(t="vl", id=local_id, et=etiqueta)}
+            UNION ALL
+            SELECT DATE(MAX(dl.created_at)) FROM devoluciones_log dl
+            WHERE {filtro.format(t="dl", id=local_id, et=etiqueta)}
+        ))"""
+
+
+def _saldo_sumar(fila: str, signo: str) -> str:
+    """Upsert que suma (signo '+') o resta ('-') el local de viaje `fila` (NEW / OLD) a su saldo;
+    al sumar, la fecha del viaje cuenta como movimiento."""
+    local_id, etiqueta = _saldo_clave(fila)
+    devueltas = f"COALESCE({fila}.cajas_devueltas, 0)"
+    fecha = f"(SELECT fecha_viaje FROM viajes WHERE id = {fila}.viaje_id)" if signo == "+" else "NULL"
+    return f"""
+        INSERT INTO pendientes_local (local_id, etiqueta, viajes, enviadas, devueltas, pendientes, ultimo_movimiento)
+        VALUES ({local_id}, {etiqueta}, {signo}1, {signo}{fila}.cajas_enviadas, {signo}{devueltas},
+                {signo}({fila}.cajas_enviadas - {devueltas}), {fecha})
+        ON CONFLICT (local_id, etiqueta) DO UPDATE SET
+            viajes = viajes + excluded.viajes,
+            enviadas = enviadas + excluded.enviadas,
+            devueltas = devueltas + excluded.devueltas,
+            pendientes = pendientes + excluded.pendientes,
+            ultimo_movimiento = COALESCE(MAX(ultimo_movimiento, excluded.ultimo_movimiento), ultimo_movimiento, excluded.ultimo_movimiento)"""
+
+
+def _saldo_limpiar(fila: str) -> str:
+    """Borra el saldo del local de `fila` cuando ya no le quedan viajes."""
+    local_id, etiqueta = _saldo_clave(fila)
+    return f"DELETE FROM pendientes_local WHERE local_id = {local_id} AND etiqueta = {etiqueta} AND viajes = 0"
+
+
+def _saldo_recalcular_ultimo(fila: str, fecha: str, cuando: str = "1") -> str:
+    """Recalcula el último movimiento del local de `fila` si el movimiento quitado (`fecha`) era el último."""
+    local_id, etiqueta = _saldo_clave(fila)
+    return f"""
+        UPDATE pendientes_local SET ultimo_movimiento = {_saldo_ultimo("pendientes_local.local_id", "pendientes_local.etiqueta")}
+        WHERE {cuando} AND local_id = {local_id} AND etiqueta = {etiqueta} AND ultimo_movimiento IS {fecha}"""
+
+
+def _v13_pendientes_local(conn: sqlite3.Connection):
+    """Saldo por local: pendientes_local guarda por local (local_id; 0 y la etiqueta para filas sin
+    local asociado) cuántos viajes lo incluyen, enviadas / devueltas / pendientes y la fecha del
+    último movimiento (viaje o devolución). Los triggers de viaje_locales, devoluciones_log y viajes
+    lo ajustan en cada alta, devolución y edición del log, así el detalle del dashboard lee una fila
+    por local ordenada por idx_pendientes_local_pendientes en vez de agrupar viaje_locales.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pendientes_local (
+            local_id INTEGER NOT NULL,             -- reception_local.id (0: etiqueta sin local)
+            etiqueta TEXT NOT NULL DEFAULT '',     -- numero_local de las filas sin local ('' si hay local_id)
+            viajes INTEGER NOT NULL DEFAULT 0,
+            enviadas INTEGER NOT NULL DEFAULT 0,
+            devueltas INTEGER NOT NULL DEFAULT 0,
+            pendientes INTEGER NOT NULL DEFAULT 0,
+            ultimo_movimiento TEXT,                -- fecha del último viaje o devolución
+            PRIMARY KEY (local_id, etiqueta)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("DELETE FROM pendientes_local")
+    conn.execute(
+        "INSERT INTO pendientes_local (local_id, etiqueta, viajes, enviadas, devueltas, pendientes, ultimo_movimiento)"
+        + SQL_PENDIENTES_LOCAL
+    )
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_pendientes_local_pendientes ON pendientes_local(pendientes)",
+        # MAX(created_at) por local para el último movimiento (reemplaza a idx_devlog_local_id)
+        "CREATE INDEX IF NOT EXISTS idx_devlog_local_id_created ON devoluciones_log(local_id, created_at)",
+        "DROP INDEX IF EXISTS idx_devlog_local_id",
+    ):
+        conn.execute(stmt)
+    cambia_clave = "(OLD.local_id IS NOT NEW.local_id OR (NEW.local_id IS NULL AND OLD.numero_local IS NOT NEW.numero_local))"
+    triggers = {
+        # El trigger que completa local_id (migración 12) puede correr antes que este y mover la
+        # fila a su local: la clave "sin local" queda en 0 viajes y se borra
+        "trg_pendientes_local_ins": f"""
+            AFTER INSERT ON viaje_locales BEGIN
+                {_saldo_sumar("NEW", "+")};
+                {_saldo_limpiar("NEW")};
+            END""",
+        "trg_pendientes_local_del": f"""
+            AFTER DELETE ON viaje_locales BEGIN
+                {_saldo_sumar("OLD", "-")};
+                {_saldo_limpiar("OLD")};
+                {_saldo_recalcular_ultimo("OLD", "(SELECT fecha_viaje FROM viajes WHERE id = OLD.viaje_id)")};
+            END""",
+        # Renombrar un local reescribe numero_local de sus filas: sin cambio de clave no hay nada que ajustar
+        "trg_pendientes_local_upd": f"""
+            AFTER UPDATE OF viaje_id, local_id, numero_local, cajas_enviadas, cajas_devueltas ON viaje_locales
+            WHEN {cambia_clave} OR OLD.viaje_id IS NOT NEW.viaje_id
+              OR OLD.cajas_enviadas IS NOT NEW.cajas_enviadas OR OLD.cajas_devueltas IS NOT NEW.cajas_devueltas BEGIN
+                {_saldo_sumar("OLD", "-")};
+                {_saldo_sumar("NEW", "+")};
+                {_saldo_limpiar("OLD")};
+                {_saldo_recalcular_ultimo("OLD", "(SELECT fecha_viaje FROM viajes WHERE id = OLD.viaje_id)",
+                                          f"({cambia_clave} OR OLD.viaje_id IS NOT NEW.viaje_id)")};
+            END""",
+        "trg_pendientes_local_log_ins": f"""
+            AFTER INSERT ON devoluciones_log BEGIN
+                UPDATE pendientes_local SET ultimo_movimiento = COALESCE(MAX(ultimo_movimiento, DATE(NEW.created_at)), DATE(NEW.created_at))
+                WHERE local_id = {_saldo_clave("NEW")[0]} AND etiqueta = {_saldo_clave("NEW")[1]};
+            END""",
+        "trg_pendientes_local_log_del": f"""
+            AFTER DELETE ON devoluciones_log BEGIN
+                {_saldo_recalcular_ultimo("OLD", "DATE(OLD.created_at)")};
+            END""",
+        "trg_pendientes_local_log_upd": f"""
+            AFTER UPDATE OF local_id, numero_local, created_at ON devoluciones_log
+            WHEN {cambia_clave} OR OLD.created_at IS NOT NEW.created_at BEGIN
+                {_saldo_recalcular_ultimo("OLD", "DATE(OLD.created_at)")};
+                UPDATE pendientes_local SET ultimo_movimiento = {_saldo_ultimo("pendientes_local.local_id", "pendientes_local.etiqueta")}
+                WHERE local_id = {_saldo_clave("NEW")[0]} AND etiqueta = {_saldo_clave("NEW")[1]};
+            END""",
+        "trg_pendientes_local_fecha": f"""
+            AFTER UPDATE OF fecha_viaje ON viajes WHEN OLD.fecha_viaje IS NOT NEW.fecha_viaje BEGIN
+                UPDATE pendientes_local SET ultimo_movimiento = {_saldo_ultimo("pendientes_local.local_id", "pendientes_local.etiqueta")}
+                WHERE (local_id, etiqueta) IN (
+                    SELECT {_saldo_clave("vl")[0]}, {_saldo_clave("vl")[1]} FROM viaje_locales vl WHERE vl.viaje_id = NEW.id
+                );
+            END""",
+    }
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {cuerpo}")
+    conn.execute("ANALYZE pendientes_local")
+
+
+def _v14_cd_devoluciones(conn: sqlite3.Connection):
+    """Fecha de las devoluciones del CD: cd_devoluciones guarda un movimiento por cada cambio de
+    cajas_devueltas de un despacho (cajas con signo, fecha del día en que se registra; revertir o
+    corregir a la baja resta ese día). cd_stock_diario imputa las devueltas a esa fecha y no a la del
+    despacho: registrar una devolución hoy ya no cambia el stock de días anteriores.
+    Las devueltas previas no tienen fecha: el backfill las deja a la del despacho, como hasta ahora.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cd_devoluciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            despacho_id INTEGER NOT NULL,   -- cd_despachos.id
+            cd_local TEXT,                  -- el del despacho (lo mantienen los triggers)
+            fecha TEXT,                     -- día en que se registró (NULL: despacho legado sin fecha)
+            cajas INTEGER NOT NULL          -- con signo
+        )
+        """
+    )
+    for stmt in (
+        "CREATE INDEX IF NOT EXISTS idx_cd_devoluciones_despacho ON cd_devoluciones(despacho_id)",
+        # Serie diaria por CD (backfill de snapshots y verificación) sin tocar la tabla
+        "CREATE INDEX IF NOT EXISTS idx_cd_devoluciones_cd ON cd_devoluciones(cd_local, fecha, cajas)",
+    ):
+        conn.execute(stmt)
+    # Antes de crear los triggers: los snapshots existentes ya tienen estas devueltas a esa fecha
+    conn.execute(
+        "INSERT INTO cd_devoluciones (despacho_id, cd_local, fecha, cajas)"
+        " SELECT id, cd_local, fecha, cajas_devueltas FROM cd_despachos WHERE COALESCE(cajas_devueltas, 0) <> 0"
+    )
+    triggers = _cd_diario_triggers(fechas_devolucion=True)
+    for nombre, cuerpo in triggers.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {nombre}")
+        conn.execute(f"CREATE TRIGGER {nombre} {cuerpo}")
+    conn.execute("ANALYZE cd_devoluciones")
+
+
+MIGRATIONS = [
+    (1, "esquema base", _v1_esquema_base),
+    (2, "fechas en formato ISO canónico", _v2_fechas_iso),
+    (3, "índices compuestos y parciales de pendientes", _v3_indices_pendientes),
+    (4, "ledger cd_stock mantenido por triggers", _v4_cd_stock),
+    (5, "marca es_cd en reception_local", _v5_locales_es_cd),
+    (6, "stock particionado por CD", _v6_stock_por_cd),
+    (7, "búsqueda FTS y paginación de despachos", _v7_busqueda_despachos),
+    (8, "snapshots diarios de stock por CD", _v8_cd_stock_diario),
+    (9, "resumen de pendientes por destino", _v9_cd_pendientes_destino),
+    (10, "CHECK de devueltas <= enviadas", _v10_checks_devoluciones),
+    (11, "totales por viaje mantenidos por triggers", _v11_totales_viaje),
+    (12, "local_id entero en lugar de la etiqueta del local", _v12_local_id),
+    (13, "saldo pendiente por local mantenido por triggers", _v13_pendientes_local),
+    (14, "fecha de las devoluciones del CD en el stock diario", _v14_cd_devoluciones),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def _apply(conn: sqlite3.Connection, version: int, step) -> bool:
+    """Aplica un paso en su transacción. False si otro proceso ya lo aplicó."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if get_schema_version(conn) >= version:
+            conn.execute("ROLLBACK")
+            return False
+        step(conn)
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+        conn.execute("COMMIT")
+        return True
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def migrate() -> int:
+    """Lleva el esquema a LATEST_VERSION y devuelve la versión resultante.
+    Si ya está al día solo lee PRAGMA user_version (sin DDL ni commits).
+    """
+    conn = get_connection()
+    try:
+        current = get_schema_version(conn)
+        if current >= LATEST_VERSION or get_pool().settings.read_only:
+            return current
+        # Los pasos que reconstruyen tablas requieren foreign_keys OFF (fuera de transacción)
+        conn.execute("PRAGMA foreign_keys = OFF")
+        try:
+            for version, _descripcion, step in MIGRATIONS:
+                if version > current:
+                    _apply(conn, version, step)
+        finally:
+            conn.execute("PRAGMA foreign_keys = ON")
+        return get_schema_version(conn)
+    finally:
+        conn.close()
+
+
+def pending_migrations() -> list:
+    """Lista (version, descripcion) de los pasos aún no aplicados."""
+    conn = get_connection()
+    try:
+        current = get_schema_version(conn)
+    finally:
+        conn.close()
+    return [(v, d) for v, d, _ in MIGRATIONS if v > current]
@@ -1,18 +1,30 @@
-from app.db import get_connection
+import json
+from app.db import get_connection, to_iso_date
+from app.models import cd_stock
+from app.models.locales import SQL_ID_LOCAL, id_local, sql_display
 import pandas as pd
 
 
+def _rango_fechas(start_date=None, end_date=None):
+    """Fragmento ' AND fecha >= ? AND fecha <= ?' (según lo provisto) y sus parámetros ISO."""
+    sql = ""; params = []
+    if start_date:
+        sql += " AND fecha >= ?"; params.append(to_iso_date(start_date))
+    if end_date:
+        sql += " AND fecha <= ?"; params.append(to_iso_date(end_date))
+    return sql, params
+
+
 def resumen_por_cd():
     conn = get_connection()
     df = pd.read_sql_query(
         """
         SELECT cd_local,
-               SUM(cajas_enviadas) AS enviadas,
-               SUM(cajas_devueltas) AS devueltas,
-               SUM(cajas_enviadas - cajas_devueltas) AS pendientes
-        FROM cd_despachos
-        GROUP BY cd_local
-        HAVING enviadas > 0
+               enviados AS enviadas,
+               devueltos AS devueltas,
+               enviados - devueltos AS pendientes
+        FROM cd_stock
+        WHERE enviados > 0
         ORDER BY pendientes DESC
         """,
         conn
@@ -22,45 +34,10 @@ def resumen_por_cd():
 
 
 def totales(cd_display: str | None):
-    recibido_viajes = 0
-    if cd_display:
-        conn = get_connection()
-        try:
-            row = conn.execute(
-                "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-                (cd_display,)
-            ).fetchone()
-            recibido_viajes = (row[0] or 0) if row else 0
-        finally:
-            conn.close()
-
-    conn = get_connection()
-    try:
-        row = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd = (row[0] or 0) if row else 0
-        devueltos = (row[1] or 0) if row else 0
-        row2 = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = (row2[0] or 0) if row2 else 0
-    finally:
-        conn.close()
-
-    entradas_totales = int(recibido_viajes) + int(devueltos)
-    stock = entradas_totales - int(enviados_cd) - int(enviados_origen)
-    if stock < 0:
-        stock = 0
-    return {
-        "cd": cd_display,
-        "recibido_viajes": int(recibido_viajes),
-        "entradas_totales": int(entradas_totales),
-        "enviados": int(enviados_cd),
-        "enviados_origen": int(enviados_origen),
-        "devueltos": int(devueltos),
-        "stock": int(stock),
-    }
+    """Totales del CD desde el ledger cd_stock (mantenido por triggers)."""
+    datos = cd_stock.totales(cd_display)
+    datos["stock"] = max(datos["stock"], 0)
+    return datos
 
 
 def crear_despacho(cd_local, destino_local, fecha, cajas_enviadas):
@@ -70,8 +47,8 @@ def crear_despacho(cd_local, destino_local, fecha, cajas_enviadas):
     conn = get_connection()
     try:
         conn.execute(
-            "INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas) VALUES (?, ?, ?, ?)",
-            (cd_local, destino_local, fecha, cajas_enviadas)
+            f"INSERT INTO cd_despachos (cd_local, destino_local, destino_id, fecha, cajas_enviadas) VALUES (?, ?, {SQL_ID_LOCAL}, ?, ?)",
+            (cd_local, destino_local, destino_local, to_iso_date(fecha), cajas_enviadas)
         )
         conn.commit(); return True, "Despacho registrado"
     except Exception as e:
@@ -84,9 +61,9 @@ def listar_despachos(start_date=None, end_date=None, cd_local=None):
     conn = get_connection()
     query = "SELECT * FROM cd_despachos WHERE 1=1"; params = []
     if start_date:
-        query += " AND date(fecha) >= date(?)"; params.append(start_date)
+        query += " AND fecha >= ?"; params.append(to_iso_date(start_date))
     if end_date:
-        query += " AND date(fecha) <= date(?)"; params.append(end_date)
+        query += " AND fecha <= ?"; params.append(to_iso_date(end_date))
     if cd_local and cd_local != "Todos":
         query += " AND cd_local = ?"; params.append(cd_local)
     query += " ORDER BY fecha DESC, id DESC"
@@ -119,35 +96,31 @@ def listar_envios_origen(start_date=None, end_date=None):
     conn = get_connection()
     query = "SELECT id, fecha, cajas_enviadas FROM cd_envios_origen WHERE 1=1"; params = []
     if start_date:
-        query += " AND date(fecha) >= date(?)"; params.append(start_date)
+        query += " AND fecha >= ?"; params.append(to_iso_date(start_date))
     if end_date:
-        query += " AND date(fecha) <= date(?)"; params.append(end_date)
+        query += " AND fecha <= ?"; params.append(to_iso_date(end_date))
     query += " ORDER BY fecha DESC, id DESC"
     df = pd.read_sql_query(query, conn, params=params)
     conn.close(); return df
 
 
-def enviar_a_origen(fecha, cajas):
+def enviar_a_origen(fecha, cajas, cd_local=None):
     cajas = int(cajas)
     if cajas <= 0:
         return False, "La cantidad debe ser mayor a 0"
     conn = get_connection()
     try:
         conn.execute("BEGIN IMMEDIATE")
-        # Calcular recibido al CD (por viajes)
-        # Nota: la detección de cd_display la hace la UI con get_cd_display
-        # Aquí solo usamos totales sin cd_display para validación de stock
-        row = conn.execute("SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos").fetchone()
-        enviados_cd = int((row[0] or 0) if row else 0)
-        devueltos = int((row[1] or 0) if row else 0)
-        row2 = conn.execute("SELECT SUM(cajas_enviadas) FROM cd_envios_origen").fetchone()
-        enviados_origen = int((row2[0] or 0) if row2 else 0)
-        # Aproximación de recibido_viajes: suma por todos los CD detectados está en totales();
-        # para mantener lógica, usamos entradas_totales = devueltos + recibido_viajes (UI proveerá cd_display si precisa precisión)
-        # Aquí tomamos recibido_viajes como total de viaje_locales a cualquier CD no trivial podría ser distinto;
-        # sin embargo la UI ya muestra stock con precisión. Mantener compat con lógica original: validar contra stock reportado en UI.
-        # Para simplificar, permitimos la inserción (la UI valida antes del submit).
-        conn.execute("INSERT INTO cd_envios_origen (fecha, cajas_enviadas) VALUES (?, ?)", (fecha, cajas))
+        # Sin validación de stock: la UI valida contra cd_totales() antes del submit.
+        # Sin cd_local se imputa al CD principal (primer local con es_cd).
+        conn.execute(
+            """
+            INSERT INTO cd_envios_origen (fecha, cajas_enviadas, cd_local)
+            VALUES (?, ?, COALESCE(?, (SELECT CASE WHEN nombre IS NOT NULL AND nombre <> '' THEN numero || ' - ' || nombre ELSE CAST(numero AS TEXT) END
+                                       FROM reception_local WHERE es_cd = 1 ORDER BY numero LIMIT 1)))
+            """,
+            (to_iso_date(fecha), cajas, cd_local)
+        )
         conn.commit(); return True, "Envío al origen registrado"
     except Exception as e:
         try:
@@ -171,7 +144,7 @@ def actualizar_envio_origen(envio_id, nueva_fecha, nuevas_cajas):
             conn.execute("ROLLBACK"); return False, "Envío no encontrado"
         conn.execute(
             "UPDATE cd_envios_origen SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_cajas, envio_id)
+            (to_iso_date(nueva_fecha), nuevas_cajas, envio_id)
         )
         conn.commit(); return True, "Envío actualizado"
     except Exception as e:
@@ -207,7 +180,7 @@ def actualizar_despacho(despacho_id, nueva_fecha, nuevas_cajas):
             conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
         conn.execute(
             "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_cajas, despacho_id)
+            (to_iso_date(nueva_fecha), nuevas_cajas, despacho_id)
         )
         conn.commit(); return True, "Despacho actualizado"
     except Exception as e:
@@ -242,7 +215,7 @@ def actualizar_despacho_detallado(despacho_id, nueva_fecha, nuevas_enviadas, nue
 
         conn.execute(
             "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ?, cajas_devueltas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_enviadas, nuevas_devueltas, despacho_id)
+            (to_iso_date(nueva_fecha), nuevas_enviadas, nuevas_devueltas, despacho_id)
         )
         conn.commit(); return True, "Despacho actualizado"
     except Exception as e:
@@ -298,13 +271,15 @@ def revertir_despacho_a_pendiente(despacho_id):
 
 def pendientes_por_destino(start_date=None, end_date=None):
     conn = get_connection()
-    query = "SELECT destino_local, SUM(cajas_enviadas) AS enviadas, SUM(cajas_devueltas) AS devueltas FROM cd_despachos WHERE 1=1"; params = []
-    if start_date:
-        query += " AND date(fecha) >= date(?)"; params.append(start_date)
-    if end_date:
-        query += " AND date(fecha) <= date(?)"; params.append(end_date)
-    query += " GROUP BY destino_local"
-    df = pd.read_sql_query(query, conn, params=params)
+    rango, params = _rango_fechas(start_date, end_date)
+    # Solo destinos con algún despacho abierto (índice parcial); luego totales de esos destinos por destino_id
+    query = (
+        f"SELECT t.destino_id, {sql_display('NULL')} AS destino_local, t.enviadas, t.devueltas FROM ("
+        "SELECT destino_id, SUM(cajas_enviadas) AS enviadas, SUM(cajas_devueltas) AS devueltas FROM cd_despachos"
+        " WHERE destino_id IN (SELECT DISTINCT destino_id FROM cd_despachos WHERE cajas_devueltas < cajas_enviadas" + rango + ")"
+        + rango + " GROUP BY destino_id) t LEFT JOIN reception_local rl ON rl.id = t.destino_id"
+    )
+    df = pd.read_sql_query(query, conn, params=params + params)
     conn.close()
     if df.empty:
         return df
@@ -315,35 +290,72 @@ def pendientes_por_destino(start_date=None, end_date=None):
     return df
 
 
+# Asignación FIFO por destino: pendientes acumulados (suma corrida por fecha, id) sobre los
+# despachos abiertos; cada despacho recibe min(pendiente, lo que resta de :cantidad al llegar a él).
+# Cada despacho abierto tiene al menos 1 pendiente, así que nunca se necesitan más de :cantidad
+# filas: el LIMIT corta la lectura del índice parcial antes de calcular la ventana.
+_FIFO_CTE = """
+    WITH abiertos AS (
+        SELECT id, fecha, cajas_enviadas - cajas_devueltas AS pend
+        FROM cd_despachos
+        WHERE destino_id = :destino_id AND cajas_devueltas < cajas_enviadas
+        ORDER BY fecha, id
+        LIMIT :cantidad
+    ),
+    acumulados AS (
+        SELECT id, fecha, pend, SUM(pend) OVER (ORDER BY fecha, id ROWS UNBOUNDED PRECEDING) AS acumulado
+        FROM abiertos
+    ),
+    asignacion AS (
+        SELECT id, fecha, pend, MIN(pend, :cantidad - (acumulado - pend)) AS aplicar
+        FROM acumulados
+        WHERE acumulado - pend < :cantidad
+    )
+"""
+
+
+def asignar_devolucion_fifo(conn, destino_display, cantidad) -> list:
+    """Aplica `cantidad` devoluciones a los despachos abiertos del destino (más antiguos primero).
+    La asignación se calcula con una sola consulta (suma corrida) y se aplica con un único
+    UPDATE ... FROM json_each; llamar con la transacción de escritura abierta (BEGIN IMMEDIATE).
+    Retorna [{'despacho_id', 'fecha', 'aplicado', 'pendientes_restantes'}] en orden FIFO.
+    """
+    destino_id = id_local(conn, destino_display)
+    if destino_id is None:
+        return []
+    filas = conn.execute(
+        _FIFO_CTE + " SELECT id, fecha, pend, aplicar FROM asignacion",
+        {"destino_id": destino_id, "cantidad": int(cantidad)},
+    ).fetchall()
+    if filas:
+        conn.execute(
+            """
+            UPDATE cd_despachos SET cajas_devueltas = cajas_devueltas + json_extract(a.value, '$[1]')
+            FROM json_each(?) AS a
+            WHERE cd_despachos.id = json_extract(a.value, '$[0]')
+            """,
+            (json.dumps([[rid, aplicar] for rid, _f, _p, aplicar in filas]),),
+        )
+    return [
+        {"despacho_id": rid, "fecha": fecha, "aplicado": int(aplicar), "pendientes_restantes": int(pend - aplicar)}
+        for rid, fecha, pend, aplicar in filas
+    ]
+
+
 def registrar_devolucion_por_destino(destino_display, cantidad):
     restante = int(cantidad)
     if restante <= 0:
         return 0
     conn = get_connection()
     try:
-        rows = conn.execute(
-            """
-            SELECT id, cajas_enviadas, cajas_devueltas
-            FROM cd_despachos
-            WHERE destino_local = ? AND cajas_devueltas < cajas_enviadas
-            ORDER BY date(fecha) ASC, id ASC
-            """,
-            (destino_display,)
-        ).fetchall()
-        total_aplicado = 0
-        for rid, envi, dev in rows:
-            if restante <= 0:
-                break
-            pend = int(envi) - int(dev)
-            aplicar = min(pend, restante)
-            if aplicar > 0:
-                conn.execute(
-                    "UPDATE cd_despachos SET cajas_devueltas = cajas_devueltas + ? WHERE id = ?",
-                    (aplicar, rid)
-                )
-                restante -= aplicar
-                total_aplicado += aplicar
-        conn.commit(); return total_aplicado
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            detalle = asignar_devolucion_fifo(conn, destino_display, restante)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return sum(d["aplicado"] for d in detalle)
     finally:
         conn.close()
 
@@ -352,9 +364,52 @@ def registrar_devolucion_todas_por_destino(destino_display):
     conn = get_connection()
     try:
         conn.execute(
-            "UPDATE cd_despachos SET cajas_devueltas = cajas_enviadas WHERE destino_local = ? AND cajas_devueltas < cajas_enviadas",
+            f"UPDATE cd_despachos SET cajas_devueltas = cajas_enviadas WHERE destino_id = {SQL_ID_LOCAL} AND cajas_devueltas < cajas_enviadas",
             (destino_display,)
         )
         conn.commit()
     finally:
         conn.close()
+
+
+# Resumen cd_pendientes_destino (migraciones 9 y 12) recalculado desde cd_despachos
+_SQL_PENDIENTES_DESTINO_REAL = """
+    SELECT destino_id, SUM(cajas_enviadas), SUM(COALESCE(cajas_devueltas, 0)),
+           SUM(IFNULL(cajas_devueltas < cajas_enviadas, 0)), MIN(CASE WHEN cajas_devueltas < cajas_enviadas THEN fecha END)
+    FROM cd_despachos WHERE destino_id IS NOT NULL GROUP BY destino_id
+"""
+
+
+def verificar_pendientes_destino(reparar: bool = False) -> dict:
+    """Compara cd_pendientes_destino con los totales reales por destino.
+    Retorna {'ok', 'destinos', 'diferencias': {destino_id: (guardado, real)}}; las tuplas son
+    (enviadas, devueltas, abiertos, primer_abierto) y un destino sin despachos equivale a
+    (0, 0, 0, None). Con reparar=True reescribe el resumen completo si difiere.
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE" if reparar else "BEGIN")
+        try:
+            vacio = (0, 0, 0, None)
+            guardado = {r[0]: tuple(r[1:]) for r in conn.execute(
+                "SELECT destino_id, enviadas, devueltas, abiertos, primer_abierto FROM cd_pendientes_destino"
+            ).fetchall()}
+            real = {r[0]: tuple(r[1:]) for r in conn.execute(_SQL_PENDIENTES_DESTINO_REAL).fetchall()}
+            diferencias = {
+                d: (guardado.get(d, vacio), real.get(d, vacio))
+                for d in sorted(set(guardado) | set(real))
+                if guardado.get(d, vacio) != real.get(d, vacio)
+            }
+            if diferencias and reparar:
+                conn.execute("DELETE FROM cd_pendientes_destino")
+                conn.execute(
+                    "INSERT INTO cd_pendientes_destino (destino_id, enviadas, devueltas, abiertos, primer_abierto) "
+                    + _SQL_PENDIENTES_DESTINO_REAL
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"ok": not diferencias, "destinos": len(real), "diferencias": diferencias}
+    finally:
+        conn.close()
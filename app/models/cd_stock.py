@@ -0,0 +1,298 @@
+"""Ledger cd_stock: contadores por CD mantenidos por triggers (migraciones 4, 6, 8 y 14).
+
+Una fila por CD (clave cd_local = display "numero - nombre"):
+stock = recibido_viajes + devueltos - enviados - enviados_origen
+
+Cada fila existente es exacta: los triggers de viaje_locales, cd_despachos y cd_envios_origen
+la ajustan en cada escritura. Una fila faltante (CD recién marcado) se calcula desde las tablas
+base la primera vez que se lee. `python -m app.maintenance cd-stock` compara todo contra los SUM reales.
+
+cd_stock_diario guarda los mismos contadores acumulados al cierre de cada día con movimientos
+(fecha del viaje / despacho / envío; las devueltas, a la fecha en que se registraron según
+cd_devoluciones): el stock en una fecha es la última fila <= fecha.
+"""
+from __future__ import annotations
+import sqlite3
+from typing import Iterable, List, Optional
+
+from app.db import get_connection, write_transaction
+
+_CAMPOS = ("recibido_viajes", "enviados", "devueltos", "enviados_origen")
+
+# Totales reales de un CD calculados desde las tablas base (índices por cd_local / numero_local)
+_SQL_REAL = """
+    SELECT (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM viaje_locales WHERE numero_local = :cd),
+           (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_despachos WHERE cd_local = :cd),
+           (SELECT COALESCE(SUM(cajas_devueltas), 0) FROM cd_despachos WHERE cd_local = :cd),
+           (SELECT COALESCE(SUM(cajas_enviadas), 0) FROM cd_envios_origen WHERE cd_local = :cd)
+"""
+
+_SQL_GUARDAR = """
+    INSERT OR REPLACE INTO cd_stock (cd_local, recibido_viajes, enviados, devueltos, enviados_origen)
+""" + _SQL_REAL.replace("SELECT (", "SELECT :cd, (", 1)
+
+_SQL_LEER = "SELECT recibido_viajes, enviados, devueltos, enviados_origen FROM cd_stock WHERE cd_local = ?"
+
+# Acumulados por día de un CD desde las tablas base (misma imputación que los triggers de las migraciones 8 y 14)
+_SQL_DIARIO_REAL = """
+    SELECT fecha, SUM(SUM(rec)) OVER w, SUM(SUM(env)) OVER w, SUM(SUM(dev)) OVER w, SUM(SUM(ori)) OVER w
+    FROM (
+        SELECT v.fecha_viaje AS fecha, vl.cajas_enviadas AS rec, 0 AS env, 0 AS dev, 0 AS ori
+        FROM viaje_locales vl JOIN viajes v ON v.id = vl.viaje_id WHERE vl.numero_local = :cd
+        UNION ALL
+        SELECT fecha, 0, cajas_enviadas, 0, 0 FROM cd_despachos WHERE cd_local = :cd
+        UNION ALL
+        SELECT fecha, 0, 0, cajas, 0 FROM cd_devoluciones WHERE cd_local = :cd
+        UNION ALL
+        SELECT fecha, 0, 0, 0, cajas_enviadas FROM cd_envios_origen WHERE cd_local = :cd
+    )
+    WHERE fecha IS NOT NULL
+    GROUP BY fecha
+    WINDOW w AS (ORDER BY fecha)
+    ORDER BY fecha
+"""
+
+# Despachos del CD cuyas devoluciones fechadas no suman sus cajas_devueltas (id, faltante)
+_SQL_DEVOLUCIONES_DIFIEREN = """
+    SELECT d.id, COALESCE(d.cajas_devueltas, 0) - COALESCE(SUM(e.cajas), 0)
+    FROM cd_despachos d LEFT JOIN cd_devoluciones e ON e.despacho_id = d.id AND e.cd_local IS d.cd_local
+    WHERE d.cd_local = :cd
+    GROUP BY d.id HAVING COALESCE(d.cajas_devueltas, 0) <> COALESCE(SUM(e.cajas), 0)
+"""
+
+_SQL_DIARIO_GUARDAR = (
+    "INSERT INTO cd_stock_diario (cd_local, fecha, recibido_viajes, enviados, devueltos, enviados_origen) "
+    "SELECT :cd, * FROM (" + _SQL_DIARIO_REAL + ")"
+)
+
+_SQL_DIARIO_LEER = """
+    SELECT fecha, recibido_viajes, enviados, devueltos, enviados_origen FROM cd_stock_diario
+    WHERE cd_local = ? AND fecha <= ? ORDER BY fecha DESC LIMIT 1
+"""
+
+
+def _como_dict(cd_local, valores) -> dict:
+    d = {"cd": cd_local}
+    d.update({k: int(v or 0) for k, v in zip(_CAMPOS, valores)})
+    d["entradas_totales"] = d["recibido_viajes"] + d["devueltos"]
+    d["stock"] = d["entradas_totales"] - d["enviados"] - d["enviados_origen"]
+    return d
+
+
+def _vacio(cd_local) -> dict:
+    return _como_dict(cd_local, (0, 0, 0, 0))
+
+
+def leer(conn: sqlite3.Connection, cd_local: Optional[str]) -> dict:
+    """Totales de un CD en O(1). Si su fila falta se calcula y guarda, por lo que conviene
+    llamarla con la transacción de escritura ya abierta (BEGIN IMMEDIATE).
+    """
+    if not cd_local:
+        return _vacio(cd_local)
+    row = conn.execute(_SQL_LEER, (cd_local,)).fetchone()
+    if row is None:
+        conn.execute(_SQL_GUARDAR, {"cd": cd_local})
+        row = conn.execute(_SQL_LEER, (cd_local,)).fetchone()
+    return _como_dict(cd_local, row)
+
+
+def asegurar(conn: sqlite3.Connection, cd_local: Optional[str]) -> Optional[dict]:
+    """Garantiza la fila del CD antes de abrir la transacción de escritura principal.
+    Si ya existe es una lectura por PK; si falta se calcula en una transacción propia.
+    Retorna los totales leídos (None sin CD).
+    """
+    if not cd_local:
+        return None
+    row = conn.execute(_SQL_LEER, (cd_local,)).fetchone()
+    if row is not None:
+        return _como_dict(cd_local, row)
+    with write_transaction(conn, "cd_stock.crear_fila"):
+        return leer(conn, cd_local)
+
+
+def totales(cd_local: Optional[str]) -> dict:
+    """Lectura independiente (abre y cierra su conexión). Solo toma el lock de escritura si
+    hay que crear la fila del CD.
+    """
+    if not cd_local:
+        return _vacio(cd_local)
+    conn = get_connection()
+    try:
+        return asegurar(conn, cd_local)
+    finally:
+        conn.close()
+
+
+def resumen() -> List[dict]:
+    """Una fila por CD del ledger (lee solo cd_stock: escala con la cantidad de CDs)."""
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            "SELECT cd_local, recibido_viajes, enviados, devueltos, enviados_origen FROM cd_stock ORDER BY cd_local"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_como_dict(r[0], r[1:]) for r in rows]
+
+
+def _tiene_diario(conn: sqlite3.Connection, cd_local: str) -> bool:
+    return conn.execute("SELECT 1 FROM cd_stock_diario WHERE cd_local = ? LIMIT 1", (cd_local,)).fetchone() is not None
+
+
+def _asegurar_diario(conn: sqlite3.Connection, cd_local: str):
+    """Arma los snapshots de un CD que aún no tiene (transacción propia, como asegurar())."""
+    if _tiene_diario(conn, cd_local):
+        return
+    with write_transaction(conn, "cd_stock.crear_diario"):
+        if not _tiene_diario(conn, cd_local):
+            conn.execute(_SQL_DIARIO_GUARDAR, {"cd": cd_local})
+
+
+def en_fecha(cd_local: Optional[str], fecha: str) -> dict:
+    """Totales del CD al cierre de `fecha` (ISO): una búsqueda por PK en cd_stock_diario."""
+    if not cd_local:
+        return _vacio(cd_local)
+    conn = get_connection()
+    try:
+        _asegurar_diario(conn, cd_local)
+        row = conn.execute(_SQL_DIARIO_LEER, (cd_local, fecha)).fetchone()
+    finally:
+        conn.close()
+    datos = _como_dict(cd_local, row[1:] if row else (0, 0, 0, 0))
+    datos["fecha"] = fecha
+    return datos
+
+
+def historial(cd_local: Optional[str], desde: Optional[str] = None, hasta: Optional[str] = None) -> List[dict]:
+    """Snapshots del CD entre desde y hasta (ISO, inclusive), más el último anterior a `desde`
+    como base (útil para calcular los movimientos del primer día). Solo días con movimientos.
+    """
+    if not cd_local:
+        return []
+    conn = get_connection()
+    try:
+        _asegurar_diario(conn, cd_local)
+        query = "SELECT fecha, recibido_viajes, enviados, devueltos, enviados_origen FROM cd_stock_diario WHERE cd_local = ?"
+        params = [cd_local]
+        if hasta:
+            query += " AND fecha <= ?"; params.append(hasta)
+        rows = []
+        if desde:
+            base = conn.execute(_SQL_DIARIO_LEER.replace("fecha <= ?", "fecha < ?"), (cd_local, desde)).fetchone()
+            rows = [base] if base else []
+            query += " AND fecha >= ?"; params.append(desde)
+        rows += conn.execute(query + " ORDER BY fecha", params).fetchall()
+    finally:
+        conn.close()
+    resultado = []
+    for r in rows:
+        d = _como_dict(cd_local, r[1:])
+        d["fecha"] = r[0]
+        resultado.append(d)
+    return resultado
+
+
+def _claves(conn: sqlite3.Connection, cds: Iterable[str]) -> List[str]:
+    """CDs a considerar: los pedidos + los que tienen fila en el ledger o movimientos."""
+    claves = {c for c in cds if c}
+    for (cd,) in conn.execute(
+        """
+        SELECT cd_local FROM cd_stock
+        UNION SELECT cd_local FROM cd_despachos WHERE cd_local IS NOT NULL
+        UNION SELECT cd_local FROM cd_envios_origen WHERE cd_local IS NOT NULL
+        """
+    ).fetchall():
+        claves.add(cd)
+    return sorted(claves)
+
+
+def reconstruir(conn: sqlite3.Connection, cds: Iterable[str] = ()) -> List[dict]:
+    """Recalcula todas las filas desde las tablas base (usar dentro de una transacción de escritura)."""
+    claves = _claves(conn, cds)
+    conn.execute("DELETE FROM cd_stock")
+    conn.execute("DELETE FROM cd_stock_diario")
+    for cd in claves:
+        conn.execute(_SQL_GUARDAR, {"cd": cd})
+        conn.execute(_SQL_DIARIO_GUARDAR, {"cd": cd})
+    return [leer(conn, cd) for cd in claves]
+
+
+def renombrar(conn: sqlite3.Connection, anterior: str, nuevo: str):
+    """Pasa las filas del CD `anterior` a la clave `nuevo` una vez reescritas las etiquetas en las
+    tablas base (dentro de la misma transacción de escritura): ambas claves se recalculan.
+    """
+    tenia = conn.execute(_SQL_LEER, (anterior,)).fetchone() is not None
+    conn.execute("DELETE FROM cd_stock WHERE cd_local IN (?, ?)", (anterior, nuevo))
+    conn.execute("DELETE FROM cd_stock_diario WHERE cd_local IN (?, ?)", (anterior, nuevo))
+    if tenia:
+        conn.execute(_SQL_GUARDAR, {"cd": nuevo})
+        conn.execute(_SQL_DIARIO_GUARDAR, {"cd": nuevo})
+
+
+def _diario_difiere(conn: sqlite3.Connection, cd: str) -> Optional[str]:
+    """Primera fecha en que el stock según los snapshots del CD no coincide con las tablas base
+    (None si coinciden o si el CD aún no tiene snapshots). Compara el acumulado vigente en cada
+    fecha de ambas series: un día cuyos movimientos se borraron queda como fila sin cambios.
+    """
+    guardado = {r[0]: tuple(r[1:]) for r in conn.execute(
+        "SELECT fecha, recibido_viajes, enviados, devueltos, enviados_origen FROM cd_stock_diario WHERE cd_local = ?", (cd,)
+    ).fetchall()}
+    if not guardado:
+        return None
+    real = {r[0]: tuple(r[1:]) for r in conn.execute(_SQL_DIARIO_REAL, {"cd": cd}).fetchall()}
+    vigente_g = vigente_r = (0, 0, 0, 0)
+    for fecha in sorted(set(guardado) | set(real)):
+        vigente_g = guardado.get(fecha, vigente_g)
+        vigente_r = real.get(fecha, vigente_r)
+        if vigente_g != vigente_r:
+            return fecha
+    return None
+
+
+def verificar(cds: Iterable[str] = (), reparar: bool = False) -> dict:
+    """Compara el ledger y sus snapshots diarios con las tablas base para cada CD.
+    Retorna {'ok', 'por_cd': {cd: {'ledger', 'real'}}, 'diferencias': {cd: {campo: (ledger, real)}},
+    'devoluciones': {cd: [despachos cuyo cd_devoluciones no suma cajas_devueltas]},
+    'diario': {cd: primera fecha distinta}} (ledger None = fila aún no creada).
+    Con reparar=True reescribe las filas y snapshots que difieren; a las devoluciones que faltan
+    (sin fecha conocida) les agrega un movimiento de hoy.
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE" if reparar else "BEGIN")
+        try:
+            por_cd = {}; diferencias = {}; devoluciones = {}; diario = {}
+            for cd in _claves(conn, cds):
+                row = conn.execute(_SQL_LEER, (cd,)).fetchone()
+                ledger = _como_dict(cd, row) if row else None
+                real = _como_dict(cd, conn.execute(_SQL_REAL, {"cd": cd}).fetchone())
+                por_cd[cd] = {"ledger": ledger, "real": real}
+                # Una fila faltante no es un error: leer() la crea al primer uso
+                dif = {k: (ledger[k], real[k]) for k in _CAMPOS if ledger[k] != real[k]} if ledger else {}
+                if dif:
+                    diferencias[cd] = dif
+                    if reparar:
+                        conn.execute(_SQL_GUARDAR, {"cd": cd})
+                faltantes = conn.execute(_SQL_DEVOLUCIONES_DIFIEREN, {"cd": cd}).fetchall()
+                if faltantes:
+                    devoluciones[cd] = [r[0] for r in faltantes]
+                    if reparar:
+                        # Los triggers de cd_devoluciones ajustan cd_stock_diario
+                        conn.executemany(
+                            "INSERT INTO cd_devoluciones (despacho_id, cd_local, fecha, cajas) VALUES (?, ?, date('now', 'localtime'), ?)",
+                            [(rid, cd, cajas) for rid, cajas in faltantes],
+                        )
+                fecha = _diario_difiere(conn, cd)
+                if fecha:
+                    diario[cd] = fecha
+                    if reparar:
+                        conn.execute("DELETE FROM cd_stock_diario WHERE cd_local = ?", (cd,))
+                        conn.execute(_SQL_DIARIO_GUARDAR, {"cd": cd})
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"ok": not (diferencias or devoluciones or diario), "por_cd": por_cd, "diferencias": diferencias,
+                "devoluciones": devoluciones, "diario": diario}
+    finally:
+        conn.close()
@@ -1,7 +1,47 @@
-from app.db import get_connection
+from app.db import get_connection, write_transaction
 import pandas as pd
 import sqlite3
 
+# id del local de una etiqueta "numero - nombre" (parámetro ?): el número es único e indexado
+SQL_ID_LOCAL = "(SELECT id FROM reception_local WHERE numero = CAST(? AS INTEGER))"
+
+
+def id_local(conn, etiqueta) -> int | None:
+    """id de reception_local para la etiqueta "numero - nombre" (None si no corresponde a ninguno)."""
+    if not etiqueta:
+        return None
+    row = conn.execute("SELECT id FROM reception_local WHERE numero = CAST(? AS INTEGER)", (etiqueta,)).fetchone()
+    return row[0] if row else None
+
+
+def sql_display(etiqueta: str, alias: str = "rl") -> str:
+    """Display "numero - nombre" de reception_local `alias` (unida por id con LEFT JOIN), con el
+    mismo formato que locales_service._display; sin local asociado queda la etiqueta guardada.
+    """
+    return (f"CASE WHEN {alias}.id IS NULL THEN {etiqueta} WHEN {alias}.nombre <> '' "
+            f"THEN {alias}.numero || ' - ' || {alias}.nombre ELSE CAST({alias}.numero AS TEXT) END")
+
+
+def _display(numero, nombre) -> str:
+    return f"{numero} - {nombre}" if nombre else str(numero)
+
+
+def renombrar_etiquetas(conn, local_id: int, anterior: str, nuevo: str):
+    """Reescribe la etiqueta guardada de un local renombrado (viaje_locales, devoluciones_log,
+    cd_despachos / cd_envios_origen) y mueve sus filas de cd_stock a la clave nueva, así el
+    historial no queda partido. Llamar dentro de la transacción que actualiza reception_local.
+    """
+    if anterior == nuevo:
+        return
+    from app.models import cd_stock
+    conn.execute("UPDATE viaje_locales SET numero_local = ? WHERE local_id = ?", (nuevo, local_id))
+    conn.execute("UPDATE devoluciones_log SET numero_local = ? WHERE local_id = ?", (nuevo, local_id))
+    conn.execute("UPDATE cd_despachos SET destino_local = ? WHERE destino_id = ?", (nuevo, local_id))
+    # El CD se identifica por su etiqueta (ledgers por cd_local)
+    conn.execute("UPDATE cd_despachos SET cd_local = ? WHERE cd_local = ?", (nuevo, anterior))
+    conn.execute("UPDATE cd_envios_origen SET cd_local = ? WHERE cd_local = ?", (nuevo, anterior))
+    cd_stock.renombrar(conn, anterior, nuevo)
+
 
 def get_locales_catalogo() -> pd.DataFrame:
     conn = get_connection()
@@ -63,8 +103,12 @@ def editar_local(id: int, numero: int, nombre: str):
     try:
         if numero_existe(numero, exclude_id=id):
             return False, "No se puede asignar un número que ya está usado por otro local."
-        conn.execute("UPDATE reception_local SET numero=?, nombre=? WHERE id=?", (numero, nombre, id))
-        conn.commit(); return True, "Local editado correctamente."
+        with write_transaction(conn, "locales.editar"):
+            previo = conn.execute("SELECT numero, nombre FROM reception_local WHERE id=?", (id,)).fetchone()
+            conn.execute("UPDATE reception_local SET numero=?, nombre=? WHERE id=?", (numero, nombre, id))
+            if previo:
+                renombrar_etiquetas(conn, id, _display(*previo), _display(numero, nombre))
+        return True, "Local editado correctamente."
     except sqlite3.IntegrityError:
         return False, "Ya existe un local con ese número o nombre."
     except Exception as e:
@@ -78,6 +122,8 @@ def eliminar_local(id: int):
     try:
         conn.execute("DELETE FROM reception_local WHERE id=?", (id,))
         conn.commit(); return True, "Local eliminado correctamente."
+    except sqlite3.IntegrityError:
+        return False, "No se puede eliminar: el local tiene viajes o despachos registrados."
     except Exception as e:
         return False, f"Error: {e}"
     finally:
@@ -1,33 +1,32 @@
-from app.db import get_connection
+from app.db import get_connection, to_iso_date, next_iso_date, write_transaction
 import pandas as pd
 import sqlite3
 from typing import Optional, Tuple
+from app.models.locales import SQL_ID_LOCAL, sql_display
 
 
 def get_viajes_detallados(fecha_desde=None, fecha_hasta=None, chofer_id=None, estado=None) -> pd.DataFrame:
     conn = get_connection()
+    # Totales guardados en viajes por triggers (migración 11): sin JOIN ni GROUP BY de viaje_locales
     query = [
         "SELECT v.id, v.fecha_viaje, v.estado, c.nombre AS chofer,",
-        "       COALESCE(COUNT(vl.id),0) AS total_locales,",
-        "       COALESCE(SUM(vl.cajas_enviadas),0) AS total_enviadas,",
-        "       COALESCE(SUM(vl.cajas_devueltas),0) AS total_devueltas,",
-        "       COALESCE(SUM(vl.cajas_enviadas),0) - COALESCE(SUM(vl.cajas_devueltas),0) AS pendientes",
+        "       v.total_locales, v.total_enviadas, v.total_devueltas, v.pendientes",
         "FROM viajes v",
-        "JOIN choferes c ON v.chofer_id = c.id",
-        "LEFT JOIN viaje_locales vl ON v.id = vl.viaje_id"
+        "JOIN choferes c ON v.chofer_id = c.id"
     ]
     filtros = []; params = []
     if fecha_desde:
-        filtros.append("v.fecha_viaje >= ?"); params.append(fecha_desde)
+        filtros.append("v.fecha_viaje >= ?"); params.append(to_iso_date(fecha_desde))
     if fecha_hasta:
-        filtros.append("v.fecha_viaje <= ?"); params.append(fecha_hasta)
+        filtros.append("v.fecha_viaje <= ?"); params.append(to_iso_date(fecha_hasta))
     if chofer_id:
         filtros.append("v.chofer_id = ?"); params.append(chofer_id)
     if estado and estado != "Todos":
         filtros.append("v.estado = ?"); params.append(estado)
     if filtros:
         query.append("WHERE " + " AND ".join(filtros))
-    query.append("GROUP BY v.id ORDER BY v.fecha_viaje DESC, v.id DESC")
+    # (fecha_viaje, id) coincide con idx_viajes_fecha: rango + orden sin B-tree temporal
+    query.append("ORDER BY v.fecha_viaje DESC, v.id DESC")
     try:
         df = pd.read_sql_query(" ".join(query), conn, params=params)
     finally:
@@ -35,11 +34,20 @@ def get_viajes_detallados(fecha_desde=None, fecha_hasta=None, chofer_id=None, es
     return df
 
 
+# Alta de un local en el viaje: local_id resuelto desde la etiqueta elegida en la UI
+_SQL_INSERT_LOCAL = (
+    "INSERT INTO viaje_locales (viaje_id, numero_local, local_id, cajas_enviadas, cajas_devueltas) "
+    f"VALUES (?, ?, {SQL_ID_LOCAL}, ?, 0)"
+)
+
+
 def get_viaje_locales(viaje_id: int) -> pd.DataFrame:
     conn = get_connection()
     try:
         df = pd.read_sql_query(
-            "SELECT id, numero_local, cajas_enviadas, cajas_devueltas, (cajas_enviadas - cajas_devueltas) AS pendientes FROM viaje_locales WHERE viaje_id = ? ORDER BY id",
+            f"SELECT vl.id, vl.local_id, {sql_display('vl.numero_local')} AS numero_local, vl.cajas_enviadas, vl.cajas_devueltas,"
+            " (vl.cajas_enviadas - vl.cajas_devueltas) AS pendientes"
+            " FROM viaje_locales vl LEFT JOIN reception_local rl ON rl.id = vl.local_id WHERE vl.viaje_id = ? ORDER BY vl.id",
             conn,
             params=(viaje_id,)
         )
@@ -48,40 +56,32 @@ def get_viaje_locales(viaje_id: int) -> pd.DataFrame:
     return df
 
 
-def _log_devolucion(viaje_id: int, viaje_local_id: int, numero_local: str, cantidad: int, tipo: str = "individual", usuario: Optional[str] = None):
-    """Inserta una fila en devoluciones_log (best effort)."""
-    try:
-        conn = get_connection(); cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?)",
-            (viaje_id, viaje_local_id, numero_local, int(cantidad), tipo, usuario)
-        )
-        conn.commit(); conn.close()
-    except Exception:
-        # logging silencioso para no romper el flujo principal
-        try:
-            conn.close()
-        except Exception:
-            pass
-
-
 def registrar_devolucion(viaje_local_id: int, cantidad: int, usuario: Optional[str] = None):
-    conn = get_connection(); cur = conn.cursor()
+    """Suma `cantidad` devueltas si no excede los pendientes y registra el log en la misma transacción.
+    El control de pendientes va en el WHERE del UPDATE (más el CHECK de la tabla): dos operadores
+    sobre el mismo local no pueden pasarse de lo enviado.
+    """
+    cantidad = int(cantidad)
+    if cantidad <= 0:
+        return False, "Cantidad inválida"
+    conn = get_connection()
     try:
-        cur.execute("SELECT viaje_id, numero_local, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE id = ?", (viaje_local_id,))
-        row = cur.fetchone()
-        if not row:
-            return False, "Registro no encontrado"
-        viaje_id, numero_local, enviadas, devueltas = row
-        pendientes = int(enviadas or 0) - int(devueltas or 0)
-        cantidad = int(cantidad)
-        if cantidad <= 0:
-            return False, "Cantidad inválida"
-        if cantidad > pendientes:
-            return False, "Cantidad excede pendientes"
-        cur.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_devueltas + ? WHERE id = ?", (cantidad, viaje_local_id))
-        conn.commit()
-        _log_devolucion(viaje_id, viaje_local_id, numero_local, cantidad, "individual", usuario)
+        with write_transaction(conn, "viajes.registrar_devolucion"):
+            filas = conn.execute(
+                "UPDATE viaje_locales SET cajas_devueltas = COALESCE(cajas_devueltas, 0) + ? "
+                "WHERE id = ? AND COALESCE(cajas_devueltas, 0) + ? <= cajas_enviadas "
+                "RETURNING viaje_id, numero_local, local_id",
+                (cantidad, viaje_local_id, cantidad)
+            ).fetchall()
+            if not filas:
+                existe = conn.execute("SELECT 1 FROM viaje_locales WHERE id = ?", (viaje_local_id,)).fetchone()
+                conn.execute("ROLLBACK")
+                return False, "Cantidad excede pendientes" if existe else "Registro no encontrado"
+            viaje_id, numero_local, local_id = filas[0]
+            conn.execute(
+                "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, local_id, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?,?)",
+                (viaje_id, viaje_local_id, numero_local, local_id, cantidad, "individual", usuario)
+            )
         return True, "Devolución registrada"
     except Exception as e:
         return False, f"Error: {e}"
@@ -89,49 +89,66 @@ def registrar_devolucion(viaje_local_id: int, cantidad: int, usuario: Optional[s
         conn.close()
 
 
+# Devolución masiva: un log por local con pendientes + un UPDATE, ambos sobre el índice por viaje_id
+_SQL_LOG_MASIVA = """
+    INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, local_id, cantidad, tipo, usuario)
+    SELECT viaje_id, id, numero_local, local_id, cajas_enviadas - COALESCE(cajas_devueltas, 0), 'masiva', ?
+    FROM viaje_locales
+    WHERE viaje_id = ? AND COALESCE(cajas_devueltas, 0) < cajas_enviadas
+    RETURNING cantidad
+"""
+_SQL_COMPLETAR_VIAJE = (
+    "UPDATE viaje_locales SET cajas_devueltas = cajas_enviadas "
+    "WHERE viaje_id = ? AND COALESCE(cajas_devueltas, 0) < cajas_enviadas"
+)
+
+
 def registrar_devolucion_todas_por_viaje(viaje_id: int, usuario: Optional[str] = None):
-    """Marca como devueltas todas las cajas pendientes del viaje, registrando una entrada por cada local con pendientes."""
-    conn = get_connection(); cur = conn.cursor()
+    """Marca como devueltas todas las cajas pendientes del viaje, registrando una entrada por cada local con pendientes.
+    Log y UPDATE van en una sola transacción sobre la misma conexión (dos sentencias, sin loop por local).
+    """
+    conn = get_connection()
     try:
-        cur.execute("SELECT id, numero_local, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE viaje_id = ?", (viaje_id,))
-        rows = cur.fetchall()
-        if not rows:
-            return False, "Viaje sin locales"
-        total_registros = 0
-        for (vl_id, numero_local, enviadas, devueltas) in rows:
-            enviadas = int(enviadas or 0); devueltas = int(devueltas or 0)
-            pendientes = enviadas - devueltas
-            if pendientes > 0:
-                cur.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_enviadas WHERE id = ?", (vl_id,))
-                total_registros += pendientes
-                _log_devolucion(viaje_id, vl_id, numero_local, pendientes, "masiva", usuario)
-        conn.commit()
-        return True, f"Devoluciones completadas ({total_registros} cajas)"
+        with write_transaction(conn, "viajes.devolucion_todas_por_viaje"):
+            cantidades = conn.execute(_SQL_LOG_MASIVA, (usuario, viaje_id)).fetchall()
+            if not cantidades:
+                tiene = conn.execute("SELECT 1 FROM viaje_locales WHERE viaje_id = ? LIMIT 1", (viaje_id,)).fetchone()
+                conn.execute("ROLLBACK")
+                return (True, "Devoluciones completadas (0 cajas)") if tiene else (False, "Viaje sin locales")
+            conn.execute(_SQL_COMPLETAR_VIAJE, (viaje_id,))
+        return True, f"Devoluciones completadas ({sum(c for (c,) in cantidades)} cajas)"
     except Exception as e:
         return False, f"Error: {e}"
     finally:
         conn.close()
 
 
-def listar_devoluciones_log(viaje_id: Optional[int] = None, fecha_desde: Optional[str] = None, fecha_hasta: Optional[str] = None, numero_local: Optional[str] = None):
-    """Devuelve un DataFrame con el historial de devoluciones (más reciente primero)."""
+def listar_devoluciones_log(viaje_id: Optional[int] = None, fecha_desde: Optional[str] = None, fecha_hasta: Optional[str] = None,
+                            numero_local: Optional[str] = None, local_id: Optional[int] = None):
+    """Devuelve un DataFrame con el historial de devoluciones (más reciente primero).
+    El filtro por local usa local_id (o el id de la etiqueta `numero_local`); numero_local se arma al leer.
+    """
     conn = get_connection()
     try:
         base = [
-            "SELECT dl.id, dl.created_at, dl.viaje_id, dl.viaje_local_id, dl.numero_local, dl.cantidad, dl.tipo, dl.usuario,",
+            f"SELECT dl.id, dl.created_at, dl.viaje_id, dl.viaje_local_id, dl.local_id, {sql_display('dl.numero_local')} AS numero_local,",
+            "       dl.cantidad, dl.tipo, dl.usuario,",
             "       vl.cajas_enviadas, vl.cajas_devueltas, (vl.cajas_enviadas - vl.cajas_devueltas) AS pendientes_actuales",
             "FROM devoluciones_log dl",
-            "JOIN viaje_locales vl ON dl.viaje_local_id = vl.id"
+            "JOIN viaje_locales vl ON dl.viaje_local_id = vl.id",
+            "LEFT JOIN reception_local rl ON rl.id = dl.local_id"
         ]
         filtros = []; params = []
         if viaje_id:
             filtros.append("dl.viaje_id = ?"); params.append(viaje_id)
         if fecha_desde:
-            filtros.append("date(dl.created_at) >= ?"); params.append(fecha_desde)
+            filtros.append("dl.created_at >= ?"); params.append(to_iso_date(fecha_desde))
         if fecha_hasta:
-            filtros.append("date(dl.created_at) <= ?"); params.append(fecha_hasta)
-        if numero_local:
-            filtros.append("dl.numero_local = ?"); params.append(numero_local)
+            filtros.append("dl.created_at < ?"); params.append(next_iso_date(fecha_hasta))
+        if local_id is not None:
+            filtros.append("dl.local_id = ?"); params.append(int(local_id))
+        elif numero_local:
+            filtros.append(f"dl.local_id = {SQL_ID_LOCAL}"); params.append(numero_local)
         if filtros:
             base.append("WHERE " + " AND ".join(filtros))
         base.append("ORDER BY dl.id DESC")
@@ -222,30 +239,29 @@ def viaje_agregar_local(viaje_id: int, numero_local_display: str, cajas_enviadas
         return False, "Cantidad inválida"
     try:
         conn = get_connection(); cur = conn.cursor()
-        cur.execute("SELECT 1 FROM viaje_locales WHERE viaje_id=? AND numero_local=?", (viaje_id, numero_local_display))
+        cur.execute(f"SELECT 1 FROM viaje_locales WHERE viaje_id=? AND local_id={SQL_ID_LOCAL}", (viaje_id, numero_local_display))
         if cur.fetchone():
             conn.close(); return False, "El local ya está en el viaje"
-        cur.execute(
-            "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,0)",
-            (viaje_id, numero_local_display, cajas_enviadas)
-        )
+        cur.execute(_SQL_INSERT_LOCAL, (viaje_id, numero_local_display, numero_local_display, cajas_enviadas))
         conn.commit(); conn.close(); return True, "Local agregado"
     except Exception as e:
         return False, f"Error: {e}"
 
 
 def viaje_eliminar_local(item_id: int):
+    conn = get_connection()
     try:
-        conn = get_connection(); cur = conn.cursor()
-        row = cur.execute("SELECT cajas_devueltas FROM viaje_locales WHERE id=?", (item_id,)).fetchone()
-        if not row:
-            conn.close(); return False, "Registro no existe"
-        if int(row[0] or 0) > 0:
-            conn.close(); return False, "No se puede eliminar: ya tiene devoluciones"
-        cur.execute("DELETE FROM viaje_locales WHERE id=?", (item_id,))
-        conn.commit(); conn.close(); return True, "Local eliminado"
+        with write_transaction(conn, "viajes.eliminar_local"):
+            cur = conn.execute("DELETE FROM viaje_locales WHERE id = ? AND COALESCE(cajas_devueltas, 0) = 0", (item_id,))
+            if cur.rowcount == 0:
+                existe = conn.execute("SELECT 1 FROM viaje_locales WHERE id = ?", (item_id,)).fetchone()
+                conn.execute("ROLLBACK")
+                return False, "No se puede eliminar: ya tiene devoluciones" if existe else "Registro no existe"
+        return True, "Local eliminado"
     except Exception as e:
         return False, f"Error: {e}"
+    finally:
+        conn.close()
 
 
 def crear_viaje_con_locales(fecha_viaje, chofer_id: int, items: list):
@@ -257,17 +273,14 @@ def crear_viaje_con_locales(fecha_viaje, chofer_id: int, items: list):
     try:
         conn = get_connection(); cur = conn.cursor()
         conn.execute("BEGIN")
-        cur.execute("INSERT INTO viajes (fecha_viaje, chofer_id, estado) VALUES (?,?,?)", (fecha_viaje, chofer_id, 'En Curso'))
+        cur.execute("INSERT INTO viajes (fecha_viaje, chofer_id, estado) VALUES (?,?,?)", (to_iso_date(fecha_viaje), chofer_id, 'En Curso'))
         viaje_id = cur.lastrowid
         for it in items:
             disp = it['display']
             cajas = int(it['cajas'])
             if cajas <= 0:
                 conn.execute("ROLLBACK"); conn.close(); return False, f"Cantidad inválida para {disp}"
-            cur.execute(
-                "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,0)",
-                (viaje_id, disp, cajas)
-            )
+            cur.execute(_SQL_INSERT_LOCAL, (viaje_id, disp, disp, cajas))
         conn.commit(); conn.close(); return True, f"Viaje #{viaje_id} creado"
     except Exception as e:
         try:
@@ -283,15 +296,12 @@ def crear_viaje(chofer_id: int, fecha_viaje, locales: list):
     (Se mantiene por compatibilidad con la interfaz antigua)."""
     conn = get_connection(); cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (?,?,?)", (chofer_id, fecha_viaje, 'En Curso'))
+        cur.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (?,?,?)", (chofer_id, to_iso_date(fecha_viaje), 'En Curso'))
         viaje_id = cur.lastrowid
         for local in locales:
             num = local.get('numero_local'); cajas = int(local.get('cajas_enviadas') or 0)
             if num and cajas > 0:
-                cur.execute(
-                    "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,0)",
-                    (viaje_id, num, cajas)
-                )
+                cur.execute(_SQL_INSERT_LOCAL, (viaje_id, num, num, cajas))
         conn.commit(); return viaje_id
     finally:
         conn.close()
@@ -304,3 +314,94 @@ def actualizar_estado_viaje(viaje_id: int, nuevo_estado: str):
         conn.commit(); return True
     finally:
         conn.close()
+
+
+# Totales por viaje (migración 11) recalculados desde viaje_locales
+_SQL_TOTALES_VIAJE_REAL = """
+    SELECT v.id, COUNT(vl.id), COALESCE(SUM(vl.cajas_enviadas), 0), COALESCE(SUM(COALESCE(vl.cajas_devueltas, 0)), 0)
+    FROM viajes v LEFT JOIN viaje_locales vl ON vl.viaje_id = v.id GROUP BY v.id
+"""
+
+
+def verificar_totales_viajes(reparar: bool = False) -> dict:
+    """Compara los totales guardados en viajes con los de viaje_locales.
+    Retorna {'ok', 'viajes', 'diferencias': {viaje_id: (guardado, real)}}; las tuplas son
+    (total_locales, total_enviadas, total_devueltas, pendientes). Con reparar=True
+    reescribe los totales de los viajes que difieren.
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE" if reparar else "BEGIN")
+        try:
+            guardado = {r[0]: tuple(r[1:]) for r in conn.execute(
+                "SELECT id, total_locales, total_enviadas, total_devueltas, pendientes FROM viajes"
+            ).fetchall()}
+            real = {r[0]: (r[1], r[2], r[3], r[2] - r[3]) for r in conn.execute(_SQL_TOTALES_VIAJE_REAL).fetchall()}
+            diferencias = {v: (guardado[v], real[v]) for v in sorted(real) if guardado[v] != real[v]}
+            if diferencias and reparar:
+                conn.executemany(
+                    "UPDATE viajes SET total_locales = ?, total_enviadas = ?, total_devueltas = ?, pendientes = ? WHERE id = ?",
+                    [(*real[v], v) for v in diferencias],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"ok": not diferencias, "viajes": len(real), "diferencias": diferencias}
+    finally:
+        conn.close()
+
+
+# Saldo real por local (backfill de la migración 13, verificación y reparación)
+SQL_PENDIENTES_LOCAL = """
+    SELECT t.local_id, t.etiqueta, t.viajes, t.enviadas, t.devueltas, t.enviadas - t.devueltas,
+           COALESCE(MAX(t.fecha, l.fecha), t.fecha, l.fecha)
+    FROM (
+        SELECT IFNULL(vl.local_id, 0) AS local_id,
+               CASE WHEN vl.local_id IS NULL THEN IFNULL(vl.numero_local, '') ELSE '' END AS etiqueta,
+               COUNT(*) AS viajes, SUM(vl.cajas_enviadas) AS enviadas,
+               SUM(COALESCE(vl.cajas_devueltas, 0)) AS devueltas, MAX(v.fecha_viaje) AS fecha
+        FROM viaje_locales vl LEFT JOIN viajes v ON v.id = vl.viaje_id
+        GROUP BY 1, 2
+    ) AS t LEFT JOIN (
+        SELECT IFNULL(local_id, 0) AS local_id,
+               CASE WHEN local_id IS NULL THEN IFNULL(numero_local, '') ELSE '' END AS etiqueta,
+               DATE(MAX(created_at)) AS fecha
+        FROM devoluciones_log GROUP BY 1, 2
+    ) AS l ON l.local_id = t.local_id AND l.etiqueta = t.etiqueta
+"""
+
+
+def verificar_pendientes_local(reparar: bool = False) -> dict:
+    """Compara pendientes_local con los saldos reales de viaje_locales / devoluciones_log.
+    Retorna {'ok', 'locales', 'diferencias': {clave: (guardado, real)}}; la clave es el local_id
+    (o la etiqueta de las filas sin local) y las tuplas son (viajes, enviadas, devueltas,
+    pendientes, ultimo_movimiento). Con reparar=True reescribe la tabla completa si difiere.
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE" if reparar else "BEGIN")
+        try:
+            vacio = (0, 0, 0, 0, None)
+            guardado = {r[0] or r[1]: tuple(r[2:]) for r in conn.execute(
+                "SELECT local_id, etiqueta, viajes, enviadas, devueltas, pendientes, ultimo_movimiento FROM pendientes_local"
+            ).fetchall()}
+            real = {r[0] or r[1]: tuple(r[2:]) for r in conn.execute(SQL_PENDIENTES_LOCAL).fetchall()}
+            diferencias = {
+                k: (guardado.get(k, vacio), real.get(k, vacio))
+                for k in sorted(set(guardado) | set(real), key=str)
+                if guardado.get(k, vacio) != real.get(k, vacio)
+            }
+            if diferencias and reparar:
+                conn.execute("DELETE FROM pendientes_local")
+                conn.execute(
+                    "INSERT INTO pendientes_local (local_id, etiqueta, viajes, enviadas, devueltas, pendientes, ultimo_movimiento) "
+                    + SQL_PENDIENTES_LOCAL
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {"ok": not diferencias, "locales": len(real), "diferencias": diferencias}
+    finally:
+        conn.close()
@@ -0,0 +1,402 @@
+"""Asesor de índices y chequeo de planes (EXPLAIN QUERY PLAN) para models y services.
+
+Crea una base temporal con datos representativos, ejecuta cada función de app/services y
+app/models con parámetros típicos capturando las sentencias SQL que emiten (via
+app.db.set_trace_callback), y analiza el plan de cada una:
+- marca recorridos completos (SCAN) sobre tablas con más de `min_rows` filas;
+- sugiere índices compuestos / de cobertura a partir de las columnas filtradas.
+
+HOT_QUERIES lista los escenarios críticos: check_hot_queries() (y `--check` por CLI)
+falla si alguno vuelve a hacer SCAN sobre una tabla grande.
+
+Uso:
+    python -m app.query_plans            # reporte completo
+    python -m app.query_plans --check    # exit 1 si un escenario crítico regresó a SCAN
+"""
+from __future__ import annotations
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app import db
+from app.config import ENV_CACHE_DISABLED, ENV_DB_PATH, ENV_DB_PRAGMAS, ENV_DB_TIMEOUT
+
+DEFAULT_ROWS = 2000      # viajes sembrados (el resto de las tablas escala a partir de este valor)
+DEFAULT_MIN_ROWS = 500   # tablas con menos filas no se reportan aunque se recorran completas
+
+# Escenarios que nunca deben recorrer completa una tabla grande
+HOT_QUERIES = [
+    "viajes.listar_viajes",
+    "viajes.viaje_locales",
+    "viajes.listar_devoluciones_log",
+    "cd.listar_despachos",
+    "cd.listar_envios_origen",
+    "cd.pendientes_por_destino",
+    "cd.pendientes_por_destino_resumen",
+    "cd.buscar_pendientes",
+    "cd.buscar_historial",
+    "cd.buscar_destino",
+    "cd.devolucion_por_destino",
+    "cd.devolucion_todas_por_destino",
+    "viajes.devoluciones_log_por_local",
+    "cd.totales",
+    "cd.crear_despacho",
+    "cd.enviar_a_origen",
+    "cd.actualizar_envio_origen",
+    "cd.aplicar_cambios_envios",
+    "cd.actualizar_despacho_detallado",
+    "cd.aplicar_cambios_historial",
+    "cd.resumen_por_cd",
+    "cd.stock_en_fecha",
+    "cd.stock_historial",
+]
+
+_SKIP_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "END", "SAVEPOINT", "RELEASE", "--", "EXPLAIN", "CREATE", "ANALYZE")
+_TABLE_REF = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+([A-Za-z_]\w*)(?:\s+(?:AS\s+)?([A-Za-z_]\w*))?", re.IGNORECASE)
+_VALOR = r"(?:\?|'|-?\d|NULL\b)"   # literal o parámetro (no otra columna)
+_SQL_WORDS = {"WHERE", "ON", "SET", "GROUP", "ORDER", "LEFT", "JOIN", "INNER", "VALUES", "LIMIT", "USING", "HAVING", "AS", "SELECT", "DEFAULT", "RETURNING"}
+
+
+@dataclass
+class StatementPlan:
+    escenario: str
+    sql: str
+    plan: List[str]
+    full_scans: List[Tuple[str, int]] = field(default_factory=list)
+    sugerencias: List[str] = field(default_factory=list)
+
+
+# ---------------------------------
+# Base temporal con datos representativos
+# ---------------------------------
+
+def _sembrar_datos(conn, rows: int, seed: int = 7):
+    rnd = random.Random(seed)
+    hoy = datetime.date.today()
+    conn.execute("BEGIN")
+    locales = [(1, "CD Central")] + [(n, f"Local {n}") for n in range(2, 151)]
+    conn.executemany("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (?,?,?)", [(n, nombre, int(n == 1)) for n, nombre in locales])
+    displays = [f"{n} - {nombre}" for n, nombre in locales]
+    cd_display = displays[0]
+    conn.executemany("INSERT INTO choferes (nombre) VALUES (?)", [(f"Chofer {i}",) for i in range(1, 21)])
+    conn.executemany("INSERT INTO users (username, password_hash, role) VALUES (?,?,?)", [("admin", "sha256$x", "admin")])
+    vl_id = 0
+    for viaje_id in range(1, rows + 1):
+        fecha = (hoy - datetime.timedelta(days=rnd.randint(0, 730))).isoformat()
+        estado = "En Curso" if rnd.random() < 0.1 else "Completado"
+        conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (?,?,?)", (rnd.randint(1, 20), fecha, estado))
+        destinos = [cd_display] + rnd.sample(displays[1:], 4)
+        for disp in destinos:
+            enviadas = rnd.randint(5, 60)
+            devueltas = enviadas if estado == "Completado" else rnd.randint(0, enviadas)
+            conn.execute(
+                "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,?)",
+                (viaje_id, disp, enviadas, devueltas)
+            )
+            vl_id += 1
+            if devueltas:
+                conn.execute(
+                    "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario, created_at) VALUES (?,?,?,?,?,?,?)",
+                    (viaje_id, vl_id, disp, devueltas, "individual", "admin", fecha + " 12:00:00")
+                )
+    for _ in range(rows * 2):
+        fecha = (hoy - datetime.timedelta(days=rnd.randint(0, 730))).isoformat()
+        enviadas = rnd.randint(1, 20)
+        devueltas = enviadas if rnd.random() < 0.8 else rnd.randint(0, enviadas)
+        conn.execute(
+            "INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,?,?)",
+            (cd_display, rnd.choice(displays[1:]), fecha, enviadas, devueltas)
+        )
+    for _ in range(rows // 2):
+        fecha = (hoy - datetime.timedelta(days=rnd.randint(0, 730))).isoformat()
+        conn.execute("INSERT INTO cd_envios_origen (fecha, cajas_enviadas) VALUES (?,?)", (fecha, rnd.randint(1, 5)))
+    conn.execute("COMMIT")
+
+
+@contextlib.contextmanager
+def base_temporal(rows: int = DEFAULT_ROWS):
+    """Apunta app.db a una base temporal migrada y sembrada; restaura la configuración al salir.
+
+    busy_timeout corto: aquí interesa el plan, no esperar locks (p.ej. el log de devoluciones
+    que abre una segunda conexión mientras la primera tiene la escritura).
+    Sin cache de lecturas: cada escenario tiene que llegar a la base para capturar su SQL.
+    """
+    claves = (ENV_DB_PATH, ENV_DB_PRAGMAS, ENV_DB_TIMEOUT, ENV_CACHE_DISABLED)
+    previos = {k: os.environ.get(k) for k in claves}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ[ENV_DB_PATH] = os.path.join(tmp, "query_plans.db")
+        os.environ[ENV_DB_PRAGMAS] = "busy_timeout=100"
+        os.environ[ENV_DB_TIMEOUT] = "0.1"
+        os.environ[ENV_CACHE_DISABLED] = "1"
+        try:
+            db.init_database()
+            conn = db.get_connection()
+            try:
+                _sembrar_datos(conn, rows)
+            finally:
+                conn.close()
+            yield os.environ[ENV_DB_PATH]
+        finally:
+            db.close_pool()
+            for k, v in previos.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+
+# ---------------------------------
+# Escenarios: funciones de models/services con parámetros representativos
+# ---------------------------------
+
+def _escenarios() -> List[Tuple[str, Callable[[], object]]]:
+    from app.services import stats_service, viajes_service, cd_service, locales_service, choferes_service, users_service
+    from app.models import viajes as mdl_viajes, locales as mdl_locales
+
+    hoy = datetime.date.today()
+    desde = hoy - datetime.timedelta(days=30)
+    conn = db.get_connection()
+    try:
+        viaje_id = conn.execute("SELECT id FROM viajes WHERE estado='En Curso' ORDER BY id LIMIT 1").fetchone()[0]
+        vl_id, vl_pend = conn.execute(
+            "SELECT id, cajas_enviadas - cajas_devueltas FROM viaje_locales WHERE viaje_id=? ORDER BY id LIMIT 1", (viaje_id,)
+        ).fetchone()
+        log_id = conn.execute("SELECT id FROM devoluciones_log ORDER BY id DESC LIMIT 1").fetchone()[0]
+        despacho_id, destino = conn.execute(
+            "SELECT id, destino_local FROM cd_despachos WHERE cajas_devueltas < cajas_enviadas ORDER BY id LIMIT 1"
+        ).fetchone()
+        envio_id = conn.execute("SELECT id FROM cd_envios_origen ORDER BY id DESC LIMIT 1").fetchone()[0]
+        local_display = conn.execute("SELECT numero_local FROM viaje_locales WHERE id=?", (vl_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    # Estado estable: la reconstrucción inicial del ledger cd_stock (CD recién detectado) es única
+    cd_service.cd_totales()
+    cd_service.cd_stock_en_fecha(hoy)
+
+    return [
+        # lecturas
+        ("stats.get_dashboard_stats", stats_service.get_dashboard_stats),
+        ("stats.get_pendientes_por_local", lambda: stats_service.get_pendientes_por_local(solo_pendientes=True)),
+        ("stats.dashboard_snapshot", stats_service.get_dashboard_snapshot),
+        ("viajes.listar_viajes", lambda: viajes_service.listar_viajes(fecha_desde=desde, fecha_hasta=hoy, estado="En Curso")),
+        ("viajes.viaje_locales", lambda: viajes_service.viaje_locales(viaje_id)),
+        ("viajes.listar_devoluciones_log", lambda: mdl_viajes.listar_devoluciones_log(fecha_desde=desde, fecha_hasta=hoy)),
+        ("viajes.devoluciones_log_por_local", lambda: mdl_viajes.listar_devoluciones_log(numero_local=local_display)),
+        ("cd.totales", cd_service.cd_totales),
+        ("cd.resumen_por_cd", cd_service.cd_resumen_por_cd),
+        ("cd.stock_en_fecha", lambda: cd_service.cd_stock_en_fecha(desde)),
+        ("cd.stock_historial", lambda: cd_service.cd_stock_historial(desde, hoy)),
+        ("cd.listar_despachos", lambda: cd_service.cd_listar_despachos(start_date=desde, end_date=hoy)),
+        ("cd.listar_envios_origen", lambda: cd_service.cd_listar_envios_origen(start_date=desde, end_date=hoy)),
+        ("cd.pendientes_por_destino", lambda: cd_service.cd_pendientes_por_destino(start_date=desde, end_date=hoy)),
+        ("cd.pendientes_por_destino_resumen", cd_service.cd_pendientes_por_destino),
+        ("cd.buscar_pendientes", lambda: cd_service.cd_buscar_despachos(estado="pendiente", cursor=(hoy.isoformat(), 10**9))),
+        ("cd.buscar_historial", lambda: cd_service.cd_buscar_despachos(start_date=desde, end_date=hoy, estado="completo")),
+        ("cd.buscar_destino", lambda: cd_service.cd_buscar_despachos(texto=destino[-6:], estado="pendiente")),
+        ("locales.catalogo", locales_service.get_catalogo_con_display),
+        ("locales.catalogo_modelo", mdl_locales.get_locales_catalogo),
+        ("choferes.listar", choferes_service.listar_choferes),
+        ("users.obtener_usuario", lambda: users_service.obtener_usuario("admin")),
+        # escrituras
+        ("viajes.registrar_devolucion", lambda: viajes_service.registrar_devolucion(vl_id, max(1, vl_pend))),
+        ("viajes.update_devueltas", lambda: viajes_service.update_devueltas_viaje_locales(viaje_id, [{"id": vl_id, "cajas_devueltas": 0}])),
+        ("viajes.actualizar_devolucion_log", lambda: mdl_viajes.actualizar_devolucion_log(log_id, 1)),
+        ("viajes.devolucion_todas_por_viaje", lambda: viajes_service.registrar_devolucion_todas_por_viaje(viaje_id)),
+        ("cd.crear_despacho", lambda: cd_service.cd_crear_despacho("1 - CD Central", destino, hoy, 1)),
+        ("cd.registrar_devolucion", lambda: cd_service.cd_registrar_devolucion(despacho_id, 1)),
+        ("cd.actualizar_despacho_detallado", lambda: cd_service.cd_actualizar_despacho_detallado(despacho_id, hoy, 20, 1)),
+        ("cd.aplicar_cambios_historial", lambda: cd_service.cd_aplicar_cambios_historial(
+            {"actualizar": [{"id": despacho_id, "fecha": hoy, "cajas_enviadas": 20, "cajas_devueltas": 2}]})),
+        ("cd.enviar_a_origen", lambda: cd_service.cd_enviar_a_origen(hoy, 1)),
+        ("cd.actualizar_envio_origen", lambda: cd_service.cd_actualizar_envio_origen(envio_id, hoy, 1)),
+        ("cd.aplicar_cambios_envios", lambda: cd_service.cd_aplicar_cambios_envios(
+            {"actualizar": [{"id": envio_id, "fecha": hoy, "cajas_enviadas": 2}]})),
+        ("cd.devolucion_por_destino", lambda: cd_service.cd_registrar_devolucion_por_destino(destino, 3)),
+        ("cd.devolucion_todas_por_destino", lambda: cd_service.cd_registrar_devolucion_todas_por_destino(destino)),
+        # al final: cambian los displays usados arriba
+        ("locales.renombrar", lambda: locales_service.actualizar_local(2, 2, "Local 2 renombrado")),
+        ("locales.renombrar_cd", lambda: locales_service.actualizar_local(1, 1, "CD Central renombrado")),
+    ]
+
+
+def capturar_sentencias() -> List[Tuple[str, str]]:
+    """Ejecuta los escenarios y devuelve [(escenario, sql)] sin duplicados por escenario."""
+    capturadas: List[Tuple[str, str]] = []
+    actual = {"nombre": ""}
+
+    def _tracer(sql: str):
+        texto = " ".join(sql.split())
+        if texto and not texto.upper().startswith(_SKIP_PREFIXES) and texto.upper() != "SELECT 1":
+            par = (actual["nombre"], texto)
+            if par not in capturadas:
+                capturadas.append(par)
+
+    escenarios = _escenarios()
+    db.set_trace_callback(_tracer)
+    try:
+        for nombre, fn in escenarios:
+            actual["nombre"] = nombre
+            try:
+                fn()
+            except Exception as e:  # un escenario roto no debe ocultar al resto
+                capturadas.append((nombre, f"-- error: {e}"))
+    finally:
+        db.set_trace_callback(None)
+    return capturadas
+
+
+# ---------------------------------
+# Análisis de planes
+# ---------------------------------
+
+def _alias_map(sql: str) -> Dict[str, str]:
+    alias = {}
+    for tabla, al in _TABLE_REF.findall(sql):
+        alias[tabla] = tabla
+        if al and al.upper() not in _SQL_WORDS:
+            alias[al] = tabla
+    return alias
+
+
+def _columnas_filtradas(sql: str, alias: str, tabla: str, columnas: List[str]) -> Tuple[List[str], List[str], List[str]]:
+    """Columnas de `tabla` comparadas contra un valor (igualdad / rango) y usadas en ORDER BY.
+    Heurístico por regex sobre el SQL expandido: comparaciones columna-columna no cuentan.
+    """
+    cuerpo = re.split(r"\bWHERE\b|\bON\b", sql, maxsplit=1, flags=re.IGNORECASE)
+    where = cuerpo[1] if len(cuerpo) > 1 else ""
+    prefijo = rf"(?:\b{re.escape(alias)}\.)?" if alias != tabla else rf"(?:\b{re.escape(tabla)}\.)?"
+    eq, rango, orden = [], [], []
+    for col in columnas:
+        c = re.escape(col)
+        if re.search(rf"{prefijo}\b{c}\s*(=\s*{_VALOR}|\bIN\s*\()", where, re.IGNORECASE):
+            eq.append(col)
+        elif re.search(rf"{prefijo}\b{c}\s*(>=|<=|<|>|\bBETWEEN\b|\bLIKE\b)\s*{_VALOR}", where, re.IGNORECASE):
+            rango.append(col)
+    m = re.search(r"\bORDER BY\b(.*?)(\bLIMIT\b|$)", sql, re.IGNORECASE)
+    if m:
+        for col in columnas:
+            if re.search(rf"{prefijo}\b{re.escape(col)}\b", m.group(1), re.IGNORECASE) and col not in eq + rango:
+                orden.append(col)
+    return eq, rango, orden
+
+
+def _sugerir_indice(conn, sql: str, alias: str, tabla: str) -> Optional[str]:
+    # La PK entera es el rowid: ya está implícita al final de todo índice
+    columnas = [r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall() if not r[5]]
+    eq, rango, orden = _columnas_filtradas(sql, alias, tabla, columnas)
+    clave = eq + rango[:1] + [c for c in orden if c not in rango[:1]]
+    if not clave:
+        return None
+    # Si la sentencia solo lee pocas columnas más, sugerir índice de cobertura
+    select = re.search(r"\bSELECT\b(.*?)\bFROM\b", sql, re.IGNORECASE | re.DOTALL)
+    extra = []
+    if select:
+        for col in columnas:
+            if col not in clave and re.search(rf"\b{re.escape(col)}\b", select.group(1)):
+                extra.append(col)
+    cols = clave + (extra if len(clave) + len(extra) <= 4 else [])
+    nombre = f"idx_{tabla}_" + "_".join(cols)
+    tipo = "cobertura" if extra and cols != clave else "compuesto" if len(cols) > 1 else "simple"
+    return f"CREATE INDEX IF NOT EXISTS {nombre} ON {tabla}({', '.join(cols)})  -- {tipo}"
+
+
+def analizar(capturadas: List[Tuple[str, str]], min_rows: int = DEFAULT_MIN_ROWS) -> List[StatementPlan]:
+    conn = db.get_connection()
+    try:
+        tablas = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall()]
+        # Recorrer un índice parcial solo visita las filas abiertas: no cuenta como SCAN completo
+        parciales = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql LIKE '% WHERE %'").fetchall()}
+        filas = {}
+        for t in tablas:
+            try:
+                filas[t] = int(conn.execute(f'SELECT COUNT(*) FROM "{t}"').fetchone()[0])
+            except Exception:
+                filas[t] = 0
+        resultado = []
+        for escenario, sql in capturadas:
+            if sql.startswith("-- error"):
+                resultado.append(StatementPlan(escenario, sql, ["ERROR"]))
+                continue
+            try:
+                plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+            except Exception as e:
+                resultado.append(StatementPlan(escenario, sql, [f"EXPLAIN falló: {e}"]))
+                continue
+            alias = _alias_map(sql)
+            sp = StatementPlan(escenario, sql, plan)
+            for linea in plan:
+                m = re.match(r"SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?", linea)
+                if not m or m.group(2) in parciales:
+                    continue
+                # Tabla virtual con restricción (p.ej. FTS5 MATCH: "INDEX 0:M1"): búsqueda en su índice
+                if re.search(r"VIRTUAL TABLE INDEX \d+:\S", linea):
+                    continue
+                tabla = alias.get(m.group(1), m.group(1))
+                if filas.get(tabla, 0) < min_rows:
+                    continue
+                sp.full_scans.append((tabla, filas[tabla]))
+                sug = _sugerir_indice(conn, sql, m.group(1), tabla)
+                if sug and sug not in sp.sugerencias:
+                    sp.sugerencias.append(sug)
+            resultado.append(sp)
+        return resultado
+    finally:
+        conn.close()
+
+
+def ejecutar(rows: int = DEFAULT_ROWS, min_rows: int = DEFAULT_MIN_ROWS) -> List[StatementPlan]:
+    """Siembra una base temporal, captura las sentencias de todos los escenarios y analiza sus planes."""
+    with base_temporal(rows):
+        return analizar(capturar_sentencias(), min_rows=min_rows)
+
+
+def check_hot_queries(planes: List[StatementPlan], hot: Optional[List[str]] = None) -> List[StatementPlan]:
+    """Sentencias de escenarios críticos que recorren completa una tabla grande (regresiones)."""
+    hot = HOT_QUERIES if hot is None else hot
+    return [p for p in planes if p.escenario in hot and (p.full_scans or p.plan == ["ERROR"])]
+
+
+def _imprimir(planes: List[StatementPlan]):
+    for p in planes:
+        marca = "SCAN" if p.full_scans else "ok"
+        print(f"[{marca}] {p.escenario}: {p.sql[:160]}")
+        for linea in p.plan:
+            print(f"        {linea}")
+        for tabla, n in p.full_scans:
+            print(f"    ! recorrido completo de {tabla} ({n} filas)")
+        for s in p.sugerencias:
+            print(f"    > {s}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN de todas las consultas de models/services")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="viajes a sembrar en la base temporal")
+    parser.add_argument("--min-rows", type=int, default=DEFAULT_MIN_ROWS, help="umbral de filas para reportar un SCAN")
+    parser.add_argument("--check", action="store_true", help="falla si un escenario de HOT_QUERIES hace SCAN")
+    parser.add_argument("--json", action="store_true", help="salida JSON")
+    args = parser.parse_args(argv)
+
+    planes = ejecutar(rows=args.rows, min_rows=args.min_rows)
+    regresiones = check_hot_queries(planes)
+    if args.json:
+        print(json.dumps([p.__dict__ for p in planes], ensure_ascii=False, indent=2))
+    else:
+        _imprimir(planes)
+        print(f"\n{len(planes)} sentencias, {sum(1 for p in planes if p.full_scans)} con SCAN sobre tablas >= {args.min_rows} filas")
+    if args.check and regresiones:
+        for p in regresiones:
+            print(f"REGRESIÓN {p.escenario}: {p.sql[:160]} -> {p.plan}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Cache en memoria de lecturas de services, invalidado por versión de tabla.
+
+- @cacheado("tabla", ..., ttl=None): guarda el resultado por función + argumentos (y base de
+  datos) junto con la versión de cada tabla de la que depende la lectura.
+- @invalida("tabla", ...) / invalidar(...): los services de escritura suben la versión de las
+  tablas que escriben; la próxima lectura que dependa de alguna vuelve a la base.
+- TTL por entrada y LRU con tamaño máximo (ver app.config.get_cache_settings).
+- cache_stats(): hits / misses / expirados / invalidados / desalojos por función.
+
+No depende de Streamlit: en el servidor lo comparten todas las sesiones del proceso y un job
+batch lo usa igual (o lo desactiva con CAJAS_PLASTICAS_CACHE_DISABLED=1). Las escrituras de
+otro proceso no suben las versiones de este: el TTL acota ese desfase.
+"""
+from __future__ import annotations
+import copy
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import pandas as pd
+
+from app.config import get_cache_settings, get_db_path
+
+# clave (db, función, args, kwargs) -> (valor, época + versiones de sus tablas, expira); orden = LRU
+_entradas: "OrderedDict[tuple, tuple]" = OrderedDict()
+_versiones: Dict[str, int] = {}
+_epoca = 0  # sube con invalidar() sin tablas: vence todo, incluso lecturas en curso
+_stats: Dict[str, Dict[str, int]] = {}
+_lock = threading.Lock()
+
+
+def _registrar(funcion: str, evento: str):
+    st = _stats.setdefault(funcion, {"hits": 0, "misses": 0, "expirados": 0, "invalidados": 0, "desalojos": 0})
+    st[evento] += 1
+
+
+def _copia(valor):
+    """El llamador puede modificar lo que recibe (la UI agrega columnas): nunca entregar el guardado."""
+    if isinstance(valor, pd.DataFrame):
+        return valor.copy()
+    if isinstance(valor, (list, dict)):
+        return copy.deepcopy(valor)
+    return valor
+
+
+def cacheado(*tablas: str, ttl: Optional[float] = None):
+    """Decorador para lecturas: cachea el resultado por argumentos mientras no cambie la versión
+    de `tablas` ni venza el TTL (`ttl` o el de la configuración). Argumentos no hashables no se
+    cachean. La función original queda en `.sin_cache`.
+    """
+    def decorador(fn):
+        nombre = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            ajustes = get_cache_settings()
+            if not ajustes.enabled:
+                return fn(*args, **kwargs)
+            clave = (get_db_path(), nombre, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(clave)
+            except TypeError:
+                return fn(*args, **kwargs)
+            ahora = time.monotonic()
+            with _lock:
+                # Versiones tomadas antes de leer: una escritura durante la lectura deja la entrada vencida
+                versiones = (_epoca,) + tuple(_versiones.get(t, 0) for t in tablas)
+                entrada = _entradas.get(clave)
+                if entrada is not None:
+                    valor, guardadas, expira = entrada
+                    if guardadas == versiones and ahora < expira:
+                        _entradas.move_to_end(clave)
+                        _registrar(nombre, "hits")
+                        return _copia(valor)
+                    del _entradas[clave]
+                    _registrar(nombre, "invalidados" if guardadas != versiones else "expirados")
+                _registrar(nombre, "misses")
+            valor = fn(*args, **kwargs)
+            with _lock:
+                _entradas[clave] = (valor, versiones, ahora + (ajustes.ttl if ttl is None else ttl))
+                _entradas.move_to_end(clave)
+                while len(_entradas) > max(ajustes.max_entries, 0):
+                    desalojada, _ = _entradas.popitem(last=False)
+                    _registrar(desalojada[1], "desalojos")
+            return _copia(valor)
+
+        envoltura.sin_cache = fn
+        envoltura.tablas = tablas
+        return envoltura
+    return decorador
+
+
+def invalidar(*tablas: str):
+    """Sube la versión de `tablas`; sin argumentos descarta todo el cache (p.ej. tras un borrado masivo)
+    y sube la época, así una lectura que empezó antes no guarda un resultado válido.
+    """
+    global _epoca
+    with _lock:
+        if not tablas:
+            _entradas.clear()
+            _epoca += 1
+        for t in tablas:
+            _versiones[t] = _versiones.get(t, 0) + 1
+
+
+def invalida(*tablas: str):
+    """Decorador para escrituras: al terminar (con o sin éxito) invalida las lecturas de `tablas`."""
+    def decorador(fn):
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                invalidar(*tablas)
+        return envoltura
+    return decorador
+
+
+def cache_stats() -> dict:
+    """Métricas por función cacheada (del proceso actual):
+    {funcion: {hits, misses, expirados, invalidados, desalojos, entradas, hit_ratio}}."""
+    with _lock:
+        datos = {f: dict(st, entradas=0) for f, st in _stats.items()}
+        for clave in _entradas:
+            if clave[1] in datos:
+                datos[clave[1]]["entradas"] += 1
+    for st in datos.values():
+        consultas = st["hits"] + st["misses"]
+        st["hit_ratio"] = st["hits"] / consultas if consultas else 0.0
+    return datos
+
+
+def reset_cache_stats():
+    with _lock:
+        _stats.clear()
@@ -1,66 +1,91 @@
+import json
 import pandas as pd
-from typing import Optional, Tuple
+from typing import Any, List, Optional, Tuple
 from datetime import date
 
-try:
-    from app.db import get_connection as get_connection
-except Exception:  # fallback minimal
-    import sqlite3, os
-    def get_connection():
-        return sqlite3.connect(os.getenv("CAJAS_PLASTICAS_DB", "cajas_plasticas.db"))
+from app.db import get_connection, to_iso_date, write_transaction, lock_stats
+from app.models import cd as mdl_cd, cd_stock
+from app.models.locales import SQL_ID_LOCAL, id_local, sql_display
+# Resolver de CDs con cache (marca es_cd); se invalida en las escrituras de locales_service
+from app.services.locales_service import get_cd_display as _get_cd_display, listar_cds as _listar_cds
+from app.services.cache import cacheado, invalida
 
-try:
-    from app.models.locales import get_locales_catalogo as mdl_get_locales_catalogo
-except Exception:
-    mdl_get_locales_catalogo = None
+# Tablas de las que sale el ledger cd_stock (lo mantienen sus triggers)
+_FUENTES_CD_STOCK = ("viaje_locales", "cd_despachos", "cd_envios_origen", "reception_local")
 
-# Helper interno para obtener catálogo de locales
 
-def _get_locales_catalogo():
-    if mdl_get_locales_catalogo:
-        try:
-            return mdl_get_locales_catalogo()
-        except Exception:
-            pass
-    # fallback directo a la BD (mínimo)
-    conn = get_connection()
-    try:
-        df = pd.read_sql_query("SELECT numero, nombre FROM locales ORDER BY numero", conn)
-    except Exception:
-        df = pd.DataFrame(columns=["numero", "nombre"])
-    finally:
-        conn.close()
-    return df
-
-
-def _get_cd_display():
-    catalogo_df = _get_locales_catalogo()
-    if catalogo_df.empty:
-        return None
-    for _, row in catalogo_df.iterrows():
-        nombre = str(row.get("nombre") or "")
-        if nombre and ("cd" in nombre.lower()):
-            numero = row.get("numero")
-            return f"{numero} - {nombre}" if nombre else str(numero)
-    return None
+def _rango_fechas(start_date=None, end_date=None):
+    """Fragmento ' AND fecha >= ? AND fecha <= ?' (según lo provisto) y sus parámetros ISO."""
+    sql = ""; params = []
+    if start_date:
+        sql += " AND fecha >= ?"; params.append(to_iso_date(start_date))
+    if end_date:
+        sql += " AND fecha <= ?"; params.append(to_iso_date(end_date))
+    return sql, params
 
 # =====================
 # CONSULTAS / RESÚMENES
 # =====================
 
+def _cd_o_principal(cd_local):
+    return cd_local or _get_cd_display()
+
+
+# Preparación fuera del lock de escritura: el CD se resuelve desde el cache de locales_service y
+# la fila del ledger se crea (si falta) en su propia transacción corta. Dentro de
+# write_transaction quedan solo lecturas por PK (fila + ledger) y la escritura.
+
+def _preparar_cd_de(conn, tabla: str, row_id) -> Tuple[bool, Optional[str]]:
+    """(existe, cd) de un despacho / envío, con la fila de ledger del CD ya creada."""
+    row = conn.execute(f"SELECT cd_local FROM {tabla} WHERE id = ?", (row_id,)).fetchone()
+    if row is None:
+        return False, None
+    cd = _cd_o_principal(row[0])
+    cd_stock.asegurar(conn, cd)
+    return True, cd
+
+
+def _filas_por_id(conn, tabla: str, columnas: str, ids) -> dict:
+    """{id: (columnas...)} de las filas pedidas en una sola consulta por PK."""
+    if not ids:
+        return {}
+    rows = conn.execute(
+        f"SELECT id, {columnas} FROM {tabla} WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps([int(i) for i in ids]),)
+    ).fetchall()
+    return {r[0]: r[1:] for r in rows}
+
+
+def _validar_stock_lote(conn, deltas: dict) -> List[str]:
+    """deltas {cd: variación neta de stock}; errores de los CDs que quedarían negativos."""
+    errores = []
+    for cd, delta in sorted(deltas.items(), key=lambda kv: str(kv[0])):
+        if delta >= 0:
+            continue
+        stock = cd_stock.leer(conn, cd)["stock"]
+        if stock + delta < 0:
+            errores.append(f"Stock insuficiente en {cd or 'CD'}: el lote descuenta {-delta} y hay {stock} disponibles")
+    return errores
+
+
+def cd_listar_cds():
+    """Displays de los CD configurados (el primero es el principal)."""
+    return _listar_cds()
+
+
+@cacheado(*_FUENTES_CD_STOCK)
 def cd_resumen_por_cd():
-    """Resumen por cada CD: enviadas, devueltas y pendientes."""
+    """Resumen por cada CD: enviadas, devueltas y pendientes (desde el ledger: una fila por CD)."""
     conn = get_connection()
     try:
         df = pd.read_sql_query(
             """
             SELECT cd_local,
-                   SUM(cajas_enviadas) AS enviadas,
-                   SUM(cajas_devueltas) AS devueltas,
-                   SUM(cajas_enviadas - cajas_devueltas) AS pendientes
-            FROM cd_despachos
-            GROUP BY cd_local
-            HAVING enviadas > 0
+                   enviados AS enviadas,
+                   devueltos AS devueltas,
+                   enviados - devueltos AS pendientes
+            FROM cd_stock
+            WHERE enviados > 0
             ORDER BY pendientes DESC
             """,
             conn
@@ -70,202 +95,254 @@ def cd_resumen_por_cd():
         conn.close()
 
 
-def cd_totales():
-    """Calcula totales y stock del CD detectado automáticamente."""
-    cd_disp = _get_cd_display()
-    recibido_viajes = 0
-    if cd_disp:
-        conn = get_connection()
-        try:
-            row = conn.execute(
-                "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-                (cd_disp,)
-            ).fetchone()
-            recibido_viajes = (row[0] or 0) if row else 0
-        finally:
-            conn.close()
-    conn = get_connection()
-    try:
-        row = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd = (row[0] or 0) if row else 0
-        devueltos = (row[1] or 0) if row else 0
-        row2 = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = (row2[0] or 0) if row2 else 0
-    finally:
-        conn.close()
-    entradas_totales = recibido_viajes + devueltos
-    stock = entradas_totales - enviados_cd - enviados_origen
-    if stock < 0:
-        stock = 0
-    return {
-        "cd": cd_disp,
-        "recibido_viajes": int(recibido_viajes),
-        "entradas_totales": int(entradas_totales),
-        "enviados": int(enviados_cd),
-        "enviados_origen": int(enviados_origen),
-        "devueltos": int(devueltos),
-        "stock": int(stock),
-    }
+def cd_lock_stats() -> pd.DataFrame:
+    """Espera y retención del lock de escritura por operación (ms, proceso actual)."""
+    filas = [
+        {
+            "operacion": op,
+            "ejecuciones": st["count"],
+            "rollbacks": st["rollbacks"],
+            "ocupado": st["busy"],
+            "espera_max_ms": round(st["wait_max"] * 1000, 2),
+            "lock_prom_ms": round(st["hold_avg"] * 1000, 2),
+            "lock_max_ms": round(st["hold_max"] * 1000, 2),
+        }
+        for op, st in sorted(lock_stats().items())
+    ]
+    return pd.DataFrame(filas)
+
+
+@cacheado(*_FUENTES_CD_STOCK)
+def cd_totales(cd_local: Optional[str] = None):
+    """Totales y stock de un CD (por defecto el principal); lectura O(1) del ledger cd_stock."""
+    datos = cd_stock.totales(_cd_o_principal(cd_local))
+    datos["stock"] = max(datos["stock"], 0)
+    return datos
+
+def cd_stock_en_fecha(fecha, cd_local: Optional[str] = None):
+    """Totales y stock de un CD al cierre de `fecha` (por defecto el CD principal).
+    Lee un snapshot de cd_stock_diario; movimientos imputados a la fecha del viaje / despacho / envío
+    y devueltas a la fecha en que se registraron (una devolución posterior no cambia días pasados).
+    """
+    datos = cd_stock.en_fecha(_cd_o_principal(cd_local), to_iso_date(fecha))
+    datos["stock"] = max(datos["stock"], 0)
+    return datos
+
+
+def cd_stock_historial(start_date=None, end_date=None, cd_local: Optional[str] = None) -> pd.DataFrame:
+    """Un registro por día con movimientos en el rango: movimientos del día (entradas = recibido
+    por viajes + devueltas, despachos, envios_origen) y stock al cierre. Para gráficos de tendencia.
+    """
+    desde = to_iso_date(start_date); hasta = to_iso_date(end_date)
+    filas = cd_stock.historial(_cd_o_principal(cd_local), desde, hasta)
+    columnas = ["fecha", "entradas", "recibido_viajes", "devueltas", "despachos", "envios_origen", "stock"]
+    if not filas:
+        return pd.DataFrame(columns=columnas)
+    df = pd.DataFrame(filas)
+    previo = df[["recibido_viajes", "devueltos", "enviados", "enviados_origen"]].shift(1).fillna(0)
+    movs = df[["recibido_viajes", "devueltos", "enviados", "enviados_origen"]] - previo
+    out = pd.DataFrame({
+        "fecha": df["fecha"],
+        "entradas": (movs["recibido_viajes"] + movs["devueltos"]).astype(int),
+        "recibido_viajes": movs["recibido_viajes"].astype(int),
+        "devueltas": movs["devueltos"].astype(int),
+        "despachos": movs["enviados"].astype(int),
+        "envios_origen": movs["enviados_origen"].astype(int),
+        "stock": df["stock"].astype(int),
+    })
+    # La primera fila previa a `desde` solo sirve de base para los movimientos del primer día
+    if desde:
+        out = out[out["fecha"] >= desde]
+    return out.reset_index(drop=True)
 
 # =====================
 # ENVÍOS A ORIGEN
 # =====================
 
-def cd_enviar_a_origen(fecha, cajas: int) -> Tuple[bool, str]:
+@invalida("cd_envios_origen")
+def cd_enviar_a_origen(fecha, cajas: int, cd_local: Optional[str] = None) -> Tuple[bool, str]:
     cajas = int(cajas)
     if cajas <= 0:
         return False, "La cantidad debe ser mayor a 0"
+    cd = _cd_o_principal(cd_local)
     conn = get_connection()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        cd_disp = _get_cd_display()
-        row_rec = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-            (cd_disp,)
-        ).fetchone() if cd_disp else (0,)
-        recibido = (row_rec[0] or 0)
-        row_cd = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd = (row_cd[0] or 0) if row_cd else 0
-        devueltos = (row_cd[1] or 0) if row_cd else 0
-        row_ori = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = (row_ori[0] or 0) if row_ori else 0
-        entradas_totales = recibido + devueltos
-        stock = entradas_totales - enviados_cd - enviados_origen
-        if cajas > stock:
-            conn.execute("ROLLBACK")
-            return False, f"Stock insuficiente. Disponible: {int(stock)}"
-        conn.execute(
-            "INSERT INTO cd_envios_origen (fecha, cajas_enviadas) VALUES (?, ?)",
-            (fecha, cajas)
-        )
-        conn.commit()
+        fecha_iso = to_iso_date(fecha)
+        cd_stock.asegurar(conn, cd)
+        with write_transaction(conn, "cd.enviar_a_origen"):
+            stock = cd_stock.leer(conn, cd)["stock"]
+            if cajas > stock:
+                conn.execute("ROLLBACK")
+                return False, f"Stock insuficiente. Disponible: {int(stock)}"
+            conn.execute(
+                "INSERT INTO cd_envios_origen (fecha, cajas_enviadas, cd_local) VALUES (?, ?, ?)",
+                (fecha_iso, cajas, cd)
+            )
         return True, "Envío al origen registrado"
     except Exception as e:
-        try: conn.execute("ROLLBACK")
-        except Exception: pass
         return False, f"Error al registrar envío al origen: {e}"
     finally:
         conn.close()
 
-def cd_listar_envios_origen(start_date=None, end_date=None):
+def cd_listar_envios_origen(start_date=None, end_date=None, cd_local=None):
     conn = get_connection()
     try:
         query = "SELECT id, fecha, cajas_enviadas FROM cd_envios_origen WHERE 1=1"
         params = []
+        if cd_local and cd_local != "Todos":
+            query += " AND cd_local = ?"; params.append(cd_local)
         if start_date:
-            query += " AND date(fecha) >= date(?)"; params.append(start_date)
+            query += " AND fecha >= ?"; params.append(to_iso_date(start_date))
         if end_date:
-            query += " AND date(fecha) <= date(?)"; params.append(end_date)
+            query += " AND fecha <= ?"; params.append(to_iso_date(end_date))
         query += " ORDER BY fecha DESC, id DESC"
         return pd.read_sql_query(query, conn, params=params)
     finally:
         conn.close()
 
+@invalida("cd_envios_origen")
 def cd_actualizar_envio_origen(envio_id, nueva_fecha, nuevas_cajas):
     nuevas_cajas = int(nuevas_cajas)
     if nuevas_cajas <= 0:
         return False, "La cantidad debe ser mayor a 0"
     conn = get_connection()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        row_cur = conn.execute(
-            "SELECT cajas_enviadas FROM cd_envios_origen WHERE id = ?",
-            (envio_id,)
-        ).fetchone()
-        if not row_cur:
-            conn.execute("ROLLBACK"); return False, "Envío no encontrado"
-        old_cajas = int(row_cur[0] or 0)
-        cd_disp = _get_cd_display()
-        row_rec = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-            (cd_disp,)
-        ).fetchone() if cd_disp else (0,)
-        recibido = int(row_rec[0] or 0)
-        row_cd = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd = int((row_cd[0] or 0) if row_cd else 0)
-        devueltos = int((row_cd[1] or 0) if row_cd else 0)
-        row_ori = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen WHERE id <> ?",
-            (envio_id,)
-        ).fetchone()
-        enviados_origen_otros = int((row_ori[0] or 0) if row_ori else 0)
-        entradas_totales = recibido + devueltos
-        stock_excl = entradas_totales - enviados_cd - enviados_origen_otros
-        if nuevas_cajas > stock_excl:
-            conn.execute("ROLLBACK"); return False, f"Stock insuficiente. Disponible: {int(stock_excl)}"
-        conn.execute(
-            "UPDATE cd_envios_origen SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_cajas, envio_id)
-        )
-        conn.commit(); return True, "Envío actualizado"
+        fecha_iso = to_iso_date(nueva_fecha)
+        existe, cd = _preparar_cd_de(conn, "cd_envios_origen", envio_id)
+        if not existe:
+            return False, "Envío no encontrado"
+        with write_transaction(conn, "cd.actualizar_envio_origen"):
+            row_cur = conn.execute(
+                "SELECT cajas_enviadas FROM cd_envios_origen WHERE id = ?",
+                (envio_id,)
+            ).fetchone()
+            if not row_cur:
+                conn.execute("ROLLBACK"); return False, "Envío no encontrado"
+            old_cajas = int(row_cur[0] or 0)
+            # El ledger del CD del envío lo incluye: se descuenta para validar la nueva cantidad
+            stock_excl = cd_stock.leer(conn, cd)["stock"] + old_cajas
+            if nuevas_cajas > stock_excl:
+                conn.execute("ROLLBACK"); return False, f"Stock insuficiente. Disponible: {int(stock_excl)}"
+            conn.execute(
+                "UPDATE cd_envios_origen SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
+                (fecha_iso, nuevas_cajas, envio_id)
+            )
+        return True, "Envío actualizado"
     except Exception as e:
-        try: conn.execute("ROLLBACK")
-        except Exception: pass
         return False, f"Error al actualizar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_envios_origen")
 def cd_eliminar_envio_origen(envio_id):
     conn = get_connection()
     try:
-        conn.execute("DELETE FROM cd_envios_origen WHERE id = ?", (envio_id,))
-        conn.commit(); return True, "Envío eliminado"
+        with write_transaction(conn, "cd.eliminar_envio_origen"):
+            conn.execute("DELETE FROM cd_envios_origen WHERE id = ?", (envio_id,))
+        return True, "Envío eliminado"
     except Exception as e:
         return False, f"Error al eliminar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_envios_origen")
+def cd_aplicar_cambios_envios(cambios: dict) -> Tuple[bool, str]:
+    """Aplica en una sola transacción las ediciones del historial de envíos a origen (PF).
+
+    cambios = {
+        'actualizar': [{'id', 'fecha', 'cajas_enviadas'}, ...],
+        'eliminar':   [id, ...],
+    }
+    Valida todo el lote (campos + stock neto por CD contra el ledger) y aplica todo o nada.
+    Retorna (ok, msg); si falla, msg trae un error por línea.
+    """
+    actualizar = list(cambios.get("actualizar") or [])
+    eliminar = sorted({int(i) for i in cambios.get("eliminar") or []})
+    if not (actualizar or eliminar):
+        return True, "Sin cambios"
+
+    errores = []; nuevos = {}
+    for c in actualizar:
+        rid = int(c["id"])
+        try:
+            fecha = to_iso_date(c["fecha"])
+        except ValueError as e:
+            errores.append(f"Envío #{rid}: {e}"); continue
+        cajas = int(c["cajas_enviadas"])
+        if cajas <= 0:
+            errores.append(f"Envío #{rid}: La cantidad debe ser mayor a 0")
+        elif rid in nuevos or rid in eliminar:
+            errores.append(f"Envío #{rid}: tiene más de un cambio en el lote")
+        else:
+            nuevos[rid] = (fecha, cajas)
+    if errores:
+        return False, "\n".join(errores)
+
+    ids = sorted(set(nuevos) | set(eliminar))
+    conn = get_connection()
+    try:
+        # Fuera del lock: CDs involucrados y sus filas de ledger
+        previos = _filas_por_id(conn, "cd_envios_origen", "cd_local", ids)
+        for cd in {_cd_o_principal(r[0]) for r in previos.values()}:
+            cd_stock.asegurar(conn, cd)
+        with write_transaction(conn, "cd.aplicar_cambios_envios"):
+            actuales = _filas_por_id(conn, "cd_envios_origen", "cajas_enviadas, cd_local", ids)
+            faltan = [rid for rid in ids if rid not in actuales]
+            if faltan:
+                conn.execute("ROLLBACK")
+                return False, "\n".join(f"Envío #{rid}: Envío no encontrado" for rid in faltan)
+            # Cada envío descuenta stock: editar aplica (vieja - nueva), eliminar devuelve la vieja
+            deltas = {}
+            for rid, (old, cd) in actuales.items():
+                old = int(old or 0)
+                delta = old - nuevos[rid][1] if rid in nuevos else old
+                cd = _cd_o_principal(cd)
+                deltas[cd] = deltas.get(cd, 0) + delta
+            errores = _validar_stock_lote(conn, deltas)
+            if errores:
+                conn.execute("ROLLBACK")
+                return False, "\n".join(errores)
+            conn.executemany(
+                "UPDATE cd_envios_origen SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
+                [(f, c, rid) for rid, (f, c) in nuevos.items()]
+            )
+            conn.executemany("DELETE FROM cd_envios_origen WHERE id = ?", [(rid,) for rid in eliminar])
+        partes = []
+        if nuevos:
+            partes.append(f"{len(nuevos)} actualizado(s)")
+        if eliminar:
+            partes.append(f"{len(eliminar)} eliminado(s)")
+        return True, "Envíos: " + ", ".join(partes)
+    except Exception as e:
+        return False, f"Error al aplicar cambios: {e}"
+    finally:
+        conn.close()
+
 # =====================
 # DESPACHOS CD
 # =====================
 
+@invalida("cd_despachos")
 def cd_crear_despacho(cd_local, destino_local, fecha, cajas_enviadas):
     cajas_enviadas = int(cajas_enviadas)
     if cajas_enviadas <= 0:
         return False, "Cantidad inválida"
+    cd_local = _cd_o_principal(cd_local)
     conn = get_connection()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        # Calcular stock disponible igual que en cd_totales
-        cd_disp = _get_cd_display()
-        recibido_viajes = 0
-        if cd_disp:
-            row_r = conn.execute(
-                "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-                (cd_disp,)
-            ).fetchone()
-            recibido_viajes = int((row_r[0] or 0) if row_r else 0)
-        row_cd = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd_total = int((row_cd[0] or 0) if row_cd else 0)
-        devueltos_total = int((row_cd[1] or 0) if row_cd else 0)
-        row_ori = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = int((row_ori[0] or 0) if row_ori else 0)
-        stock_disponible = (recibido_viajes + devueltos_total) - enviados_cd_total - enviados_origen
-        if cajas_enviadas > stock_disponible:
-            conn.execute("ROLLBACK")
-            return False, f"Stock insuficiente. Disponible: {stock_disponible}"
-        conn.execute(
-            "INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas) VALUES (?, ?, ?, ?)",
-            (cd_local, destino_local, fecha, cajas_enviadas)
-        )
-        conn.commit(); return True, "Despacho registrado"
+        fecha_iso = to_iso_date(fecha)
+        cd_stock.asegurar(conn, cd_local)
+        with write_transaction(conn, "cd.crear_despacho"):
+            stock_disponible = cd_stock.leer(conn, cd_local)["stock"]
+            if cajas_enviadas > stock_disponible:
+                conn.execute("ROLLBACK")
+                return False, f"Stock insuficiente. Disponible: {stock_disponible}"
+            conn.execute(
+                f"INSERT INTO cd_despachos (cd_local, destino_local, destino_id, fecha, cajas_enviadas) VALUES (?, ?, {SQL_ID_LOCAL}, ?, ?)",
+                (cd_local, destino_local, destino_local, fecha_iso, cajas_enviadas)
+            )
+        return True, "Despacho registrado"
     except Exception as e:
-        try: conn.execute("ROLLBACK")
-        except Exception: pass
         return False, f"Error: {e}"
     finally:
         conn.close()
@@ -273,89 +350,138 @@ def cd_crear_despacho(cd_local, destino_local, fecha, cajas_enviadas):
 def cd_listar_despachos(start_date=None, end_date=None, cd_local=None):
     conn = get_connection()
     try:
-        query = "SELECT * FROM cd_despachos WHERE 1=1"
+        # Display del destino armado al leer desde reception_local (destino_id)
+        query = (
+            f"SELECT d.id, d.cd_local, {sql_display('d.destino_local')} AS destino_local, d.destino_id, d.fecha,"
+            " d.cajas_enviadas, d.cajas_devueltas FROM cd_despachos d LEFT JOIN reception_local rl ON rl.id = d.destino_id WHERE 1=1"
+        )
         params = []
         if start_date:
-            query += " AND date(fecha) >= date(?)"; params.append(start_date)
+            query += " AND d.fecha >= ?"; params.append(to_iso_date(start_date))
         if end_date:
-            query += " AND date(fecha) <= date(?)"; params.append(end_date)
+            query += " AND d.fecha <= ?"; params.append(to_iso_date(end_date))
         if cd_local and cd_local != "Todos":
-            query += " AND cd_local = ?"; params.append(cd_local)
-        query += " ORDER BY fecha DESC, id DESC"
+            query += " AND d.cd_local = ?"; params.append(cd_local)
+        query += " ORDER BY d.fecha DESC, d.id DESC"
         return pd.read_sql_query(query, conn, params=params)
     finally:
         conn.close()
 
+DESPACHOS_POR_PAGINA = 50
+
+
+def _tiene_fts_despachos(conn) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cd_despachos_fts'"
+    ).fetchone() is not None
+
+
+def cd_buscar_despachos(start_date=None, end_date=None, cd_local=None, texto=None, estado=None,
+                        cursor=None, limite: int = DESPACHOS_POR_PAGINA) -> dict:
+    """Una página de despachos ordenada por fecha DESC, id DESC (paginación keyset).
+
+    texto: contenido en destino_local, sin distinguir mayúsculas (índice FTS5 trigram desde
+    3 caracteres; más corto o sin FTS5, LIKE sobre el rango filtrado).
+    estado: 'pendiente' | 'completo' | None (todos).
+    cursor: (fecha, id) devuelto como 'siguiente' por la página anterior; None = primera página.
+    Retorna {'filas': DataFrame (con columna pendientes), 'total': int, 'siguiente': cursor | None}.
+    """
+    where, params = _rango_fechas(start_date, end_date)
+    if cd_local and cd_local != "Todos":
+        where += " AND cd_local = ?"; params.append(cd_local)
+    # Mismo WHERE que idx_cd_despachos_abiertos_fecha para que SQLite use el índice parcial
+    if estado == "pendiente":
+        where += " AND cajas_devueltas < cajas_enviadas"
+    elif estado == "completo":
+        where += " AND cajas_devueltas >= cajas_enviadas"
+    texto = (texto or "").strip()
+    conn = get_connection()
+    try:
+        if texto:
+            if len(texto) >= 3 and _tiene_fts_despachos(conn):
+                where += " AND id IN (SELECT rowid FROM cd_despachos_fts WHERE cd_despachos_fts MATCH ?)"
+                params.append('"' + texto.replace('"', '""') + '"')
+            else:
+                where += " AND destino_local LIKE ? ESCAPE '\\'"
+                params.append("%" + texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        total = conn.execute("SELECT COUNT(*) FROM cd_despachos WHERE 1=1" + where, params).fetchone()[0]
+        pagina, pagina_params = where, list(params)
+        if cursor:
+            pagina += " AND (fecha, id) < (?, ?)"; pagina_params += [cursor[0], int(cursor[1])]
+        # La página se corta sobre cd_despachos; el display del destino se une solo a esas filas
+        df = pd.read_sql_query(
+            f"SELECT d.id, d.cd_local, {sql_display('d.destino_local')} AS destino_local, d.destino_id, d.fecha,"
+            " d.cajas_enviadas, d.cajas_devueltas, d.pendientes FROM ("
+            "SELECT id, cd_local, destino_local, destino_id, fecha, cajas_enviadas, COALESCE(cajas_devueltas, 0) AS cajas_devueltas,"
+            " cajas_enviadas - COALESCE(cajas_devueltas, 0) AS pendientes FROM cd_despachos WHERE 1=1"
+            + pagina + " ORDER BY fecha DESC, id DESC LIMIT ?"
+            ") d LEFT JOIN reception_local rl ON rl.id = d.destino_id ORDER BY d.fecha DESC, d.id DESC",
+            conn, params=pagina_params + [int(limite) + 1]
+        )
+    finally:
+        conn.close()
+    siguiente = None
+    if len(df) > limite:
+        df = df.iloc[:limite]
+        siguiente = (df["fecha"].iloc[-1], int(df["id"].iloc[-1]))
+    return {"filas": df, "total": int(total), "siguiente": siguiente}
+
+@invalida("cd_despachos")
 def cd_registrar_devolucion(despacho_id, cantidad):
     cantidad = int(cantidad)
     if cantidad <= 0:
         return False, "Cantidad inválida"
     conn = get_connection()
     try:
-        row = conn.execute(
-            "SELECT cajas_enviadas, cajas_devueltas FROM cd_despachos WHERE id = ?",
-            (despacho_id,)
-        ).fetchone()
-        if not row:
-            return False, "Despacho no encontrado"
-        envi, dev = row
-        pend = (envi or 0) - (dev or 0)
-        if cantidad > pend:
-            return False, "Excede pendientes"
-        conn.execute(
-            "UPDATE cd_despachos SET cajas_devueltas = cajas_devueltas + ? WHERE id = ?",
-            (cantidad, despacho_id)
-        )
-        conn.commit(); return True, "Devolución registrada"
+        with write_transaction(conn, "cd.registrar_devolucion"):
+            # Validación y escritura en una sola sentencia: dos operadores a la vez no pueden pasarse
+            cur = conn.execute(
+                "UPDATE cd_despachos SET cajas_devueltas = COALESCE(cajas_devueltas, 0) + ? "
+                "WHERE id = ? AND COALESCE(cajas_devueltas, 0) + ? <= cajas_enviadas",
+                (cantidad, despacho_id, cantidad)
+            )
+            if cur.rowcount == 0:
+                existe = conn.execute("SELECT 1 FROM cd_despachos WHERE id = ?", (despacho_id,)).fetchone()
+                conn.execute("ROLLBACK"); return False, "Excede pendientes" if existe else "Despacho no encontrado"
+        return True, "Devolución registrada"
     except Exception as e:
         return False, f"Error: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
 def cd_actualizar_despacho(despacho_id, nueva_fecha, nuevas_cajas):
     nuevas_cajas = int(nuevas_cajas)
     if nuevas_cajas <= 0:
         return False, "La cantidad enviada debe ser mayor a 0"
     conn = get_connection()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        row_cur = conn.execute(
-            "SELECT cajas_enviadas FROM cd_despachos WHERE id = ?",
-            (despacho_id,)
-        ).fetchone()
-        if not row_cur:
-            conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
-        old_enviadas = int(row_cur[0] or 0)
-        cd_disp = _get_cd_display()
-        row_rec = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-            (cd_disp,)
-        ).fetchone() if cd_disp else (0,)
-        recibido = int(row_rec[0] or 0)
-        row_cd = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd_total = int((row_cd[0] or 0) if row_cd else 0)
-        devueltos_total = int((row_cd[1] or 0) if row_cd else 0)
-        row_ori = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = int((row_ori[0] or 0) if row_ori else 0)
-        stock_actual = (recibido + devueltos_total) - enviados_cd_total - enviados_origen
-        if stock_actual + old_enviadas - nuevas_cajas < 0:
-            conn.execute("ROLLBACK"); return False, f"Stock insuficiente para {nuevas_cajas}. Disponible: {stock_actual + old_enviadas}"
-        conn.execute(
-            "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_cajas, despacho_id)
-        )
-        conn.commit(); return True, "Despacho actualizado"
+        fecha_iso = to_iso_date(nueva_fecha)
+        existe, cd = _preparar_cd_de(conn, "cd_despachos", despacho_id)
+        if not existe:
+            return False, "Despacho no encontrado"
+        with write_transaction(conn, "cd.actualizar_despacho"):
+            row_cur = conn.execute(
+                "SELECT cajas_enviadas FROM cd_despachos WHERE id = ?",
+                (despacho_id,)
+            ).fetchone()
+            if not row_cur:
+                conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
+            old_enviadas = int(row_cur[0] or 0)
+            stock_actual = cd_stock.leer(conn, cd)["stock"]
+            if stock_actual + old_enviadas - nuevas_cajas < 0:
+                conn.execute("ROLLBACK"); return False, f"Stock insuficiente para {nuevas_cajas}. Disponible: {stock_actual + old_enviadas}"
+            conn.execute(
+                "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ? WHERE id = ?",
+                (fecha_iso, nuevas_cajas, despacho_id)
+            )
+        return True, "Despacho actualizado"
     except Exception as e:
-        try: conn.execute("ROLLBACK")
-        except Exception: pass
         return False, f"Error al actualizar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
 def cd_actualizar_despacho_detallado(despacho_id, nueva_fecha, nuevas_enviadas, nuevas_devueltas):
     nuevas_enviadas = int(nuevas_enviadas)
     nuevas_devueltas = int(nuevas_devueltas)
@@ -367,152 +493,253 @@ def cd_actualizar_despacho_detallado(despacho_id, nueva_fecha, nuevas_enviadas,
         return False, "Las devueltas no pueden superar a las enviadas"
     conn = get_connection()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        row = conn.execute(
-            "SELECT cajas_enviadas, cajas_devueltas FROM cd_despachos WHERE id = ?",
-            (despacho_id,)
-        ).fetchone()
-        if not row:
-            conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
-        old_enviadas = int(row[0] or 0)
-        cd_disp = _get_cd_display()
-        row_rec = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM viaje_locales WHERE numero_local = ?",
-            (cd_disp,)
-        ).fetchone() if cd_disp else (0,)
-        recibido = int(row_rec[0] or 0)
-        row_cd = conn.execute(
-            "SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM cd_despachos"
-        ).fetchone()
-        enviados_cd_total = int((row_cd[0] or 0) if row_cd else 0)
-        devueltos_total = int((row_cd[1] or 0) if row_cd else 0)
-        row_ori = conn.execute(
-            "SELECT SUM(cajas_enviadas) FROM cd_envios_origen"
-        ).fetchone()
-        enviados_origen = int((row_ori[0] or 0) if row_ori else 0)
-        stock_actual = (recibido + devueltos_total) - enviados_cd_total - enviados_origen
-        if stock_actual + old_enviadas - nuevas_enviadas < 0:
-            conn.execute("ROLLBACK"); return False, f"Stock insuficiente para aumentar a {nuevas_enviadas}. Disponible: {stock_actual + old_enviadas}"
-        conn.execute(
-            "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ?, cajas_devueltas = ? WHERE id = ?",
-            (nueva_fecha, nuevas_enviadas, nuevas_devueltas, despacho_id)
-        )
-        conn.commit(); return True, "Despacho actualizado"
+        fecha_iso = to_iso_date(nueva_fecha)
+        existe, cd = _preparar_cd_de(conn, "cd_despachos", despacho_id)
+        if not existe:
+            return False, "Despacho no encontrado"
+        with write_transaction(conn, "cd.actualizar_despacho_detallado"):
+            row = conn.execute(
+                "SELECT cajas_enviadas FROM cd_despachos WHERE id = ?",
+                (despacho_id,)
+            ).fetchone()
+            if not row:
+                conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
+            old_enviadas = int(row[0] or 0)
+            stock_actual = cd_stock.leer(conn, cd)["stock"]
+            if stock_actual + old_enviadas - nuevas_enviadas < 0:
+                conn.execute("ROLLBACK"); return False, f"Stock insuficiente para aumentar a {nuevas_enviadas}. Disponible: {stock_actual + old_enviadas}"
+            conn.execute(
+                "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ?, cajas_devueltas = ? WHERE id = ?",
+                (fecha_iso, nuevas_enviadas, nuevas_devueltas, despacho_id)
+            )
+        return True, "Despacho actualizado"
     except Exception as e:
-        try: conn.execute("ROLLBACK")
-        except Exception: pass
         return False, f"Error al actualizar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
 def cd_eliminar_despacho(despacho_id):
     conn = get_connection()
     try:
-        row = conn.execute(
-            "SELECT cajas_devueltas FROM cd_despachos WHERE id = ?",
-            (despacho_id,)
-        ).fetchone()
-        if not row:
-            return False, "Despacho no encontrado"
-        if (row[0] or 0) > 0:
-            return False, "No se puede eliminar: ya tiene devoluciones registradas"
-        conn.execute("DELETE FROM cd_despachos WHERE id = ?", (despacho_id,))
-        conn.commit(); return True, "Despacho eliminado"
+        with write_transaction(conn, "cd.eliminar_despacho"):
+            cur = conn.execute(
+                "DELETE FROM cd_despachos WHERE id = ? AND COALESCE(cajas_devueltas, 0) = 0", (despacho_id,)
+            )
+            if cur.rowcount == 0:
+                existe = conn.execute("SELECT 1 FROM cd_despachos WHERE id = ?", (despacho_id,)).fetchone()
+                conn.execute("ROLLBACK")
+                return False, "No se puede eliminar: ya tiene devoluciones registradas" if existe else "Despacho no encontrado"
+        return True, "Despacho eliminado"
     except Exception as e:
         return False, f"Error al eliminar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
 def cd_eliminar_despacho_forzado(despacho_id):
     conn = get_connection()
     try:
-        conn.execute("DELETE FROM cd_despachos WHERE id = ?", (despacho_id,))
-        conn.commit(); return True, "Despacho eliminado (forzado)"
+        with write_transaction(conn, "cd.eliminar_despacho_forzado"):
+            conn.execute("DELETE FROM cd_despachos WHERE id = ?", (despacho_id,))
+        return True, "Despacho eliminado (forzado)"
     except Exception as e:
         return False, f"Error al eliminar: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
 def cd_revertir_despacho_a_pendiente(despacho_id):
     conn = get_connection()
     try:
-        row = conn.execute(
-            "SELECT cajas_enviadas, cajas_devueltas FROM cd_despachos WHERE id = ?",
-            (despacho_id,)
-        ).fetchone()
-        if not row:
-            return False, "Despacho no encontrado"
-        cajas_devueltas = int(row[1] or 0)
-        conn.execute(
-            "UPDATE cd_despachos SET cajas_devueltas = 0 WHERE id = ?",
-            (despacho_id,)
-        )
-        conn.commit(); return True, f"Despacho revertido a pendiente. {cajas_devueltas} cajas marcadas como no devueltas."
+        with write_transaction(conn, "cd.revertir_despacho"):
+            row = conn.execute(
+                "SELECT cajas_devueltas FROM cd_despachos WHERE id = ?",
+                (despacho_id,)
+            ).fetchone()
+            if not row:
+                conn.execute("ROLLBACK"); return False, "Despacho no encontrado"
+            cajas_devueltas = int(row[0] or 0)
+            conn.execute(
+                "UPDATE cd_despachos SET cajas_devueltas = 0 WHERE id = ?",
+                (despacho_id,)
+            )
+        return True, f"Despacho revertido a pendiente. {cajas_devueltas} cajas marcadas como no devueltas."
     except Exception as e:
         return False, f"Error al revertir: {e}"
     finally:
         conn.close()
 
+@invalida("cd_despachos")
+def cd_aplicar_cambios_historial(cambios: dict) -> Tuple[bool, str]:
+    """Aplica en una sola transacción las ediciones del historial de despachos.
+
+    cambios = {
+        'actualizar': [{'id', 'fecha', 'cajas_enviadas', 'cajas_devueltas'}, ...],
+        'revertir':   [id, ...],   # devueltas -> 0 (vuelve a pendiente)
+        'eliminar':   [id, ...],
+    }
+    Valida todo el lote (campos + stock neto por CD contra el ledger) y aplica todo o nada.
+    Retorna (ok, msg); si falla, msg trae un error por línea.
+    """
+    actualizar = list(cambios.get("actualizar") or [])
+    revertir = sorted({int(i) for i in cambios.get("revertir") or []})
+    eliminar = sorted({int(i) for i in cambios.get("eliminar") or []})
+    if not (actualizar or revertir or eliminar):
+        return True, "Sin cambios"
+
+    errores = []; nuevos = {}
+    for c in actualizar:
+        rid = int(c["id"])
+        try:
+            fecha = to_iso_date(c["fecha"])
+        except ValueError as e:
+            errores.append(f"Despacho #{rid}: {e}"); continue
+        env = int(c["cajas_enviadas"]); dev = int(c["cajas_devueltas"])
+        if env <= 0:
+            errores.append(f"Despacho #{rid}: La cantidad enviada debe ser mayor a 0")
+        elif dev < 0:
+            errores.append(f"Despacho #{rid}: La cantidad devuelta no puede ser negativa")
+        elif dev > env:
+            errores.append(f"Despacho #{rid}: Devueltas ({dev}) no pueden superar Enviadas ({env})")
+        else:
+            nuevos[rid] = (fecha, env, dev)
+    solapados = set(nuevos) & (set(revertir) | set(eliminar)) | set(revertir) & set(eliminar)
+    for rid in sorted(solapados):
+        errores.append(f"Despacho #{rid}: tiene más de un cambio en el lote")
+    if errores:
+        return False, "\n".join(errores)
+
+    ids = sorted(set(nuevos) | set(revertir) | set(eliminar))
+    conn = get_connection()
+    try:
+        # Fuera del lock: CDs involucrados y sus filas de ledger
+        previos = _filas_por_id(conn, "cd_despachos", "cd_local", ids)
+        for cd in {_cd_o_principal(r[0]) for r in previos.values()}:
+            cd_stock.asegurar(conn, cd)
+        with write_transaction(conn, "cd.aplicar_cambios_historial"):
+            actuales = _filas_por_id(conn, "cd_despachos", "cajas_enviadas, cajas_devueltas, cd_local", ids)
+            faltan = [rid for rid in ids if rid not in actuales]
+            if faltan:
+                conn.execute("ROLLBACK")
+                return False, "\n".join(f"Despacho #{rid}: Despacho no encontrado" for rid in faltan)
+            # stock = recibido + devueltos - enviados - enviados_origen: variación neta por CD
+            deltas = {}
+            for rid, (env_old, dev_old, cd) in actuales.items():
+                env_old = int(env_old or 0); dev_old = int(dev_old or 0)
+                if rid in nuevos:
+                    _f, env, dev = nuevos[rid]
+                    delta = (dev - dev_old) - (env - env_old)
+                elif rid in revertir:
+                    delta = -dev_old
+                else:
+                    delta = env_old - dev_old
+                cd = _cd_o_principal(cd)
+                deltas[cd] = deltas.get(cd, 0) + delta
+            errores = _validar_stock_lote(conn, deltas)
+            if errores:
+                conn.execute("ROLLBACK")
+                return False, "\n".join(errores)
+            conn.executemany(
+                "UPDATE cd_despachos SET fecha = ?, cajas_enviadas = ?, cajas_devueltas = ? WHERE id = ?",
+                [(f, e, d, rid) for rid, (f, e, d) in nuevos.items()]
+            )
+            conn.executemany("UPDATE cd_despachos SET cajas_devueltas = 0 WHERE id = ?", [(rid,) for rid in revertir])
+            conn.executemany("DELETE FROM cd_despachos WHERE id = ?", [(rid,) for rid in eliminar])
+        partes = []
+        if nuevos:
+            partes.append(f"{len(nuevos)} actualizado(s)")
+        if revertir:
+            partes.append(f"{len(revertir)} revertido(s) a pendiente")
+        if eliminar:
+            partes.append(f"{len(eliminar)} eliminado(s)")
+        return True, "Despachos: " + ", ".join(partes)
+    except Exception as e:
+        return False, f"Error al aplicar cambios: {e}"
+    finally:
+        conn.close()
+
 def cd_pendientes_por_destino(start_date=None, end_date=None):
+    """Destinos con cajas pendientes: destino_id, destino_local (display), enviadas, devueltas,
+    pendientes, abiertos (despachos sin completar) y primer_abierto (fecha del más antiguo), de
+    mayor a menor pendiente. Sin rango lee el resumen cd_pendientes_destino (una fila por destino,
+    migraciones 9 y 12); con rango agrega solo los despachos de esas fechas de los destinos con
+    algún abierto en el rango. Se agrupa por destino_id y el display se arma al leer.
+    """
     conn = get_connection()
     try:
-        query = "SELECT destino_local, SUM(cajas_enviadas) AS enviadas, SUM(cajas_devueltas) AS devueltas FROM cd_despachos WHERE 1=1"
-        params = []
-        if start_date:
-            query += " AND date(fecha) >= date(?)"; params.append(start_date)
-        if end_date:
-            query += " AND date(fecha) <= date(?)"; params.append(end_date)
-        query += " GROUP BY destino_local"
-        df = pd.read_sql_query(query, conn, params=params)
+        if not start_date and not end_date:
+            return pd.read_sql_query(
+                f"SELECT p.destino_id, {sql_display('NULL')} AS destino_local, p.enviadas, p.devueltas,"
+                " p.enviadas - p.devueltas AS pendientes, p.abiertos, p.primer_abierto"
+                " FROM cd_pendientes_destino p LEFT JOIN reception_local rl ON rl.id = p.destino_id"
+                " WHERE p.enviadas > p.devueltas ORDER BY pendientes DESC",
+                conn,
+            )
+        rango, params = _rango_fechas(start_date, end_date)
+        # Solo destinos con algún despacho abierto (índice parcial); luego totales de esos destinos
+        query = (
+            f"SELECT t.destino_id, {sql_display('NULL')} AS destino_local, t.enviadas, t.devueltas, t.pendientes,"
+            " t.abiertos, t.primer_abierto FROM ("
+            "SELECT destino_id, SUM(cajas_enviadas) AS enviadas, SUM(COALESCE(cajas_devueltas, 0)) AS devueltas,"
+            " SUM(cajas_enviadas) - SUM(COALESCE(cajas_devueltas, 0)) AS pendientes,"
+            " SUM(IFNULL(cajas_devueltas < cajas_enviadas, 0)) AS abiertos,"
+            " MIN(CASE WHEN cajas_devueltas < cajas_enviadas THEN fecha END) AS primer_abierto FROM cd_despachos"
+            " WHERE destino_id IN (SELECT DISTINCT destino_id FROM cd_despachos WHERE cajas_devueltas < cajas_enviadas" + rango + ")"
+            + rango + " GROUP BY destino_id HAVING pendientes > 0"
+            ") t LEFT JOIN reception_local rl ON rl.id = t.destino_id ORDER BY t.pendientes DESC"
+        )
+        return pd.read_sql_query(query, conn, params=params + params)
     finally:
         conn.close()
-    if df.empty:
-        return df
-    df["enviadas"] = df["enviadas"].fillna(0).astype(int)
-    df["devueltas"] = df["devueltas"].fillna(0).astype(int)
-    df["pendientes"] = df["enviadas"] - df["devueltas"]
-    df = df[df["pendientes"] > 0].sort_values("pendientes", ascending=False)
-    return df
-
-def cd_registrar_devolucion_por_destino(destino_display, cantidad):
-    restante = int(cantidad)
-    if restante <= 0:
-        return 0
+
+@invalida("cd_despachos")
+def cd_asignar_devolucion_por_destino(destino_display, cantidad) -> Tuple[bool, Any]:
+    """Registra `cantidad` devoluciones del destino repartidas FIFO (despachos más antiguos primero)
+    en una sola transacción. Retorna (True, detalle) con el detalle por despacho
+    [{'despacho_id', 'fecha', 'aplicado', 'pendientes_restantes'}] (vacío si no hay pendientes)
+    o (False, msg) si la escritura falla.
+    """
+    cantidad = int(cantidad)
+    if cantidad <= 0:
+        return True, []
     conn = get_connection()
     try:
-        rows = conn.execute(
-            """
-            SELECT id, cajas_enviadas, cajas_devueltas
-            FROM cd_despachos
-            WHERE destino_local = ? AND cajas_devueltas < cajas_enviadas
-            ORDER BY date(fecha) ASC, id ASC
-            """,
-            (destino_display,)
-        ).fetchall()
-        total_aplicado = 0
-        for rid, envi, dev in rows:
-            if restante <= 0:
-                break
-            pend = int(envi) - int(dev)
-            aplicar = min(pend, restante)
-            if aplicar > 0:
-                conn.execute(
-                    "UPDATE cd_despachos SET cajas_devueltas = cajas_devueltas + ? WHERE id = ?",
-                    (aplicar, rid)
-                )
-                restante -= aplicar
-                total_aplicado += aplicar
-        conn.commit(); return total_aplicado
+        with write_transaction(conn, "cd.devolucion_por_destino"):
+            return True, mdl_cd.asignar_devolucion_fifo(conn, destino_display, cantidad)
+    except Exception as e:
+        return False, f"Error al registrar devolución: {e}"
     finally:
         conn.close()
 
-def cd_registrar_devolucion_todas_por_destino(destino_display):
+def cd_registrar_devolucion_por_destino(destino_display, cantidad) -> Tuple[bool, Any]:
+    """(True, total aplicado) (puede ser menor a `cantidad` si no alcanzan los pendientes) o (False, msg)."""
+    ok, detalle = cd_asignar_devolucion_por_destino(destino_display, cantidad)
+    if not ok:
+        return False, detalle
+    return True, sum(d["aplicado"] for d in detalle)
+
+@invalida("cd_despachos")
+def cd_registrar_devolucion_todas_por_destino(destino_display) -> Tuple[bool, Any]:
+    """Marca como devueltos todos los despachos abiertos del destino; retorna (True, cajas aplicadas)
+    o (False, msg). Los pendientes salen del resumen por destino: sin pendientes no se toma el lock.
+    """
+    sql_pend = "SELECT enviadas - devueltas FROM cd_pendientes_destino WHERE destino_id = ?"
     conn = get_connection()
     try:
-        conn.execute(
-            "UPDATE cd_despachos SET cajas_devueltas = cajas_enviadas WHERE destino_local = ? AND cajas_devueltas < cajas_enviadas",
-            (destino_display,)
-        )
-        conn.commit()
+        destino_id = id_local(conn, destino_display)
+        row = conn.execute(sql_pend, (destino_id,)).fetchone() if destino_id is not None else None
+        if not row or row[0] <= 0:
+            return True, 0
+        with write_transaction(conn, "cd.devolucion_todas_por_destino"):
+            pendientes = conn.execute(sql_pend, (destino_id,)).fetchone()[0]
+            if pendientes > 0:
+                conn.execute(
+                    "UPDATE cd_despachos SET cajas_devueltas = cajas_enviadas WHERE destino_id = ? AND cajas_devueltas < cajas_enviadas",
+                    (destino_id,)
+                )
+        return True, max(int(pendientes), 0)
+    except Exception as e:
+        return False, f"Error al registrar devolución: {e}"
     finally:
         conn.close()
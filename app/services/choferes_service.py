@@ -2,20 +2,15 @@
 Encapsula acceso a la tabla choferes.
 """
 from __future__ import annotations
-import sqlite3, os
+import sqlite3
 from typing import List, Dict, Any, Tuple, Optional
 import pandas as pd
-
-_DB_FILENAME = "cajas_plasticas.db"
-
-def _get_db_path() -> str:
-    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), _DB_FILENAME)
-
-def get_connection() -> sqlite3.Connection:
-    return sqlite3.connect(_get_db_path(), check_same_thread=False)
+from app.db import get_connection
+from app.services.cache import cacheado, invalida
 
 # --- Query Helpers ---
 
+@cacheado("choferes")
 def listar_choferes(as_dataframe: bool = True):
     conn = get_connection()
     try:
@@ -28,6 +23,7 @@ def listar_choferes(as_dataframe: bool = True):
     finally:
         conn.close()
 
+@invalida("choferes")
 def crear_chofer(nombre: str, contacto: Optional[str] = None) -> Tuple[bool, str]:
     if not nombre or not nombre.strip():
         return False, "El nombre es requerido"
@@ -43,6 +39,7 @@ def crear_chofer(nombre: str, contacto: Optional[str] = None) -> Tuple[bool, str
     finally:
         conn.close()
 
+@invalida("choferes")
 def eliminar_chofer(chofer_id: int) -> Tuple[bool, str]:
     conn = get_connection(); cur = conn.cursor()
     try:
@@ -3,21 +3,15 @@
 Responsabilidades:
 - Encapsular CRUD sobre tabla reception_local
 - Proveer helpers de validación (numero_existe, siguiente_numero)
+- Resolver los CD (marca es_cd) con el cache de lecturas (app.services.cache), invalidado en cada escritura
 - Retornar resultados consistentes (ok, msg / data)
 """
 from __future__ import annotations
 import sqlite3
 from typing import List, Optional, Tuple, Dict, Any
-import os
-
-# Conexión reutilizable
-_DB_FILENAME = "cajas_plasticas.db"
-
-def _get_db_path() -> str:
-    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), _DB_FILENAME)
-
-def get_connection() -> sqlite3.Connection:
-    return sqlite3.connect(_get_db_path(), check_same_thread=False)
+from app.db import get_connection, write_transaction
+from app.models.locales import renombrar_etiquetas
+from app.services.cache import cacheado, invalida
 
 # --- helpers internos ---
 
@@ -41,22 +35,46 @@ def siguiente_numero() -> int:
     finally:
         conn.close()
 
+def _display(numero, nombre) -> str:
+    return f"{numero} - {nombre}" if nombre else str(numero)
+
+# --- CD ---
+
+@cacheado("reception_local")
+def listar_cds() -> List[str]:
+    """Displays 'numero - nombre' de los locales marcados es_cd, ordenados por número
+    (el primero es el CD principal). Cacheado hasta la próxima escritura de reception_local.
+    """
+    conn = get_connection(); cur = conn.cursor()
+    try:
+        rows = cur.execute("SELECT numero, nombre FROM reception_local WHERE es_cd = 1 ORDER BY numero").fetchall()
+    finally:
+        conn.close()
+    return [_display(r[0], r[1]) for r in rows]
+
+def get_cd_display() -> Optional[str]:
+    """Display del CD principal (primer local con es_cd = 1) o None."""
+    cds = listar_cds()
+    return cds[0] if cds else None
+
 # --- CRUD ---
 
+@cacheado("reception_local")
 def listar_locales() -> List[Dict[str, Any]]:
     conn = get_connection(); cur = conn.cursor()
     try:
-        rows = cur.execute("SELECT id, numero, nombre FROM reception_local ORDER BY numero").fetchall()
-        return [ {"id": r[0], "numero": r[1], "nombre": r[2]} for r in rows ]
+        rows = cur.execute("SELECT id, numero, nombre, es_cd FROM reception_local ORDER BY numero").fetchall()
+        return [ {"id": r[0], "numero": r[1], "nombre": r[2], "es_cd": bool(r[3])} for r in rows ]
     finally:
         conn.close()
 
-def crear_local(numero: int, nombre: str) -> Tuple[bool, str]:
+@invalida("reception_local")
+def crear_local(numero: int, nombre: str, es_cd: bool = False) -> Tuple[bool, str]:
     if numero_existe(numero):
         return False, "Ya existe un local con ese número"
     conn = get_connection(); cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO reception_local (numero, nombre) VALUES (?, ?)", (numero, nombre.strip()))
+        cur.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (?, ?, ?)", (numero, nombre.strip(), int(bool(es_cd))))
         conn.commit()
         return True, "Local agregado correctamente"
     except sqlite3.IntegrityError:
@@ -66,15 +84,26 @@ def crear_local(numero: int, nombre: str) -> Tuple[bool, str]:
     finally:
         conn.close()
 
-def actualizar_local(id_local: int, numero: int, nombre: str) -> Tuple[bool, str]:
+# Renombrar reescribe la etiqueta guardada en viajes, devoluciones y despachos
+@invalida("reception_local", "viaje_locales", "devoluciones_log", "cd_despachos", "cd_envios_origen")
+def actualizar_local(id_local: int, numero: int, nombre: str, es_cd: Optional[bool] = None) -> Tuple[bool, str]:
+    """es_cd=None conserva la marca actual. Si cambia el display, la etiqueta guardada en viajes,
+    devoluciones y despachos se reescribe en la misma transacción (historial unido por local_id).
+    """
     if numero_existe(numero, exclude_id=id_local):
         return False, "No se puede asignar un número ya usado"
     conn = get_connection(); cur = conn.cursor()
     try:
-        cur.execute("UPDATE reception_local SET numero=?, nombre=? WHERE id=?", (numero, nombre.strip(), id_local))
-        if cur.rowcount == 0:
-            return False, "Local no encontrado"
-        conn.commit()
+        with write_transaction(conn, "locales.actualizar"):
+            previo = cur.execute("SELECT numero, nombre FROM reception_local WHERE id=?", (id_local,)).fetchone()
+            if previo is None:
+                conn.execute("ROLLBACK")
+                return False, "Local no encontrado"
+            if es_cd is None:
+                cur.execute("UPDATE reception_local SET numero=?, nombre=? WHERE id=?", (numero, nombre.strip(), id_local))
+            else:
+                cur.execute("UPDATE reception_local SET numero=?, nombre=?, es_cd=? WHERE id=?", (numero, nombre.strip(), int(bool(es_cd)), id_local))
+            renombrar_etiquetas(conn, id_local, _display(*previo), _display(numero, nombre.strip()))
         return True, "Local editado correctamente"
     except sqlite3.IntegrityError:
         return False, "Número o nombre duplicado"
@@ -83,6 +112,7 @@ def actualizar_local(id_local: int, numero: int, nombre: str) -> Tuple[bool, str
     finally:
         conn.close()
 
+@invalida("reception_local")
 def eliminar_local(id_local: int) -> Tuple[bool, str]:
     conn = get_connection(); cur = conn.cursor()
     try:
@@ -91,6 +121,9 @@ def eliminar_local(id_local: int) -> Tuple[bool, str]:
             return False, "Local no encontrado"
         conn.commit()
         return True, "Local eliminado correctamente"
+    except sqlite3.IntegrityError:
+        # viaje_locales / devoluciones_log / cd_despachos lo referencian por id
+        return False, "No se puede eliminar: el local tiene viajes o despachos registrados"
     except Exception as e:
         return False, f"Error inesperado: {e}"
     finally:
@@ -98,14 +131,16 @@ def eliminar_local(id_local: int) -> Tuple[bool, str]:
 
 # --- API amigable para UI ---
 
+@cacheado("reception_local")
 def get_catalogo_con_display():
     data = listar_locales()
     # Añadir campo display reutilizable
     for d in data:
-        d["display"] = f"{d['numero']} - {d['nombre']}" if d['nombre'] else str(d['numero'])
+        d["display"] = _display(d['numero'], d['nombre'])
     return data
 
 __all__ = [
     "listar_locales","crear_local","actualizar_local","eliminar_local",
-    "numero_existe","siguiente_numero","get_catalogo_con_display"
+    "numero_existe","siguiente_numero","get_catalogo_con_display",
+    "get_cd_display","listar_cds"
 ]
@@ -2,48 +2,108 @@
 Separado para reducir tamaño del archivo principal y facilitar pruebas.
 """
 from __future__ import annotations
+from dataclasses import dataclass
 import pandas as pd
 from app.db import get_connection
+from app.models.locales import sql_display
+from app.services.cache import cacheado
 
+# Saldo por local mantenido por triggers (migración 13); el orden recorre idx_pendientes_local_pendientes
+_SQL_PENDIENTES_LOCAL = (
+    f"SELECT {sql_display('p.etiqueta')} AS local, p.enviadas, p.devueltas, p.pendientes, p.ultimo_movimiento"
+    " FROM pendientes_local p LEFT JOIN reception_local rl ON rl.id = p.local_id"
+)
+_COLUMNAS_PENDIENTES = ["local", "enviadas", "devueltas", "pendientes", "ultimo_movimiento"]
 
+# Tablas de las que salen las cifras (pendientes_local lo mantienen los triggers de las tres de viajes)
+_FUENTES_PENDIENTES = ("viajes", "viaje_locales", "devoluciones_log", "reception_local")
+
+
+@dataclass(frozen=True)
+class PendienteLocal:
+    local: str
+    enviadas: int
+    devueltas: int
+    pendientes: int
+    ultimo_movimiento: str | None
+
+
+@dataclass(frozen=True)
+class DashboardSnapshot:
+    """Cifras del dashboard y del resumen del sidebar leídas en una misma transacción."""
+    total_choferes: int = 0
+    viajes_activos: int = 0
+    total_enviadas: int = 0
+    total_devueltas: int = 0
+    pendientes: int = 0
+    pendientes_por_local: tuple[PendienteLocal, ...] = ()  # solo locales con pendientes, mayor primero
+
+    def pendientes_df(self) -> pd.DataFrame:
+        """pendientes_por_local como DataFrame (mismas columnas que get_pendientes_por_local)."""
+        return pd.DataFrame([vars(p) for p in self.pendientes_por_local], columns=_COLUMNAS_PENDIENTES)
+
+
+def _totales(cur) -> dict:
+    total_choferes = cur.execute("SELECT COUNT(*) FROM choferes").fetchone()[0]
+    viajes_activos = cur.execute("SELECT COUNT(*) FROM viajes WHERE estado='En Curso'").fetchone()[0]
+    # Saldo por local mantenido por triggers (migración 13): una fila por local, no por viaje
+    row = cur.execute("SELECT SUM(enviadas), SUM(devueltas) FROM pendientes_local").fetchone()
+    total_enviadas = int((row[0] or 0) if row else 0)
+    total_devueltas = int((row[1] or 0) if row else 0)
+    return {
+        'total_choferes': int(total_choferes or 0),
+        'viajes_activos': int(viajes_activos or 0),
+        'total_enviadas': total_enviadas,
+        'total_devueltas': total_devueltas,
+        'pendientes': max(total_enviadas - total_devueltas, 0),
+    }
+
+
+@cacheado("choferes", *_FUENTES_PENDIENTES)
 def get_dashboard_stats() -> dict:
     """Devuelve métricas globales para el dashboard principal.
     Retorna siempre claves: total_choferes, viajes_activos, total_enviadas, total_devueltas, pendientes.
     """
     conn = get_connection(); cur = conn.cursor()
     try:
-        total_choferes = cur.execute("SELECT COUNT(*) FROM choferes").fetchone()[0]
-        viajes_activos = cur.execute("SELECT COUNT(*) FROM viajes WHERE estado='En Curso'").fetchone()[0]
-        row = cur.execute("SELECT SUM(cajas_enviadas), SUM(cajas_devueltas) FROM viaje_locales").fetchone()
-        total_enviadas = int((row[0] or 0) if row else 0)
-        total_devueltas = int((row[1] or 0) if row else 0)
-        pendientes = total_enviadas - total_devueltas
-        if pendientes < 0:
-            pendientes = 0
-        return {
-            'total_choferes': int(total_choferes or 0),
-            'viajes_activos': int(viajes_activos or 0),
-            'total_enviadas': total_enviadas,
-            'total_devueltas': total_devueltas,
-            'pendientes': pendientes,
-        }
+        return _totales(cur)
     finally:
         conn.close()
 
 
-def get_pendientes_por_local() -> pd.DataFrame:
-    """Devuelve DataFrame con columnas: local, enviadas, devueltas, pendientes."""
+@cacheado(*_FUENTES_PENDIENTES)
+def get_pendientes_por_local(solo_pendientes: bool = False) -> pd.DataFrame:
+    """Devuelve DataFrame con columnas: local, enviadas, devueltas, pendientes, ultimo_movimiento,
+    ordenado por pendientes (mayor primero). solo_pendientes=True omite los locales sin pendientes.
+    """
     conn = get_connection()
     try:
-        df = pd.read_sql_query(
-            "SELECT numero_local AS local, SUM(cajas_enviadas) AS enviadas, SUM(cajas_devueltas) AS devueltas FROM viaje_locales GROUP BY numero_local",
-            conn
+        query = _SQL_PENDIENTES_LOCAL
+        if solo_pendientes:
+            query += " WHERE p.pendientes > 0"
+        query += " ORDER BY p.pendientes DESC"
+        return pd.read_sql_query(query, conn)
+    finally:
+        conn.close()
+
+
+@cacheado("choferes", *_FUENTES_PENDIENTES)
+def get_dashboard_snapshot() -> DashboardSnapshot:
+    """Métricas globales y detalle de pendientes por local en una sola transacción de lectura
+    (totales y detalle ven el mismo estado aunque otra sesión escriba en el medio).
+    La UI lo calcula una vez por rerun y lo comparten el sidebar y el dashboard.
+    """
+    conn = get_connection(); cur = conn.cursor()
+    try:
+        cur.execute("BEGIN")
+        try:
+            totales = _totales(cur)
+            filas = cur.execute(_SQL_PENDIENTES_LOCAL + " WHERE p.pendientes > 0 ORDER BY p.pendientes DESC").fetchall()
+        finally:
+            cur.execute("COMMIT")
+        return DashboardSnapshot(
+            **totales,
+            pendientes_por_local=tuple(PendienteLocal(*fila) for fila in filas),
         )
     finally:
         conn.close()
-    if df.empty:
-        return df
-    df['enviadas'] = df['enviadas'].fillna(0).astype(int)
-    df['devueltas'] = df['devueltas'].fillna(0).astype(int)
-    df['pendientes'] = df['enviadas'] - df['devueltas']
-    return df
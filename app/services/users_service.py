@@ -2,24 +2,17 @@
 Incluye: creación, listado, actualización, cambio de contraseña, autenticación básica.
 """
 from __future__ import annotations
-import sqlite3, os, hashlib
+import sqlite3, hashlib
 try:
     import bcrypt  # bcrypt para hashing fuerte
     _BCRYPT_AVAILABLE = True
 except Exception:
     _BCRYPT_AVAILABLE = False
 from typing import List, Dict, Any, Optional, Tuple
-
-_DB_FILENAME = "cajas_plasticas.db"
+from app.db import get_connection
 
 ROLES_VALIDOS = ("admin", "cd_only", "no_cd_edit")
 
-def _get_db_path() -> str:
-    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), _DB_FILENAME)
-
-def get_connection():
-    return sqlite3.connect(_get_db_path(), check_same_thread=False)
-
 # --- hashing ---
 
 def _legacy_sha256(pw: str) -> str:
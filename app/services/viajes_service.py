@@ -10,7 +10,9 @@ Usa modelos si están disponibles (para futura modularización completa) y cae a
 from __future__ import annotations
 import pandas as pd
 from typing import Optional, Iterable
-from app.db import get_connection
+from app.db import get_connection, to_iso_date, write_transaction
+from app.models.locales import SQL_ID_LOCAL, sql_display
+from app.services.cache import invalida
 
 # Imports opcionales de modelos (si existen) -----------------
 try:
@@ -44,24 +46,21 @@ def listar_viajes(fecha_desde=None, fecha_hasta=None, chofer_id=None, estado=Non
     params = []
     query = """
         SELECT v.id, v.fecha_viaje, v.estado, c.nombre as chofer,
-               COUNT(vl.id) AS total_locales,
-               SUM(vl.cajas_enviadas) AS total_enviadas,
-               SUM(vl.cajas_devueltas) AS total_devueltas,
-               SUM(vl.cajas_enviadas - vl.cajas_devueltas) AS pendientes
+               v.total_locales, v.total_enviadas, v.total_devueltas, v.pendientes
         FROM viajes v
         LEFT JOIN choferes c ON v.chofer_id = c.id
-        LEFT JOIN viaje_locales vl ON vl.viaje_id = v.id
         WHERE 1=1
     """
     if fecha_desde:
-        query += " AND date(v.fecha_viaje) >= date(?)"; params.append(fecha_desde)
+        query += " AND v.fecha_viaje >= ?"; params.append(to_iso_date(fecha_desde))
     if fecha_hasta:
-        query += " AND date(v.fecha_viaje) <= date(?)"; params.append(fecha_hasta)
+        query += " AND v.fecha_viaje <= ?"; params.append(to_iso_date(fecha_hasta))
     if chofer_id is not None:
         query += " AND v.chofer_id = ?"; params.append(chofer_id)
     if estado and estado != "Todos":
         query += " AND v.estado = ?"; params.append(estado)
-    query += " GROUP BY v.id ORDER BY v.fecha_viaje DESC, v.id DESC"
+    # Totales mantenidos por triggers (migración 11); el orden recorre idx_viajes_fecha
+    query += " ORDER BY v.fecha_viaje DESC, v.id DESC"
     df = pd.read_sql_query(query, conn, params=params)
     conn.close()
     if df.empty:
@@ -79,13 +78,15 @@ def viaje_locales(viaje_id: int) -> pd.DataFrame:
             pass
     conn = get_connection()
     df = pd.read_sql_query(
-        "SELECT id, numero_local, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE viaje_id = ? ORDER BY id",
+        f"SELECT vl.id, vl.local_id, {sql_display('vl.numero_local')} AS numero_local, vl.cajas_enviadas, vl.cajas_devueltas"
+        " FROM viaje_locales vl LEFT JOIN reception_local rl ON rl.id = vl.local_id WHERE vl.viaje_id = ? ORDER BY vl.id",
         conn,
         params=[viaje_id]
     )
     conn.close()
     return df
 
+@invalida("viajes", "viaje_locales")
 def crear_viaje(chofer_id: int, fecha_viaje, locales: Iterable[dict]):
     if mdl_crear_viaje:
         try:
@@ -94,19 +95,20 @@ def crear_viaje(chofer_id: int, fecha_viaje, locales: Iterable[dict]):
             pass
     conn = get_connection(); cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (?,?,?)", (chofer_id, fecha_viaje, 'En Curso'))
+        cur.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (?,?,?)", (chofer_id, to_iso_date(fecha_viaje), 'En Curso'))
         viaje_id = cur.lastrowid
         for local in locales:
             num = local.get('numero_local'); cajas = int(local.get('cajas_enviadas') or 0)
             if num and cajas > 0:
                 cur.execute(
-                    "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,0)",
-                    (viaje_id, num, cajas)
+                    f"INSERT INTO viaje_locales (viaje_id, numero_local, local_id, cajas_enviadas, cajas_devueltas) VALUES (?,?,{SQL_ID_LOCAL},?,0)",
+                    (viaje_id, num, num, cajas)
                 )
         conn.commit(); return viaje_id
     finally:
         conn.close()
 
+@invalida("viajes", "viaje_locales")
 def eliminar_viaje(viaje_id: int):
     if mdl_eliminar_viaje:
         try:
@@ -123,6 +125,7 @@ def eliminar_viaje(viaje_id: int):
     finally:
         conn.close()
 
+@invalida("viajes")
 def actualizar_estado_viaje(viaje_id: int, nuevo_estado: str):
     if mdl_actualizar_estado_viaje:
         try:
@@ -135,6 +138,7 @@ def actualizar_estado_viaje(viaje_id: int, nuevo_estado: str):
 
 # Devoluciones ------------------------------------------------
 
+@invalida("viaje_locales", "devoluciones_log")
 def registrar_devolucion(viaje_local_id: int, cantidad: int, usuario: Optional[str] = None):
     if mdl_registrar_devolucion:
         try:
@@ -146,25 +150,29 @@ def registrar_devolucion(viaje_local_id: int, cantidad: int, usuario: Optional[s
         return False, "Cantidad inválida"
     conn = get_connection(); cur = conn.cursor()
     try:
-        row = cur.execute("SELECT viaje_id, cajas_enviadas, cajas_devueltas, numero_local FROM viaje_locales WHERE id=?", (viaje_local_id,)).fetchone()
-        if not row:
-            return False, "Ítem de viaje no encontrado"
-        viaje_id, envi, dev, numero_local = row
-        pend = (envi or 0) - (dev or 0)
-        if pend <= 0:
-            return False, "Sin pendientes"
-        aplicar = min(pend, cantidad)
-        cur.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_devueltas + ? WHERE id=?", (aplicar, viaje_local_id))
+        cur.execute("BEGIN IMMEDIATE")
+        # Control de pendientes en el WHERE (y CHECK de la tabla): sin lectura previa
+        filas = cur.execute(
+            "UPDATE viaje_locales SET cajas_devueltas = COALESCE(cajas_devueltas, 0) + ? "
+            "WHERE id = ? AND COALESCE(cajas_devueltas, 0) + ? <= cajas_enviadas "
+            "RETURNING viaje_id, numero_local, local_id",
+            (cantidad, viaje_local_id, cantidad)
+        ).fetchall()
+        if not filas:
+            existe = cur.execute("SELECT 1 FROM viaje_locales WHERE id = ?", (viaje_local_id,)).fetchone()
+            conn.rollback(); return False, "Cantidad excede pendientes" if existe else "Ítem de viaje no encontrado"
+        viaje_id, numero_local, local_id = filas[0]
         cur.execute(
-            "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?)",
-            (viaje_id, viaje_local_id, numero_local, aplicar, 'manual', usuario)
+            "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, local_id, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?,?)",
+            (viaje_id, viaje_local_id, numero_local, local_id, cantidad, 'manual', usuario)
         )
-        conn.commit(); return True, f"Registradas {aplicar} cajas"
+        conn.commit(); return True, f"Registradas {cantidad} cajas"
     except Exception as e:
-        return False, f"Error: {e}"
+        conn.rollback(); return False, f"Error: {e}"
     finally:
         conn.close()
 
+@invalida("viaje_locales", "devoluciones_log")
 def registrar_devolucion_todas_por_viaje(viaje_id: int, usuario: Optional[str] = None):
     if mdl_registrar_devolucion_todas_por_viaje:
         try:
@@ -173,62 +181,78 @@ def registrar_devolucion_todas_por_viaje(viaje_id: int, usuario: Optional[str] =
             pass
     conn = get_connection(); cur = conn.cursor()
     try:
-        rows = cur.execute("SELECT id, cajas_enviadas, cajas_devueltas, numero_local FROM viaje_locales WHERE viaje_id=?", (viaje_id,)).fetchall()
-        total = 0
-        for rid, envi, dev, numero_local in rows:
-            pend = (envi or 0) - (dev or 0)
-            if pend > 0:
-                cur.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_devueltas + ? WHERE id=?", (pend, rid))
-                cur.execute(
-                    "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?)",
-                    (viaje_id, rid, numero_local, pend, 'masiva', usuario)
-                )
-                total += pend
-        conn.commit(); return True, f"{total} cajas registradas"
+        cur.execute("BEGIN IMMEDIATE")
+        # Un log por local con pendientes y un UPDATE: dos sentencias en una transacción
+        cantidades = cur.execute(
+            "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, local_id, cantidad, tipo, usuario) "
+            "SELECT viaje_id, id, numero_local, local_id, cajas_enviadas - COALESCE(cajas_devueltas, 0), 'masiva', ? "
+            "FROM viaje_locales WHERE viaje_id = ? AND COALESCE(cajas_devueltas, 0) < cajas_enviadas RETURNING cantidad",
+            (usuario, viaje_id)
+        ).fetchall()
+        cur.execute(
+            "UPDATE viaje_locales SET cajas_devueltas = cajas_enviadas WHERE viaje_id = ? AND COALESCE(cajas_devueltas, 0) < cajas_enviadas",
+            (viaje_id,)
+        )
+        conn.commit(); return True, f"{sum(c for (c,) in cantidades)} cajas registradas"
     except Exception as e:
-        return False, f"Error: {e}"
+        conn.rollback(); return False, f"Error: {e}"
     finally:
         conn.close()
 
+@invalida("viaje_locales")
 def update_devueltas_viaje_locales(viaje_id: int, items: list[dict]):
     """Actualiza en lote cajas_devueltas para los locales del viaje.
     items: [{'id': viaje_local_id, 'cajas_devueltas': int}]
     Reglas:
       - 0 <= cajas_devueltas <= cajas_enviadas
       - Ignora ítems sin cambios
-      - Operación atómica
+      - Operación atómica: un SELECT de los locales del viaje, validación vectorizada y un executemany
     No registra log adicional (solo conserva los logs de devoluciones previas).
+    Retorna (True, msg) o (False, msg); si algún ítem es inválido no se aplica ninguno y retorna
+    (False, [{'id', 'motivo'}]) con un motivo por ítem rechazado.
     """
     if not items:
         return False, "Sin cambios"
-    conn = get_connection(); cur = conn.cursor()
+    errores = []; filas = []
+    for it in items:
+        try:
+            filas.append((int(it.get('id')), int(it.get('cajas_devueltas', 0))))
+        except (TypeError, ValueError):
+            errores.append({'id': it.get('id'), 'motivo': "datos inválidos"})
+    lote = pd.DataFrame(filas, columns=["id", "nuevas"])
+    conn = get_connection()
     try:
-        cur.execute("BEGIN")
-        actualizados = 0
-        for it in items:
-            try:
-                rid = int(it.get('id'))
-                dev_new = int(it.get('cajas_devueltas', 0))
-            except Exception:
-                conn.rollback(); return False, "Datos inválidos"
-            row = cur.execute("SELECT cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE id=? AND viaje_id=?", (rid, viaje_id)).fetchone()
-            if not row:
-                conn.rollback(); return False, f"Item {rid} no pertenece al viaje"
-            envi, dev_old = row
-            envi = int(envi or 0); dev_old = int(dev_old or 0)
-            if dev_new < 0 or dev_new > envi:
-                conn.rollback(); return False, f"Devueltas inválidas para item {rid}"
-            if dev_new != dev_old:
-                cur.execute("UPDATE viaje_locales SET cajas_devueltas=? WHERE id=?", (dev_new, rid))
-                actualizados += 1
-        conn.commit();
+        with write_transaction(conn, "viajes.update_devueltas"):
+            actuales = pd.read_sql_query(
+                "SELECT id, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE viaje_id = ?", conn, params=[viaje_id]
+            ).set_index("id").reindex(lote["id"])
+            ajenos = actuales["cajas_enviadas"].isna().to_numpy()
+            enviadas = actuales["cajas_enviadas"].fillna(0).astype(int).to_numpy()
+            previas = actuales["cajas_devueltas"].fillna(0).astype(int).to_numpy()
+            nuevas = lote["nuevas"].to_numpy()
+            fuera = ~ajenos & ((nuevas < 0) | (nuevas > enviadas))
+            duplicados = lote["id"].duplicated(keep=False).to_numpy()
+            # Motivo por fila a partir de las máscaras (la última asignación tiene prioridad)
+            motivos = pd.Series("", index=lote.index)
+            motivos[fuera] = ("devueltas (" + lote["nuevas"].astype(str) + ") deben estar entre 0 y "
+                              + pd.Series(enviadas, index=lote.index).astype(str))[fuera]
+            motivos[ajenos] = "no pertenece al viaje"
+            motivos[duplicados] = "tiene más de un cambio en el lote"
+            rechazados = (motivos != "").to_numpy()
+            errores += lote.loc[rechazados, ["id"]].assign(motivo=motivos[rechazados]).drop_duplicates().to_dict("records")
+            if errores:
+                conn.execute("ROLLBACK")
+                return False, errores
+            cambios = nuevas != previas
+            conn.executemany(
+                "UPDATE viaje_locales SET cajas_devueltas = ? WHERE id = ? AND viaje_id = ?",
+                [(dev, rid, viaje_id) for dev, rid in zip(nuevas[cambios].tolist(), lote["id"][cambios].tolist())],
+            )
+        actualizados = int(cambios.sum())
         if actualizados == 0:
             return False, "Sin cambios"
         return True, f"{actualizados} locales actualizados"
     except Exception as e:
-        conn.rollback(); return False, f"Error: {e}"
+        return False, f"Error: {e}"
     finally:
         conn.close()
-
-
-
@@ -0,0 +1,165 @@
+"""Benchmark: "entregar todas" de un viaje (loop por local vs. INSERT ... SELECT + UPDATE).
+
+Para cada tamaño de `--locales` crea un viaje con ese número de locales pendientes y aplica la
+devolución masiva sobre copias idénticas de la base con tres métodos:
+
+- anterior: UPDATE por local y el log en una conexión nueva por local mientras la primera
+  retiene el lock de escritura (cada log espera `--timeout-anterior` y se pierde en silencio;
+  en la app esa espera es busy_timeout = 5 s por local)
+- loop en una transacción: mismo loop, con el log en la misma conexión
+- set-based: app.models.viajes.registrar_devolucion_todas_por_viaje (2 sentencias)
+
+Verifica que loop y set-based dejen el mismo estado (devueltas y log).
+
+Uso:
+    python benchmarks/devolucion_viaje.py [--locales 50 200] [--repeticiones 5] [--timeout-anterior 0.05]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import ENV_DB_PATH  # noqa: E402
+from app import db  # noqa: E402
+
+
+def _sembrar(path: str, locales: int) -> int:
+    os.environ[ENV_DB_PATH] = path
+    db.init_database()
+    conn = db.get_connection()
+    try:
+        rnd = random.Random(42)
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer Benchmark')")
+        conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (last_insert_rowid(), '2024-01-01', 'En Curso')")
+        viaje_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        filas = []
+        for n in range(locales):
+            enviadas = rnd.randint(1, 40)
+            filas.append((viaje_id, f"{n + 2} - Local {n + 2}", enviadas, rnd.randint(0, enviadas - 1)))
+        conn.executemany(
+            "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, ?)", filas
+        )
+        conn.execute("COMMIT")
+        return viaje_id
+    finally:
+        conn.close()
+        db.close_pool()
+
+
+def _anterior(path: str, viaje_id: int, timeout: float):
+    """Implementación anterior: log best effort en otra conexión con el lock tomado por la primera."""
+    conn = sqlite3.connect(path, timeout=timeout)
+    try:
+        rows = conn.execute(
+            "SELECT id, numero_local, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE viaje_id = ?", (viaje_id,)
+        ).fetchall()
+        for vl_id, numero_local, enviadas, devueltas in rows:
+            pendientes = int(enviadas or 0) - int(devueltas or 0)
+            if pendientes > 0:
+                conn.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_enviadas WHERE id = ?", (vl_id,))
+                log = sqlite3.connect(path, timeout=timeout)
+                try:
+                    log.execute(
+                        "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?)",
+                        (viaje_id, vl_id, numero_local, pendientes, "masiva", None),
+                    )
+                    log.commit()
+                except sqlite3.Error:
+                    pass  # "database is locked": el log se perdía en silencio
+                finally:
+                    log.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _loop(path: str, viaje_id: int, _timeout: float):
+    """Mismo loop por local con el log en la misma transacción (sin conflicto de lock)."""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT id, numero_local, cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE viaje_id = ?", (viaje_id,)
+        ).fetchall()
+        for vl_id, numero_local, enviadas, devueltas in rows:
+            pendientes = int(enviadas or 0) - int(devueltas or 0)
+            if pendientes > 0:
+                conn.execute("UPDATE viaje_locales SET cajas_devueltas = cajas_enviadas WHERE id = ?", (vl_id,))
+                conn.execute(
+                    "INSERT INTO devoluciones_log (viaje_id, viaje_local_id, numero_local, cantidad, tipo, usuario) VALUES (?,?,?,?,?,?)",
+                    (viaje_id, vl_id, numero_local, pendientes, "masiva", None),
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _set_based(path: str, viaje_id: int, _timeout: float):
+    from app.models.viajes import registrar_devolucion_todas_por_viaje
+    os.environ[ENV_DB_PATH] = path
+    try:
+        ok, msg = registrar_devolucion_todas_por_viaje(viaje_id)
+        if not ok:
+            raise RuntimeError(msg)
+    finally:
+        db.close_pool()
+
+
+def _estado(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        return (
+            conn.execute("SELECT id, cajas_devueltas FROM viaje_locales ORDER BY id").fetchall(),
+            conn.execute("SELECT viaje_local_id, cantidad, tipo FROM devoluciones_log ORDER BY viaje_local_id").fetchall(),
+        )
+    finally:
+        conn.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--locales", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--timeout-anterior", type=float, default=0.05,
+                        help="espera de lock del log anterior (s); en la app es 5 s")
+    args = parser.parse_args(argv)
+
+    metodos = (("anterior", _anterior), ("loop en una transacción", _loop), ("set-based", _set_based))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.locales:
+            base = os.path.join(tmp, f"base_{n}.db")
+            viaje_id = _sembrar(base, n)
+            print(f"\nviaje con {n} locales pendientes")
+            estados = {}
+            for nombre, fn in metodos:
+                mejor = None
+                # el método anterior es lento por diseño: una sola corrida alcanza
+                for _ in range(1 if fn is _anterior else args.repeticiones):
+                    copia = os.path.join(tmp, "copia.db")
+                    for sufijo in ("", "-wal", "-shm"):
+                        if os.path.exists(copia + sufijo):
+                            os.remove(copia + sufijo)
+                    shutil.copyfile(base, copia)
+                    t0 = time.perf_counter()
+                    fn(copia, viaje_id, args.timeout_anterior)
+                    dt = time.perf_counter() - t0
+                    mejor = dt if mejor is None else min(mejor, dt)
+                estados[nombre] = _estado(copia)
+                logs = len(estados[nombre][1])
+                print(f"  {nombre:<24} {mejor * 1000:9.1f} ms   logs escritos: {logs}")
+            iguales = estados["loop en una transacción"] == estados["set-based"]
+            print(f"  loop y set-based dejan el mismo estado: {iguales}")
+            if not iguales:
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
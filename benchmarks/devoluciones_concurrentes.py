@@ -0,0 +1,138 @@
+"""Prueba de concurrencia: varios operadores registrando devoluciones sobre el mismo ítem.
+
+Siembra un viaje con un local y un despacho del CD con `--cajas` enviadas cada uno y lanza
+`--hilos` escritores que registran devoluciones de 1..3 cajas hasta que el servicio las rechaza.
+Verifica que nunca se devuelva más de lo enviado, que lo aceptado coincida con lo guardado
+(y con devoluciones_log) y que el CHECK de la tabla rechace un UPDATE directo excedido.
+Exit 1 si algo no cuadra.
+
+Uso:
+    python benchmarks/devoluciones_concurrentes.py [--hilos 8] [--cajas 500]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import ENV_DB_PATH  # noqa: E402
+from app import db  # noqa: E402
+
+CD = "1 - CD Concurrencia"
+DESTINO = "2 - Local Concurrencia"
+
+
+def _sembrar(path: str, cajas: int):
+    os.environ[ENV_DB_PATH] = path
+    db.init_database()
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD Concurrencia', 1)")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (2, 'Local Concurrencia')")
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer Concurrencia')")
+        conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (last_insert_rowid(), '2024-01-01', 'En Curso')")
+        viaje_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.execute(
+            "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, 0)",
+            (viaje_id, CD, cajas * 2),
+        )
+        conn.execute(
+            "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, 0)",
+            (viaje_id, DESTINO, cajas),
+        )
+        vl_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.execute(
+            "INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas) VALUES (?, ?, '2024-01-02', ?, 0)",
+            (CD, DESTINO, cajas),
+        )
+        despacho_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.execute("COMMIT")
+        return vl_id, despacho_id
+    finally:
+        conn.close()
+
+
+def _operador(semilla: int, registrar, item_id: int, aceptadas: list, rechazos: list, barrera):
+    rnd = random.Random(semilla)
+    barrera.wait()
+    seguidos = 0
+    while seguidos < 3:
+        cant = rnd.randint(1, 3)
+        try:
+            ok, msg = registrar(item_id, cant)
+        except sqlite3.OperationalError as e:  # busy: cuenta como rechazo
+            ok, msg = False, str(e)
+        if ok:
+            aceptadas.append(cant); seguidos = 0
+        else:
+            rechazos.append(msg); seguidos += 1
+
+
+def _correr(nombre: str, registrar, item_id: int, hilos: int) -> list:
+    aceptadas: list = []; rechazos: list = []
+    barrera = threading.Barrier(hilos)
+    ts = [threading.Thread(target=_operador, args=(i, registrar, item_id, aceptadas, rechazos, barrera)) for i in range(hilos)]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    print(f"{nombre}: {len(aceptadas)} devoluciones aceptadas ({sum(aceptadas)} cajas), "
+          f"{len(rechazos)} rechazos en {time.perf_counter() - t0:.2f} s")
+    for msg in sorted(set(rechazos)):
+        print(f"  rechazo: {msg}")
+    return aceptadas
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--cajas", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    from app.models.viajes import registrar_devolucion as vl_registrar
+    from app.services.cd_service import cd_registrar_devolucion
+
+    fallas = []
+    with tempfile.TemporaryDirectory() as tmp:
+        vl_id, despacho_id = _sembrar(os.path.join(tmp, "concurrencia.db"), args.cajas)
+        acept_vl = _correr("viaje_locales", lambda i, c: vl_registrar(i, c, usuario="bench"), vl_id, args.hilos)
+        acept_cd = _correr("cd_despachos", cd_registrar_devolucion, despacho_id, args.hilos)
+
+        conn = db.get_connection()
+        try:
+            env, dev = conn.execute("SELECT cajas_enviadas, cajas_devueltas FROM viaje_locales WHERE id = ?", (vl_id,)).fetchone()
+            log = conn.execute("SELECT COALESCE(SUM(cantidad), 0) FROM devoluciones_log WHERE viaje_local_id = ?", (vl_id,)).fetchone()[0]
+            if dev > env or dev != sum(acept_vl) or log != dev:
+                fallas.append(f"viaje_locales: enviadas={env} devueltas={dev} aceptadas={sum(acept_vl)} log={log}")
+            env, dev = conn.execute("SELECT cajas_enviadas, cajas_devueltas FROM cd_despachos WHERE id = ?", (despacho_id,)).fetchone()
+            if dev > env or dev != sum(acept_cd):
+                fallas.append(f"cd_despachos: enviadas={env} devueltas={dev} aceptadas={sum(acept_cd)}")
+            for tabla, rid in (("viaje_locales", vl_id), ("cd_despachos", despacho_id)):
+                try:
+                    conn.execute(f"UPDATE {tabla} SET cajas_devueltas = cajas_enviadas + 1 WHERE id = ?", (rid,))
+                    fallas.append(f"{tabla}: el CHECK no rechazó devueltas > enviadas")
+                except sqlite3.IntegrityError as e:
+                    print(f"{tabla}: UPDATE directo excedido rechazado ({e})")
+                conn.rollback()
+        finally:
+            conn.close()
+        db.close_pool()
+
+    for f in fallas:
+        print(f"FALLA {f}")
+    if fallas:
+        return 1
+    print("OK: ninguna devolución excedió lo enviado")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Benchmark: devolución FIFO por destino (loop por fila vs. UPDATE ... FROM con suma corrida).
+
+Crea una base temporal con `--abiertos` despachos abiertos para un mismo destino, aplica la misma
+devolución con ambos métodos sobre copias idénticas y verifica que el resultado sea el mismo.
+
+Uso:
+    python benchmarks/fifo_devoluciones.py [--abiertos 10000] [--repeticiones 5]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import ENV_DB_PATH  # noqa: E402
+from app import db  # noqa: E402
+
+DESTINO = "2 - Local Benchmark"
+
+
+def _sembrar(path: str, abiertos: int):
+    os.environ[ENV_DB_PATH] = path
+    db.init_database()
+    conn = db.get_connection()
+    try:
+        rnd = random.Random(42)
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD', 1)")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (2, 'Local Benchmark')")
+        filas = []
+        for i in range(abiertos):
+            enviadas = rnd.randint(1, 20)
+            filas.append(("1 - CD", DESTINO, f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}", enviadas, rnd.randint(0, enviadas - 1)))
+        conn.executemany(
+            "INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas) VALUES (?,?,?,?,?)", filas
+        )
+        conn.execute("COMMIT")
+        return conn.execute(
+            "SELECT SUM(cajas_enviadas - cajas_devueltas) FROM cd_despachos WHERE destino_local = ?", (DESTINO,)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+        db.close_pool()
+
+
+def _loop_por_fila(conn: sqlite3.Connection, cantidad: int) -> int:
+    """Implementación anterior: SELECT de abiertos + un UPDATE por despacho."""
+    restante = cantidad; total = 0
+    rows = conn.execute(
+        "SELECT id, cajas_enviadas, cajas_devueltas FROM cd_despachos "
+        "WHERE destino_local = ? AND cajas_devueltas < cajas_enviadas ORDER BY fecha ASC, id ASC",
+        (DESTINO,),
+    ).fetchall()
+    for rid, envi, dev in rows:
+        if restante <= 0:
+            break
+        aplicar = min(envi - dev, restante)
+        conn.execute("UPDATE cd_despachos SET cajas_devueltas = cajas_devueltas + ? WHERE id = ?", (aplicar, rid))
+        restante -= aplicar; total += aplicar
+    conn.commit()
+    return total
+
+
+def _set_based(conn: sqlite3.Connection, cantidad: int) -> int:
+    from app.models.cd import asignar_devolucion_fifo
+    conn.execute("BEGIN IMMEDIATE")
+    detalle = asignar_devolucion_fifo(conn, DESTINO, cantidad)
+    conn.execute("COMMIT")
+    return sum(d["aplicado"] for d in detalle)
+
+
+def _estado(conn) -> list:
+    return conn.execute("SELECT id, cajas_devueltas FROM cd_despachos ORDER BY id").fetchall()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--abiertos", type=int, default=10000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, "base.db")
+        pendientes = _sembrar(base, args.abiertos)
+        print(f"{args.abiertos} despachos abiertos, {pendientes} cajas pendientes en {DESTINO}")
+        casos = (("devolución chica", 100), ("10% de pendientes", pendientes // 10), ("todos los pendientes", pendientes))
+        for etiqueta, cantidad in casos:
+            tiempos = {}
+            estados = {}
+            for nombre, fn in (("loop por fila", _loop_por_fila), ("UPDATE ... FROM", _set_based)):
+                mejor = None
+                for _ in range(args.repeticiones):
+                    copia = os.path.join(tmp, "copia.db")
+                    shutil.copyfile(base, copia)
+                    conn = sqlite3.connect(copia, isolation_level=None if fn is _set_based else "")
+                    try:
+                        t0 = time.perf_counter()
+                        total = fn(conn, cantidad)
+                        dt = time.perf_counter() - t0
+                        estados[nombre] = (total, _estado(conn))
+                    finally:
+                        conn.close()
+                    mejor = dt if mejor is None else min(mejor, dt)
+                tiempos[nombre] = mejor
+            iguales = estados["loop por fila"] == estados["UPDATE ... FROM"]
+            print(f"\n{etiqueta} ({cantidad} cajas) - resultados idénticos: {iguales}")
+            for nombre, dt in tiempos.items():
+                print(f"  {nombre:<18} {dt * 1000:8.1f} ms")
+            if not iguales:
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
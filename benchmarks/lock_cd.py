@@ -0,0 +1,112 @@
+"""Benchmark: tiempo de retención del lock de escritura en las operaciones del CD.
+
+Crea una base temporal con un CD con stock, lanza `--hilos` escritores concurrentes que
+alternan despachos, devoluciones, ediciones y envíos a origen, e imprime `db.lock_stats()`
+por operación. Con `--sin-cache` invalida el cache de CDs antes de cada escritura
+(peor caso: la resolución del CD consulta la base, pero siempre antes de tomar el lock).
+
+Uso:
+    python benchmarks/lock_cd.py [--hilos 4] [--operaciones 200] [--sin-cache]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import ENV_DB_PATH  # noqa: E402
+from app import db  # noqa: E402
+
+CD = "1 - CD Benchmark"
+DESTINOS = [f"{n} - Local {n}" for n in range(2, 12)]
+
+
+def _sembrar(path: str):
+    os.environ[ENV_DB_PATH] = path
+    db.init_database()
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD Benchmark', 1)")
+        for n in range(2, 12):
+            conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (?, ?)", (n, f"Local {n}"))
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer Benchmark')")
+        conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (last_insert_rowid(), '2024-01-01', 'Finalizado')")
+        viaje_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.execute(
+            "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, 0)",
+            (viaje_id, CD, 1_000_000),
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _escritor(semilla: int, operaciones: int, sin_cache: bool, errores: list):
+    from app.services import cd_service
+    from app.services.cache import invalidar
+    rnd = random.Random(semilla)
+    for _ in range(operaciones):
+        if sin_cache:
+            invalidar("reception_local")
+        destino = rnd.choice(DESTINOS)
+        op = rnd.random()
+        if op < 0.5:
+            ok, msg = cd_service.cd_crear_despacho(None, destino, "2024-02-01", rnd.randint(1, 20))
+        elif op < 0.7:
+            ok, msg = cd_service.cd_registrar_devolucion_por_destino(destino, rnd.randint(1, 10))
+        elif op < 0.85:
+            ok, msg = cd_service.cd_enviar_a_origen("2024-02-01", rnd.randint(1, 5))
+        else:
+            df = cd_service.cd_listar_despachos(start_date="2024-02-01", end_date="2024-02-01")
+            if df.empty:
+                continue
+            fila = df.iloc[rnd.randrange(len(df))]
+            ok, msg = cd_service.cd_actualizar_despacho_detallado(
+                int(fila["id"]), "2024-02-01", int(fila["cajas_enviadas"]) + 1, int(fila["cajas_devueltas"])
+            )
+        if not ok:
+            errores.append(msg)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hilos", type=int, default=4)
+    parser.add_argument("--operaciones", type=int, default=200, help="por hilo")
+    parser.add_argument("--sin-cache", action="store_true")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _sembrar(os.path.join(tmp, "lock.db"))
+        db.reset_lock_stats()
+        errores = []
+        hilos = [
+            threading.Thread(target=_escritor, args=(i, args.operaciones, args.sin_cache, errores))
+            for i in range(args.hilos)
+        ]
+        t0 = time.perf_counter()
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        total = time.perf_counter() - t0
+
+        print(f"{args.hilos} hilos x {args.operaciones} operaciones en {total:.2f} s"
+              f"{' (cache de CDs invalidado en cada escritura)' if args.sin_cache else ''}")
+        print(f"\n{'operación':<34}{'n':>6}{'rollb.':>8}{'busy':>6}{'espera máx':>12}{'lock prom':>11}{'lock máx':>10}")
+        for op, st in sorted(db.lock_stats().items()):
+            print(f"{op:<34}{st['count']:>6}{st['rollbacks']:>8}{st['busy']:>6}"
+                  f"{st['wait_max'] * 1000:>10.2f}ms{st['hold_avg'] * 1000:>9.3f}ms{st['hold_max'] * 1000:>8.2f}ms")
+        for msg in sorted(set(errores)):
+            print(f"  rechazo: {msg}")
+        db.close_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
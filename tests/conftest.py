@@ -0,0 +1,15 @@
+"""Fixtures comunes: cada test corre sobre una base temporal migrada (nunca cajas_plasticas.db)."""
+import pytest
+
+from app import db
+from app.config import ENV_DB_PATH
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    """Apunta app.db a una base nueva en tmp_path con el esquema al día; cierra el pool al salir."""
+    monkeypatch.setenv(ENV_DB_PATH, str(tmp_path / "test.db"))
+    db.close_pool()
+    db.init_database()
+    yield str(tmp_path / "test.db")
+    db.close_pool()
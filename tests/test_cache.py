@@ -0,0 +1,29 @@
+"""Cache versionado de lecturas (app.services.cache) y sus usuarios."""
+from app.services import locales_service
+from app.services.cache import cacheado, invalidar
+
+
+def test_listar_cds_ve_el_cd_recien_marcado(base):
+    assert locales_service.listar_cds() == []
+    assert locales_service.crear_local(1, "CD Norte", es_cd=True)[0]
+    assert locales_service.listar_cds() == ["1 - CD Norte"]
+    assert locales_service.crear_local(2, "Local", es_cd=False)[0]
+    id_local = next(l["id"] for l in locales_service.listar_locales() if l["numero"] == 2)
+    assert locales_service.actualizar_local(id_local, 2, "Local", es_cd=True)[0]
+    assert locales_service.listar_cds() == ["1 - CD Norte", "2 - Local"]
+    assert locales_service.get_cd_display() == "1 - CD Norte"
+
+
+def test_invalidar_todo_vence_lecturas_en_curso(base):
+    lecturas = []
+
+    @cacheado("viajes")
+    def leer():
+        lecturas.append(1)
+        if len(lecturas) == 1:
+            invalidar()  # "Limpiar datos" mientras la primera lectura está en curso
+        return len(lecturas)
+
+    assert leer() == 1
+    assert leer() == 2  # lo leído antes del borrado no quedó vigente
+    assert leer() == 2
@@ -0,0 +1,95 @@
+"""Stock diario del CD con devoluciones fechadas (migración 14): las devueltas se imputan al día en
+que se registran, así una devolución posterior no cambia el stock de días pasados."""
+import datetime
+
+import pytest
+
+from app import db
+from app.models import cd_stock
+from app.services import cd_service
+
+CD = "1 - CD"
+DESTINO = "2 - Destino"
+HOY = datetime.date.today()
+DIA = lambda n: (HOY + datetime.timedelta(days=n)).isoformat()
+
+
+@pytest.fixture
+def cd(base):
+    """CD con 100 cajas recibidas hace 30 días."""
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD', 1)")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (2, 'Destino')")
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer')")
+        viaje_id = conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (1, ?, 'Finalizado') RETURNING id",
+                                (DIA(-30),)).fetchone()[0]
+        conn.execute("INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, 100, 0)",
+                     (viaje_id, CD))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return CD
+
+
+def _despacho(fecha, enviadas, devueltas=0) -> int:
+    """Despacho insertado con sus devueltas: quedan a la fecha del despacho (como los previos a la migración)."""
+    conn = db.get_connection()
+    try:
+        rid = conn.execute("INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas)"
+                           " VALUES (?, ?, ?, ?, ?) RETURNING id", (CD, DESTINO, fecha, enviadas, devueltas)).fetchone()[0]
+        conn.commit()
+        return rid
+    finally:
+        conn.close()
+
+
+def _stock(n):
+    return cd_service.cd_stock_en_fecha(DIA(n), CD)["stock"]
+
+
+def _verificar_ok():
+    res = cd_stock.verificar([CD])
+    assert res["ok"], {k: res[k] for k in ("diferencias", "devoluciones", "diario")}
+
+
+def test_devolucion_posterior_no_cambia_dias_anteriores(cd):
+    assert cd_service.cd_crear_despacho(CD, DESTINO, DIA(-10), 20)[0]
+    conn = db.get_connection()
+    try:
+        rid = conn.execute("SELECT id FROM cd_despachos").fetchone()[0]
+    finally:
+        conn.close()
+    antes = [_stock(n) for n in (-10, -5, -1)]
+    assert antes == [80, 80, 80]
+
+    assert cd_service.cd_registrar_devolucion(rid, 5)[0]
+    assert [_stock(n) for n in (-10, -5, -1)] == antes
+    assert _stock(0) == 85
+    _verificar_ok()
+
+
+def test_revertir_resta_el_dia_actual(cd):
+    rid = _despacho(DIA(-10), 20, devueltas=5)
+    assert [_stock(n) for n in (-10, -1)] == [85, 85]
+
+    assert cd_service.cd_revertir_despacho_a_pendiente(rid)[0]
+    assert [_stock(n) for n in (-10, -1)] == [85, 85]
+    assert _stock(0) == 80
+    assert cd_service.cd_stock_en_fecha(DIA(0), CD)["devueltos"] == 0
+    _verificar_ok()
+
+
+def test_mover_fecha_del_despacho_adelanta_sus_devoluciones(cd):
+    rid = _despacho(DIA(-10), 20, devueltas=5)
+    assert cd_service.cd_actualizar_despacho(rid, DIA(-7), 20)[0]
+
+    conn = db.get_connection()
+    try:
+        fechas = [f for (f,) in conn.execute("SELECT fecha FROM cd_devoluciones WHERE despacho_id = ?", (rid,))]
+    finally:
+        conn.close()
+    assert fechas == [DIA(-7)]
+    assert [_stock(n) for n in (-10, -8, -7)] == [100, 100, 85]
+    _verificar_ok()
@@ -0,0 +1,124 @@
+"""Devoluciones concurrentes sobre un mismo ítem: nunca se devuelve más de lo enviado.
+
+Versión pytest de benchmarks/devoluciones_concurrentes.py (guardas en el WHERE + CHECK de la migración 10).
+"""
+import random
+import sqlite3
+import threading
+
+import pytest
+
+from app import db
+from app.models.viajes import viaje_eliminar_local
+from app.services import cd_service, viajes_service
+
+CD = "1 - CD Concurrencia"
+DESTINO = "2 - Local Concurrencia"
+CAJAS = 60
+HILOS = 6
+
+
+@pytest.fixture
+def items(base):
+    """(viaje_local_id, despacho_id) con CAJAS enviadas cada uno."""
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD Concurrencia', 1)")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (2, 'Local Concurrencia')")
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer')")
+        viaje_id = conn.execute(
+            "INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (last_insert_rowid(), '2024-01-01', 'En Curso') RETURNING id"
+        ).fetchone()[0]
+        conn.execute("INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, 0)",
+                     (viaje_id, CD, CAJAS * 2))
+        vl_id = conn.execute("INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, 0) RETURNING id",
+                             (viaje_id, DESTINO, CAJAS)).fetchone()[0]
+        despacho_id = conn.execute("INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas)"
+                                   " VALUES (?, ?, '2024-01-02', ?, 0) RETURNING id", (CD, DESTINO, CAJAS)).fetchone()[0]
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return vl_id, despacho_id
+
+
+def _concurrentes(registrar, item_id) -> int:
+    """HILOS operadores registran 1..3 cajas hasta 3 rechazos seguidos; devuelve las cajas aceptadas."""
+    aceptadas = []
+    barrera = threading.Barrier(HILOS)
+
+    def operador(semilla):
+        rnd = random.Random(semilla)
+        barrera.wait()
+        seguidos = 0
+        while seguidos < 3:
+            cant = rnd.randint(1, 3)
+            ok, _msg = registrar(item_id, cant)
+            if ok:
+                aceptadas.append(cant); seguidos = 0
+            else:
+                seguidos += 1
+
+    hilos = [threading.Thread(target=operador, args=(i,)) for i in range(HILOS)]
+    for t in hilos:
+        t.start()
+    for t in hilos:
+        t.join()
+    return sum(aceptadas)
+
+
+def _fila(tabla, item_id):
+    conn = db.get_connection()
+    try:
+        return conn.execute(f"SELECT cajas_enviadas, cajas_devueltas FROM {tabla} WHERE id = ?", (item_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def test_viaje_local_no_excede(items):
+    vl_id, _ = items
+    aceptadas = _concurrentes(lambda i, c: viajes_service.registrar_devolucion(i, c, usuario="test"), vl_id)
+    enviadas, devueltas = _fila("viaje_locales", vl_id)
+    assert devueltas <= enviadas
+    assert devueltas == aceptadas
+    conn = db.get_connection()
+    try:
+        log = conn.execute("SELECT COALESCE(SUM(cantidad), 0) FROM devoluciones_log WHERE viaje_local_id = ?", (vl_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    assert log == devueltas
+
+
+def test_despacho_no_excede(items):
+    _, despacho_id = items
+    aceptadas = _concurrentes(cd_service.cd_registrar_devolucion, despacho_id)
+    enviadas, devueltas = _fila("cd_despachos", despacho_id)
+    assert devueltas <= enviadas
+    assert devueltas == aceptadas
+
+
+@pytest.mark.parametrize("tabla", ["viaje_locales", "cd_despachos"])
+def test_check_rechaza_update_directo(items, tabla):
+    item_id = items[0] if tabla == "viaje_locales" else items[1]
+    conn = db.get_connection()
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute(f"UPDATE {tabla} SET cajas_devueltas = cajas_enviadas + 1 WHERE id = ?", (item_id,))
+        conn.rollback()
+    finally:
+        conn.close()
+    assert _fila(tabla, item_id)[1] == 0
+
+
+def test_eliminar_con_devoluciones_rechazado(items):
+    vl_id, despacho_id = items
+    assert viajes_service.registrar_devolucion(vl_id, 1)[0]
+    assert cd_service.cd_registrar_devolucion(despacho_id, 1)[0]
+
+    assert viaje_eliminar_local(vl_id) == (False, "No se puede eliminar: ya tiene devoluciones")
+    assert cd_service.cd_eliminar_despacho(despacho_id) == (False, "No se puede eliminar: ya tiene devoluciones registradas")
+    assert _fila("viaje_locales", vl_id) is not None
+    assert _fila("cd_despachos", despacho_id) is not None
+    # Sin la fila, el mismo rowcount 0 informa que no existe
+    assert viaje_eliminar_local(-1) == (False, "Registro no existe")
+    assert cd_service.cd_eliminar_despacho(-1) == (False, "Despacho no encontrado")
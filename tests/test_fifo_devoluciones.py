@@ -0,0 +1,72 @@
+"""Devolución por destino: asignación FIFO (fecha, id) con suma corrida (app.models.cd._FIFO_CTE)."""
+import pytest
+
+from app import db
+from app.services import cd_service
+
+CD = "1 - CD"
+DESTINO = "2 - Destino"
+
+
+@pytest.fixture
+def despachos(base):
+    """Despachos abiertos del destino; retorna sus ids en orden FIFO (fecha, id)."""
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO reception_local (numero, nombre, es_cd) VALUES (1, 'CD', 1)")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (2, 'Destino')")
+        conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (3, 'Sin despachos')")
+        sql = ("INSERT INTO cd_despachos (cd_local, destino_local, fecha, cajas_enviadas, cajas_devueltas)"
+               " VALUES (?, ?, ?, ?, ?) RETURNING id")
+        # Insertados fuera de orden: el 2024-01-05 va después de los dos del 2024-01-03
+        tardio = conn.execute(sql, (CD, DESTINO, "2024-01-05", 6, 0)).fetchone()[0]
+        mismo_dia = [conn.execute(sql, (CD, DESTINO, "2024-01-03", env, dev)).fetchone()[0] for env, dev in ((5, 1), (3, 0))]
+        conn.execute(sql, (CD, DESTINO, "2024-01-01", 2, 2))  # cerrado: no participa
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return mismo_dia + [tardio]
+
+
+def _devueltas(ids):
+    conn = db.get_connection()
+    try:
+        return [conn.execute("SELECT cajas_devueltas FROM cd_despachos WHERE id = ?", (i,)).fetchone()[0] for i in ids]
+    finally:
+        conn.close()
+
+
+def test_asignacion_parcial_en_varios_despachos(despachos):
+    a, b, c = despachos
+    ok, detalle = cd_service.cd_asignar_devolucion_por_destino(DESTINO, 6)
+    assert ok
+    assert detalle == [
+        {"despacho_id": a, "fecha": "2024-01-03", "aplicado": 4, "pendientes_restantes": 0},
+        {"despacho_id": b, "fecha": "2024-01-03", "aplicado": 2, "pendientes_restantes": 1},
+    ]
+    assert _devueltas(despachos) == [5, 2, 0]
+    assert cd_service.cd_registrar_devolucion_por_destino(DESTINO, 2) == (True, 2)
+    assert _devueltas(despachos) == [5, 3, 1]
+
+
+def test_mismo_dia_ordenado_por_id(despachos):
+    a, b, _c = despachos
+    ok, detalle = cd_service.cd_asignar_devolucion_por_destino(DESTINO, 1)
+    assert ok and [d["despacho_id"] for d in detalle] == [a]
+    assert a < b
+
+
+def test_cantidad_mayor_que_lo_pendiente(despachos):
+    ok, detalle = cd_service.cd_asignar_devolucion_por_destino(DESTINO, 100)
+    assert ok
+    assert [d["aplicado"] for d in detalle] == [4, 3, 6]
+    assert all(d["pendientes_restantes"] == 0 for d in detalle)
+    assert _devueltas(despachos) == [5, 3, 6]
+    assert cd_service.cd_asignar_devolucion_por_destino(DESTINO, 1) == (True, [])
+
+
+@pytest.mark.parametrize("destino", ["3 - Sin despachos", "99 - No existe"])
+def test_destino_sin_despachos_abiertos(despachos, destino):
+    assert cd_service.cd_asignar_devolucion_por_destino(destino, 5) == (True, [])
+    assert _devueltas(despachos) == [1, 0, 0]
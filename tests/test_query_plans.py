@@ -0,0 +1,29 @@
+"""Gate de planes: los escenarios de HOT_QUERIES no recorren completa una tabla grande.
+
+Equivale a `python -m app.query_plans --check` (base temporal sembrada, no toca cajas_plasticas.db).
+"""
+import pytest
+
+from app import query_plans
+
+
+@pytest.fixture(scope="module")
+def planes():
+    return query_plans.ejecutar()
+
+
+def test_hot_queries_capturadas(planes):
+    # Un escenario que deja de emitir SQL (renombrado, error) no debe pasar el gate en silencio
+    capturados = {p.escenario for p in planes}
+    faltantes = [h for h in query_plans.HOT_QUERIES if h not in capturados]
+    assert faltantes == []
+
+
+def test_hot_queries_sin_regresiones(planes):
+    regresiones = query_plans.check_hot_queries(planes)
+    assert regresiones == [], "\n".join(f"{p.escenario}: {p.sql[:160]} -> {p.plan}" for p in regresiones)
+
+
+def test_check_detecta_scan():
+    plan = query_plans.StatementPlan("cd.totales", "SELECT 1 FROM cd_despachos", ["SCAN cd_despachos"], [("cd_despachos", 5000)])
+    assert query_plans.check_hot_queries([plan]) == [plan]
@@ -0,0 +1,68 @@
+"""update_devueltas_viaje_locales: validación del lote con un motivo por ítem rechazado."""
+import pytest
+
+from app import db
+from app.services import viajes_service
+
+
+@pytest.fixture
+def viaje(base):
+    """(viaje_id, [viaje_local_id con 10, 5 y 8 enviadas], viaje_local_id de otro viaje)."""
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN")
+        for n in (1, 2, 3):
+            conn.execute("INSERT INTO reception_local (numero, nombre) VALUES (?, ?)", (n, f"Local {n}"))
+        conn.execute("INSERT INTO choferes (nombre) VALUES ('Chofer')")
+        viajes = [conn.execute("INSERT INTO viajes (chofer_id, fecha_viaje, estado) VALUES (1, ?, 'En Curso') RETURNING id",
+                               (fecha,)).fetchone()[0] for fecha in ("2024-01-01", "2024-01-02")]
+        sql = "INSERT INTO viaje_locales (viaje_id, numero_local, cajas_enviadas, cajas_devueltas) VALUES (?, ?, ?, ?) RETURNING id"
+        ids = [conn.execute(sql, (viajes[0], f"{n} - Local {n}", env, dev)).fetchone()[0]
+               for n, env, dev in ((1, 10, 2), (2, 5, 0), (3, 8, 1))]
+        ajeno = conn.execute(sql, (viajes[1], "1 - Local 1", 4, 0)).fetchone()[0]
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return viajes[0], ids, ajeno
+
+
+def _devueltas(ids):
+    conn = db.get_connection()
+    try:
+        return [conn.execute("SELECT cajas_devueltas FROM viaje_locales WHERE id = ?", (i,)).fetchone()[0] for i in ids]
+    finally:
+        conn.close()
+
+
+def test_lote_mixto_rechaza_con_motivo_por_item(viaje):
+    viaje_id, (a, b, c), ajeno = viaje
+    ok, motivos = viajes_service.update_devueltas_viaje_locales(viaje_id, [
+        {"id": a, "cajas_devueltas": 2},    # sin cambios: no es un error
+        {"id": b, "cajas_devueltas": 6},    # fuera de rango
+        {"id": c, "cajas_devueltas": 3},    # duplicado
+        {"id": c, "cajas_devueltas": 4},
+        {"id": ajeno, "cajas_devueltas": 1},
+    ])
+    assert not ok
+    assert sorted(motivos, key=lambda m: m["id"]) == sorted([
+        {"id": b, "motivo": "devueltas (6) deben estar entre 0 y 5"},
+        {"id": c, "motivo": "tiene más de un cambio en el lote"},
+        {"id": ajeno, "motivo": "no pertenece al viaje"},
+    ], key=lambda m: m["id"])
+    assert _devueltas([a, b, c, ajeno]) == [2, 0, 1, 0]
+
+
+def test_datos_invalidos(viaje):
+    viaje_id, (a, _b, _c), _ = viaje
+    ok, motivos = viajes_service.update_devueltas_viaje_locales(viaje_id, [{"id": a, "cajas_devueltas": "x"}])
+    assert not ok and motivos == [{"id": a, "motivo": "datos inválidos"}]
+
+
+def test_lote_valido_aplica_solo_los_cambios(viaje):
+    viaje_id, (a, b, c), _ = viaje
+    ok, msg = viajes_service.update_devueltas_viaje_locales(viaje_id, [
+        {"id": a, "cajas_devueltas": 2}, {"id": b, "cajas_devueltas": 5}, {"id": c, "cajas_devueltas": 0},
+    ])
+    assert (ok, msg) == (True, "2 locales actualizados")
+    assert _devueltas([a, b, c]) == [2, 5, 0]
+    assert viajes_service.update_devueltas_viaje_locales(viaje_id, [{"id": a, "cajas_devueltas": 2}]) == (False, "Sin cambios")